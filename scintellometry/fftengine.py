@@ -0,0 +1,196 @@
+"""FFT engine that plans transforms once and reuses the plans.
+
+The ``pyfftw.interfaces`` functions used previously plan every transform
+anew, and hence had to use ``FFTW_ESTIMATE`` to keep planning cheap.  Since
+we transform arrays of the same shapes block after block (often for days),
+it is much better to make measured plans once, and to keep the resulting
+wisdom on disk, so that later runs (and other MPI ranks) can reuse it.
+
+The module-level functions ``fft``, ``ifft``, ``rfft`` and ``irfft`` have
+the same call signature as their ``numpy.fft`` counterparts (except that
+``n`` is only supported for ``irfft``), and use a default engine that is
+set up from environment variables:
+
+SCINTELLOMETRY_FFTW_WISDOM : file in which to keep wisdom (default
+    ``~/.scintellometry_fftw_wisdom``; set to an empty string to disable).
+SCINTELLOMETRY_FFTW_EFFORT : planner effort (default ``FFTW_MEASURE``).
+OMP_NUM_THREADS : number of threads to use (default 2).
+
+If pyfftw is not available, ``scipy.fftpack`` is used for complex
+transforms (since unlike numpy it does not cast up to complex128), and
+numpy for real ones (since the data order of scipy's rfft is awkward).
+
+Note that the input array may be overwritten.
+"""
+from __future__ import division, print_function
+
+import atexit
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import pyfftw
+except ImportError:
+    print("Consider installing pyfftw: https://github.com/hgomersall/pyFFTW")
+    pyfftw = None
+    from scipy.fftpack import fft as _fft, ifft as _ifft
+    from numpy.fft import rfft as _rfft, irfft as _irfft
+
+
+WISDOM_FILE = os.environ.get('SCINTELLOMETRY_FFTW_WISDOM',
+                             os.path.expanduser(
+                                 '~/.scintellometry_fftw_wisdom'))
+PLANNER_EFFORT = os.environ.get('SCINTELLOMETRY_FFTW_EFFORT', 'FFTW_MEASURE')
+THREADS = int(os.environ.get('OMP_NUM_THREADS', 2))
+
+
+class FFTEngine(object):
+    """Create and cache pyfftw plans, keyed by the arrays they act on.
+
+    Parameters
+    ----------
+    threads : int
+        Number of threads used by FFTW (default: ``THREADS``).
+    planner_effort : str
+        FFTW planner flag (default: ``PLANNER_EFFORT``).
+    wisdom_file : str or None
+        File from which wisdom is read on creation, and to which it is
+        written by ``save_wisdom`` (default: ``WISDOM_FILE``).
+    maxsize : int
+        Maximum number of plans to keep per thread (least recently used
+        ones are discarded first, since each plan holds aligned arrays).
+
+    Notes
+    -----
+    Plans are kept separately for each thread, so that threads can
+    execute transforms concurrently.  Since all threads share the FFTW
+    wisdom, only the first plan for a given transform is expensive.
+    """
+    def __init__(self, threads=None, planner_effort=None, wisdom_file=None,
+                 maxsize=16):
+        self.threads = THREADS if threads is None else threads
+        self.planner_effort = (PLANNER_EFFORT if planner_effort is None
+                               else planner_effort)
+        self.wisdom_file = (WISDOM_FILE if wisdom_file is None
+                            else wisdom_file)
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self.new_wisdom = False
+        if pyfftw is not None:
+            self.load_wisdom()
+
+    @property
+    def plans(self):
+        """Cache of plans for the current thread."""
+        plans = getattr(self._local, 'plans', None)
+        if plans is None:
+            plans = self._local.plans = OrderedDict()
+        return plans
+
+    def load_wisdom(self):
+        """Import wisdom from the wisdom file, if it exists."""
+        if not self.wisdom_file or not os.path.exists(self.wisdom_file):
+            return
+        try:
+            with open(self.wisdom_file, 'rb') as fh:
+                pyfftw.import_wisdom(pickle.load(fh))
+        except Exception as exc:  # corrupt or from other FFTW version
+            print("Could not import FFTW wisdom from {0}: {1}"
+                  .format(self.wisdom_file, exc))
+
+    def save_wisdom(self):
+        """Merge our wisdom with that on disk, and write it back.
+
+        The file is replaced atomically, so that different processes
+        sharing the same file do not corrupt it.
+        """
+        if pyfftw is None or not self.new_wisdom or not self.wisdom_file:
+            return
+        self.load_wisdom()
+        tmp_file = '{0}.{1}'.format(self.wisdom_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as fh:
+                pickle.dump(pyfftw.export_wisdom(), fh, protocol=2)
+            os.rename(tmp_file, self.wisdom_file)
+        except (IOError, OSError) as exc:
+            print("Could not save FFTW wisdom to {0}: {1}"
+                  .format(self.wisdom_file, exc))
+        else:
+            self.new_wisdom = False
+
+    def plan(self, kind, shape, dtype, axis=-1, n=None):
+        """Get a pyfftw.builders object for the given transform.
+
+        Parameters
+        ----------
+        kind : {'fft', 'ifft', 'rfft', 'irfft'}
+            Type of transform.
+        shape : tuple
+            Shape of the input array.
+        dtype : `~numpy.dtype`
+            Data type of the input array.
+        axis : int
+            Axis along which to transform.
+        n : int or None
+            Length of the output along axis (for ``irfft`` only).
+        """
+        axis = axis % len(shape)
+        key = (kind, tuple(shape), np.dtype(dtype).str, axis, n)
+        plans = self.plans
+        plan = plans.pop(key, None)
+        if plan is None:
+            builder = getattr(pyfftw.builders, kind)
+            args = {} if n is None else {'n': n}
+            plan = builder(pyfftw.empty_aligned(shape, dtype), axis=axis,
+                           overwrite_input=True, threads=self.threads,
+                           planner_effort=self.planner_effort,
+                           avoid_copy=False, **args)
+            self.new_wisdom = True
+            while len(plans) >= self.maxsize:
+                plans.popitem(last=False)
+        plans[key] = plan  # (re)insert as most recently used.
+        return plan
+
+    def execute(self, kind, a, axis=-1, n=None):
+        """Transform a, using a (cached) plan.
+
+        The result is written to a newly allocated aligned array, so that
+        it is not overwritten by subsequent transforms.
+        """
+        a = np.asanyarray(a)
+        plan = self.plan(kind, a.shape, a.dtype, axis, n)
+        out = pyfftw.empty_aligned(plan.output_shape, plan.output_dtype)
+        return plan(a, out)
+
+    def fft(self, a, axis=-1):
+        if pyfftw is None:
+            return _fft(a, axis=axis, overwrite_x=True)
+        return self.execute('fft', a, axis)
+
+    def ifft(self, a, axis=-1):
+        if pyfftw is None:
+            return _ifft(a, axis=axis, overwrite_x=True)
+        return self.execute('ifft', a, axis)
+
+    def rfft(self, a, axis=-1):
+        if pyfftw is None:
+            return _rfft(a, axis=axis)
+        return self.execute('rfft', a, axis)
+
+    def irfft(self, a, n=None, axis=-1):
+        if pyfftw is None:
+            return _irfft(a, n=n, axis=axis)
+        return self.execute('irfft', a, axis, n)
+
+
+engine = FFTEngine()
+atexit.register(engine.save_wisdom)
+
+fft = engine.fft
+ifft = engine.ifft
+rfft = engine.rfft
+irfft = engine.irfft
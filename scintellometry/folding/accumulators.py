@@ -0,0 +1,66 @@
+"""Accumulators for fold that can be kept on disk rather than in memory.
+
+For many channels, phase bins and time bins, the folded spectra (and for
+high time resolution, the waterfall) can be far larger than the memory
+available per process.  Since only the time bins currently being filled
+are changed, the accumulators can instead be memory-mapped to files:
+the operating system then keeps in memory only the parts being used, and
+``flush`` ensures completed parts are written out, so that their pages
+can be released.
+"""
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+
+ACCUMULATOR = '{0}_rank{1:04d}.npy'
+
+
+def accumulator(shape, dtype, directory=None, name=None, rank=0):
+    """Create a zeroed array, in memory or memory-mapped to a file.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array.
+    dtype : `~numpy.dtype`
+        Data type of the array.
+    directory : str or None
+        If given, the array is memory-mapped to a file in this directory
+        (any existing file is replaced).
+    name : str
+        Name of the accumulator, used for the file name.
+    rank : int
+        MPI rank, used for the file name.
+    """
+    if directory is None:
+        return np.zeros(shape, dtype=dtype)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # another process may have beaten us to it.
+            if not os.path.isdir(directory):
+                raise
+    filename = os.path.join(directory, ACCUMULATOR.format(name, rank))
+    # remove rather than truncate an existing file, since it may still be
+    # mapped by results of an earlier fold.
+    if os.path.exists(filename):
+        os.remove(filename)
+    # new files are sparse and read as zeros.
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=shape)
+
+
+def flush(*accumulators):
+    """Write changes to memory-mapped accumulators to disk.
+
+    Arguments can be arrays, lists of arrays, or None; those not
+    memory-mapped are ignored.
+    """
+    for item in accumulators:
+        for array in (item if isinstance(item, list) else [item]):
+            if isinstance(array, np.memmap):
+                array.flush()
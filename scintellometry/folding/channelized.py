@@ -0,0 +1,203 @@
+"""Archive of channelized spectra, to avoid re-reading and re-FFTing data.
+
+``fold`` spends most of its time reading, decoding, channelizing and (for
+coherent or by-channel dedispersion) dedispersing raw voltages.  None of
+these depend on the pulsar ephemeris or the number of phase bins, so when
+folding the same data repeatedly, it is much faster to store the resulting
+power spectra once (pass ``channelized_output`` to ``fold``), and then fold
+from a ``ChannelizedArchive`` instead of the raw data reader.
+
+The archive is a directory with a header and compressed npz shards, each
+holding the spectra of a contiguous range of blocks (as handled by a single
+MPI process).  The power is stored before any incoherent dedispersion and
+before ``rfi_filter_power`` is applied, so these can be changed between
+folds.  For coherent and by-channel dedispersion, the dispersion measure is
+fixed by the archive.
+"""
+from __future__ import division, print_function
+
+import os
+import re
+
+import numpy as np
+import astropy.units as u
+
+
+HEADER = 'header.npz'
+SHARD = 'block{0:08d}.npz'
+# Units in which Quantities are stored in the header.
+HEADER_UNITS = {'dtsample': u.s, 'tstart': u.s,
+                'freq': u.MHz, 'freq_in': u.MHz, 'fref': u.MHz,
+                'dm': u.pc / u.cm**3}
+
+
+class ChannelizedWriter(object):
+    """Write power spectra calculated in fold to an archive directory.
+
+    Parameters
+    ----------
+    name : str
+        Directory to write to (created if needed).
+    header : dict
+        Properties describing the spectra, as set up by fold.  Written by
+        the rank 0 process only.
+    chunksize : int
+        Number of blocks to store in each shard (default: 16).
+    comm : MPI communicator or None
+        Used to determine the rank.
+    """
+    def __init__(self, name, header, chunksize=16, comm=None):
+        self.name = name
+        self.chunksize = chunksize
+        self.rank = 0 if comm is None else comm.rank
+        if not os.path.isdir(name):
+            try:
+                os.makedirs(name)
+            except OSError:  # another process may have beaten us to it.
+                if not os.path.isdir(name):
+                    raise
+        if self.rank == 0:
+            values = {}
+            for key, value in header.items():
+                if value is None:  # e.g., dedisperse; absent when read.
+                    continue
+                if isinstance(value, u.Quantity):
+                    value = value.to(HEADER_UNITS[key]).value
+                values[key] = np.array(value)
+            np.savez(os.path.join(name, HEADER), **values)
+        self._first = None
+        self._power = []
+
+    def write(self, block, power):
+        """Buffer the power for a block, writing a shard when full."""
+        if self._power and block != self._first + len(self._power):
+            self.flush()
+        if not self._power:
+            self._first = block
+        # copy, since fold reuses the power arrays for later blocks.
+        self._power.append(np.array(power, dtype=np.float32))
+        if len(self._power) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        """Write out buffered blocks as a shard."""
+        if self._power:
+            np.savez_compressed(
+                os.path.join(self.name, SHARD.format(self._first)),
+                power=np.array(self._power))
+        self._power = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ChannelizedArchive(object):
+    """Reader for an archive of power spectra, to be passed on to fold.
+
+    Parameters
+    ----------
+    name : str
+        Directory holding the archive.
+    """
+    telescope = 'channelized'
+
+    def __init__(self, name):
+        self.name = name
+        with np.load(os.path.join(name, HEADER)) as header:
+            self.header = {}
+            for key in header.files:
+                value = header[key]
+                value = value.item() if value.ndim == 0 else value
+                if key in HEADER_UNITS:
+                    value = value * HEADER_UNITS[key]
+                self.header[key] = value
+        for key in ('nchan', 'npol', 'oversample', 'ntint', 'nt', 'nskip',
+                    'dtsample', 'tstart', 'freq', 'freq_in'):
+            setattr(self, key, self.header[key])
+        # Index the shards by the first block they contain.
+        shards = {}
+        for filename in os.listdir(name):
+            match = re.match(SHARD.replace('{0:08d}', r'(\d+)'), filename)
+            if match:
+                shards[int(match.group(1))] = os.path.join(name, filename)
+        self.shard_start = np.array(sorted(shards), dtype=int)
+        self.shard_files = [shards[start] for start in self.shard_start]
+        self._current = None
+
+    def check(self, nchan, ntint, dedisperse, dm, nt=None, fref=None,
+              npol=None, nskip=None):
+        """Check the archive can be folded with the given parameters.
+
+        Parameters that are None are not checked.  The reference frequency
+        is only checked for coherent dedispersion, since otherwise it is
+        only used for the dispersion delays applied while folding.
+        """
+        if nchan != self.nchan:
+            raise ValueError("Archive has nchan={0}; cannot fold with {1}."
+                             .format(self.nchan, nchan))
+        if ntint != self.ntint:
+            raise ValueError("Archive has ntint={0}; cannot fold with {1}."
+                             .format(self.ntint, ntint))
+        if nt is not None and nt != self.nt:
+            raise ValueError("Archive has nt={0}; cannot fold with {1}."
+                             .format(self.nt, nt))
+        if npol is not None and npol != self.npol:
+            raise ValueError("Archive has npol={0}; cannot fold data with "
+                             "{1}.".format(self.npol, npol))
+        if nskip is not None and not np.isclose(nskip, self.nskip):
+            raise ValueError("Archive starts at block {0} (tstart={1}); "
+                             "cannot fold from block {2}."
+                             .format(self.nskip, self.tstart, nskip))
+        if dedisperse != self.header.get('dedisperse'):
+            raise ValueError("Archive was made with dedisperse={0!r}; cannot "
+                             "fold with {1!r}."
+                             .format(self.header.get('dedisperse'),
+                                     dedisperse))
+        if (dedisperse in ('coherent', 'by-channel') and
+                not np.all(np.isclose(dm.to(HEADER_UNITS['dm']).value,
+                                      self.header['dm'].value))):
+            raise ValueError("Archive was {0} dedispersed with dm={1}; "
+                             "cannot fold with dm={2}."
+                             .format(dedisperse, self.header['dm'], dm))
+        if (dedisperse == 'coherent' and fref is not None and
+                not np.isclose(fref.to(HEADER_UNITS['fref']).value,
+                               self.header['fref'].value)):
+            raise ValueError("Archive was coherently dedispersed with "
+                             "fref={0}; cannot fold with fref={1}."
+                             .format(self.header['fref'], fref))
+
+    def read_power(self, block):
+        """Get the power for the given block (counting from the start of
+        the folded range).  Raises EOFError if it is not in the archive."""
+        ishard = np.searchsorted(self.shard_start, block, side='right') - 1
+        if ishard < 0:
+            raise EOFError("Block {0} is not in {1}".format(block, self))
+        if self._current is None or self._current[0] != ishard:
+            with np.load(self.shard_files[ishard]) as shard:
+                self._current = (ishard, shard['power'])
+        power = self._current[1]
+        index = block - self.shard_start[ishard]
+        if index >= len(power):
+            raise EOFError("Block {0} is not in {1}".format(block, self))
+        return power[index]
+
+    def close(self):
+        self._current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return ("<ChannelizedArchive {0}: {1} blocks of {2} samples x "
+                "{3} channels>".format(self.name, self.nt,
+                                       self.ntint // self.oversample,
+                                       self.nchan))
@@ -0,0 +1,202 @@
+"""Checkpoints of the accumulators of fold, to resume interrupted folds.
+
+With ``checkpoint`` given, ``fold`` regularly saves its folded spectra,
+counts and waterfall, together with the last block processed, to a file
+per MPI rank in the checkpoint directory.  If a checkpoint exists when
+``fold`` starts, the accumulators are restored from it, and folding
+continues with the next block.  With ``merge_checkpoints``, the results
+of all ranks can also be combined without running ``fold`` again, e.g.,
+to inspect a job that was stopped before it finished.
+"""
+from __future__ import division, print_function
+
+import os
+import re
+
+import numpy as np
+
+
+CHECKPOINT = 'rank{0:04d}.npz'
+
+
+def checkpoint_name(directory, rank):
+    """Name of the checkpoint file for the given MPI rank."""
+    return os.path.join(directory, CHECKPOINT.format(rank))
+
+
+def save_checkpoint(filename, block, foldspec, icount, waterfall, **info):
+    """Save accumulators, replacing any previous checkpoint atomically.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the checkpoint file.
+    block : int
+        Last block that was folded.
+    foldspec, icount : list of array, or None
+        Folded spectra and counts for each target.
+    waterfall : array or None
+        Waterfall series.
+    **info
+        Further scalar information needed to check or interpret the
+        checkpoint (e.g., start_block, end_block).
+    """
+    arrays = dict(info, block=block)
+    if foldspec is not None:
+        arrays['ntarget'] = len(foldspec)
+        for i, (_foldspec, _icount) in enumerate(zip(foldspec, icount)):
+            arrays['foldspec{0}'.format(i)] = _foldspec
+            arrays['icount{0}'.format(i)] = _icount
+    if waterfall is not None:
+        arrays['waterfall'] = waterfall
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # another process may have beaten us to it.
+            if not os.path.isdir(directory):
+                raise
+    tmp_file = filename[:-4] + '.tmp.npz'
+    np.savez(tmp_file, **arrays)
+    os.rename(tmp_file, filename)
+
+
+def load_checkpoint(filename):
+    """Read a checkpoint.
+
+    Returns
+    -------
+    checkpoint : dict
+        With entries 'block', 'foldspec' and 'icount' (lists, or None if
+        not folded), 'waterfall' (or None), and any further information
+        that was saved.
+    """
+    with np.load(filename) as data:
+        checkpoint = {key: (data[key].item() if data[key].ndim == 0
+                            else data[key])
+                      for key in data.files
+                      if not re.match(r'(foldspec|icount)\d+$', key)}
+        if 'ntarget' in checkpoint:
+            ntarget = checkpoint.pop('ntarget')
+            checkpoint['foldspec'] = [data['foldspec{0}'.format(i)]
+                                      for i in range(ntarget)]
+            checkpoint['icount'] = [data['icount{0}'.format(i)]
+                                    for i in range(ntarget)]
+        else:
+            checkpoint['foldspec'] = checkpoint['icount'] = None
+    checkpoint.setdefault('waterfall', None)
+    return checkpoint
+
+
+def restore_checkpoint(filename, foldspec, icount, waterfall, **info):
+    """Restore accumulators from a checkpoint, if it exists.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the checkpoint file.
+    foldspec, icount : list of array, or None
+        Folded spectra and counts for each target, updated in-place.
+    waterfall : array or None
+        Waterfall series, updated in-place.
+    **info
+        Information that should match that stored in the checkpoint.
+
+    Returns
+    -------
+    block : int or None
+        Last block that was folded, or None if there was no checkpoint.
+    """
+    if not os.path.exists(filename):
+        return None
+    checkpoint = load_checkpoint(filename)
+    for key, value in info.items():
+        if checkpoint.get(key) != value:
+            raise ValueError("Checkpoint {0} has {1}={2}, but fold has {3}."
+                             .format(filename, key, checkpoint.get(key),
+                                     value))
+    pairs = [(waterfall, checkpoint['waterfall'])]
+    if foldspec is not None:
+        if (checkpoint['foldspec'] is None or
+                len(checkpoint['foldspec']) != len(foldspec)):
+            raise ValueError("Checkpoint {0} does not have folded spectra "
+                             "for {1} targets.".format(filename,
+                                                       len(foldspec)))
+        pairs += list(zip(foldspec, checkpoint['foldspec']))
+        pairs += list(zip(icount, checkpoint['icount']))
+    for accumulator, saved in pairs:
+        if accumulator is None:
+            continue
+        if saved is None or saved.shape != accumulator.shape:
+            raise ValueError("Checkpoint {0} does not match the shapes of "
+                             "the arrays being accumulated."
+                             .format(filename))
+        accumulator[...] = saved
+    return checkpoint['block']
+
+
+def output_arrays(foldspec, icount, waterfall, multi_dm, npol,
+                  single_target):
+    """Convert accumulators to the form in which fold returns them.
+
+    The accumulators always have a leading axis for dispersion measure and
+    a trailing one for polarisation, and foldspec and icount are lists
+    with one entry per folding target.  These are removed if not needed.
+    """
+    if not multi_dm:
+        if foldspec is not None:
+            foldspec = [_foldspec[0] for _foldspec in foldspec]
+            icount = [_icount[0] for _icount in icount]
+        if waterfall is not None:
+            waterfall = waterfall[0]
+
+    if npol == 1:
+        if foldspec is not None:
+            foldspec = [_foldspec.reshape(_foldspec.shape[:-1])
+                        for _foldspec in foldspec]
+        if waterfall is not None:
+            waterfall = waterfall.reshape(waterfall.shape[:-1])
+
+    if foldspec is not None and single_target:
+        foldspec = foldspec[0]
+        icount = icount[0]
+
+    return foldspec, icount, waterfall
+
+
+def merge_checkpoints(directory):
+    """Sum the checkpoints of all ranks in a directory.
+
+    Returns
+    -------
+    foldspec, icount, waterfall : array, list of array, or None
+        In the form returned by fold.
+    nblock : int
+        Total number of blocks covered by the checkpoints (including any
+        skipped as bad).
+    """
+    filenames = sorted(name for name in os.listdir(directory)
+                       if re.match(CHECKPOINT.replace('{0:04d}', r'\d+')
+                                   .replace('.', r'\.') + '$', name))
+    if not filenames:
+        raise IOError("No checkpoints found in {0}".format(directory))
+    foldspec = icount = waterfall = None
+    nblock = 0
+    for filename in filenames:
+        checkpoint = load_checkpoint(os.path.join(directory, filename))
+        nblock += checkpoint['block'] + 1 - checkpoint['start_block']
+        if foldspec is None:
+            foldspec = checkpoint['foldspec']
+            icount = checkpoint['icount']
+        elif checkpoint['foldspec'] is not None:
+            for i in range(len(foldspec)):
+                foldspec[i] += checkpoint['foldspec'][i]
+                icount[i] += checkpoint['icount'][i]
+        if waterfall is None:
+            waterfall = checkpoint['waterfall']
+        elif checkpoint['waterfall'] is not None:
+            waterfall += checkpoint['waterfall']
+
+    return output_arrays(foldspec, icount, waterfall,
+                         checkpoint['multi_dm'], checkpoint['npol'],
+                         checkpoint['single_target']) + (nblock,)
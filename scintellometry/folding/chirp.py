@@ -0,0 +1,128 @@
+"""Phase factors for coherent dedispersion, calculated once and cached.
+
+For coherent and by-channel dedispersion, the fine-channel spectra are
+multiplied with a chirp that undoes the dispersive phase rotation.  For
+large blocks, this has as many elements as samples in a block, and
+calculating it with Quantity arithmetic takes seconds and many temporaries.
+Here, it is calculated with plain float64 numpy in chunks, directly into
+a complex64 result, which is kept in an in-process cache and, if a cache
+directory is given (by default from the SCINTELLOMETRY_CHIRP_CACHE
+environment variable), on disk, so that restarts and repeated folds need
+not recalculate it.
+"""
+from __future__ import division, print_function
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import astropy.units as u
+
+dispersion_delay_constant = 4149. * u.s * u.MHz**2 * u.cm**3 / u.pc
+
+CACHE_DIR = os.environ.get('SCINTELLOMETRY_CHIRP_CACHE', '')
+CHUNKSIZE = 2**20  # approximate number of elements calculated at a time
+MAXSIZE = 4  # number of chirps kept in memory
+
+_chirps = OrderedDict()
+
+
+def chirp_key(dm, fcoh, fref):
+    """Hash uniquely identifying a chirp."""
+    key = hashlib.sha1()
+    for value in (dm.to(u.pc / u.cm**3), fcoh.to(u.MHz), fref.to(u.MHz)):
+        value = np.asarray(value.value, dtype=np.float64)
+        key.update(str(value.shape).encode())
+        key.update(np.ascontiguousarray(value).tobytes())
+    return key.hexdigest()
+
+
+def calculate_chirp(dm, fcoh, fref, chunksize=CHUNKSIZE):
+    """Calculate the chirp for coherent dedispersion.
+
+    Parameters
+    ----------
+    dm : `~astropy.units.Quantity`
+        Dispersion measure.
+    fcoh : `~astropy.units.Quantity`
+        Frequencies of the fine channels (an array, with the first axis
+        used for chunking).
+    fref : `~astropy.units.Quantity`
+        Frequency relative to which the dispersion is corrected; should
+        broadcast against fcoh (e.g., the channel frequencies for
+        dedispersion by channel).
+    chunksize : int
+        Approximate number of elements to calculate at a time.
+
+    Returns
+    -------
+    dd_coh : array of complex64
+        Phase factors, with the broadcast shape of fcoh and fref.
+    """
+    # phase in cycles is dispersion_delay_constant * dm * f * (1/fref-1/f)**2
+    factor = 2. * np.pi * (dispersion_delay_constant * dm /
+                           u.MHz).to(u.dimensionless_unscaled).value
+    f = fcoh.to(u.MHz).value
+    fref = fref.to(u.MHz).value
+    shape = np.broadcast(f, fref).shape
+    f = np.broadcast_to(f, shape)
+    fref = np.broadcast_to(fref, shape)
+    dd_coh = np.empty(shape, dtype=np.complex64)
+    step = max(1, chunksize * shape[0] // max(dd_coh.size, 1))
+    for i in range(0, shape[0], step):
+        sl = slice(i, i + step)
+        fc = f[sl]
+        phase = 1. / fref[sl] - 1. / fc
+        phase *= phase
+        phase *= fc
+        phase *= factor
+        # conjugate of exp(1j*phase), i.e., undo the dispersion.
+        dd_coh.real[sl] = np.cos(phase)
+        dd_coh.imag[sl] = -np.sin(phase)
+    return dd_coh
+
+
+def coherent_chirp(dm, fcoh, fref, cache_dir=None):
+    """Get the chirp for coherent dedispersion, using the cache if possible.
+
+    The result is read-only, as it may be shared between callers.
+    See `calculate_chirp` for a description of the parameters;
+    ``cache_dir`` is the directory for the on-disk cache (default:
+    ``CACHE_DIR``; an empty string disables it).
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    key = chirp_key(dm, fcoh, fref)
+    dd_coh = _chirps.pop(key, None)
+    if dd_coh is None:
+        filename = (os.path.join(cache_dir, 'chirp_{0}.npy'.format(key))
+                    if cache_dir else None)
+        if filename and os.path.exists(filename):
+            dd_coh = np.load(filename, mmap_mode='r')
+        else:
+            dd_coh = calculate_chirp(dm, fcoh, fref)
+            if filename:
+                save_chirp(filename, dd_coh)
+        dd_coh.flags.writeable = False
+        while len(_chirps) >= MAXSIZE:
+            _chirps.popitem(last=False)
+    _chirps[key] = dd_coh  # (re)insert as most recently used.
+    return dd_coh
+
+
+def save_chirp(filename, dd_coh):
+    """Save a chirp, such that other processes never see a partial file."""
+    directory = os.path.dirname(filename)
+    tmp_file = '{0}.{1}.npy'.format(filename[:-4], os.getpid())
+    try:
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # another process may have beaten us to it.
+                if not os.path.isdir(directory):
+                    raise
+        np.save(tmp_file, dd_coh)
+        os.rename(tmp_file, filename)
+    except (IOError, OSError) as exc:
+        print("Could not save chirp to {0}: {1}".format(filename, exc))
@@ -0,0 +1,81 @@
+"""Sum large arrays over MPI ranks without copying them on the root.
+
+A plain ``comm.Reduce(sendbuf, recvbuf)`` needs a receive buffer the size
+of the array on the root, next to the root's own contribution, and MPI
+implementations may allocate further temporaries of the full message
+size.  For large folded spectra, this can exhaust the memory of the root.
+`reduce_array` instead sums in pieces of at most ``chunk_size`` bytes,
+either in place in the root's own array, or into a given output array,
+which can be memory-mapped to a file (see ``accumulators``), so that the
+sum is streamed to disk.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from .parallel import LocalComm
+
+# Maximum size in bytes of the pieces reduced in one go.
+CHUNK_SIZE = 2**26
+
+
+def reduce_array(comm, array, out=None, root=0, chunk_size=CHUNK_SIZE):
+    """Sum an array over all ranks, in pieces.
+
+    Parameters
+    ----------
+    comm : MPI communicator or `~scintellometry.folding.parallel.LocalComm`
+        Ranks over which to sum (collective operation).
+    array : array
+        Contribution of this rank.  Should be C-contiguous, since it is
+        reduced in slices of its flattened version.
+    out : array or None
+        Only used on root: array in which to store the sum, e.g., one
+        memory-mapped to a file.  If None, the sum is stored in place in
+        ``array``, so that no extra memory is needed.
+    root : int
+        Rank on which the sum is needed.
+    chunk_size : int
+        Maximum number of bytes to reduce at a time.
+
+    Returns
+    -------
+    total : array or None
+        The sum on root (``out`` or ``array``); None on other ranks.
+    """
+    if not array.flags.c_contiguous:
+        raise ValueError("Can only reduce C-contiguous arrays.")
+    is_root = comm.rank == root
+    if is_root and out is not None:
+        if out.shape != array.shape or not out.flags.c_contiguous:
+            raise ValueError("Output should be C-contiguous and have the "
+                             "same shape as the array.")
+    if comm.size == 1:
+        if is_root and out is not None:
+            out[...] = array
+        return (array if out is None else out) if is_root else None
+
+    if isinstance(comm, LocalComm):
+        in_place = None  # LocalComm accepts identical send and receive.
+    else:
+        from mpi4py import MPI
+        in_place = MPI.IN_PLACE
+
+    send = array.reshape(-1)
+    recv = (send if out is None else out.reshape(-1)) if is_root else None
+    nchunk = max(chunk_size // array.dtype.itemsize, 1)
+    for start in range(0, send.size, nchunk):
+        part = send[start:start+nchunk]
+        if not is_root:
+            comm.Reduce(part, None, root=root)
+        elif out is not None:
+            comm.Reduce(part, recv[start:start+nchunk], root=root)
+        else:
+            comm.Reduce(part if in_place is None else in_place, part,
+                        root=root)
+
+    if not is_root:
+        return None
+    if isinstance(out, np.memmap):
+        out.flush()
+    return array if out is None else out
@@ -11,24 +11,24 @@ from __future__ import division, print_function
 
 from fractions import Fraction
 import numpy as np
-import os
 import astropy.units as u
 from astropy.time import Time
 import h5py
 
+from .chirp import coherent_chirp
+from ..fftengine import engine, fft, ifft
 try:
-    # do *NOT* use on-disk cache; blue gene doesn't work; slower anyway
-    # import pyfftw
-    # pyfftw.interfaces.cache.enable()
-    from pyfftw.interfaces.scipy_fftpack import (rfft, rfftfreq, irfft,
-                                                 fft, ifft, fftfreq)
-    _fftargs = {'threads': os.environ.get('OMP_NUM_THREADS', 2),
-                'planner_effort': 'FFTW_ESTIMATE'}
+    # the real transforms use scipy's packed order, for which we have no
+    # cached plans; with the engine's wisdom loaded, planning is quick.
+    from pyfftw.interfaces.scipy_fftpack import rfft, irfft
+    _rfftargs = {'threads': engine.threads,
+                 'planner_effort': engine.planner_effort,
+                 'overwrite_x': True}
 except(ImportError):
-    print("Consider installing pyfftw: https://github.com/hgomersall/pyFFTW")
     # use FFT from scipy, since unlike numpy it does not cast up to complex128
-    from scipy.fftpack import rfft, rfftfreq, irfft, fft, ifft, fftfreq
-    _fftargs = {}
+    from scipy.fftpack import rfft, irfft
+    _rfftargs = {'overwrite_x': True}
+from scipy.fftpack import rfftfreq, fftfreq
 
 dispersion_delay_constant = 4149. * u.s * u.MHz**2 * u.cm**3 / u.pc
 _fref = 150. * u.MHz  # ref. freq. for dispersion measure
@@ -93,10 +93,12 @@ def correlate(fh1, fh2, dm, nchan, ngate, ntbin, nt, ntw,
             fh.thisfft = fft
             fh.thisifft = ifft
             fh.thisfftfreq = fftfreq
+            fh.fftargs = {}
         else:
             fh.thisfft = rfft
             fh.thisifft = irfft
             fh.thisfftfreq = rfftfreq
+            fh.fftargs = _rfftargs
 
         # pre-calculate time delay due to dispersion in coarse channels
         # LOFAR data is already channelized
@@ -151,18 +153,13 @@ def correlate(fh1, fh2, dm, nchan, ngate, ntbin, nt, ntw,
                 _fref = np.repeat(fh.freq.value, fh.ntint(nchan))*fh.freq.unit
             # (check via eq. 5.21 and following in
             # Lorimer & Kramer, Handbook of Pulsar Astrono
-            dang = (dispersion_delay_constant * dm * fcoh *
-                    (1./_fref-1./fcoh)**2) * 360. * u.deg
+            fh.dd_coh = coherent_chirp(dm, fcoh, _fref)
 
             if fh.thisfftfreq is rfftfreq:
                 # order of frequencies is r[0], r[1],i[1],...r[n-1],i[n-1],r[n]
                 # for 0 and n need only real part, but for 1...n-1 need real, imag
                 # so just get shifts for r[1], r[2], ..., r[n-1]
-                dang = dang.to(u.rad).value[1:-1:2]
-            else:
-                dang = dang.to(u.rad).value
-
-            fh.dd_coh = np.exp(dang * 1j).conj().astype(np.complex64)
+                fh.dd_coh = fh.dd_coh[1:-1:2]
     #### done fh setup ###
 
     ## xcorr setup
@@ -259,21 +256,19 @@ def correlate(fh1, fh2, dm, nchan, ngate, ntbin, nt, ntw,
                 vals[i] = raws[i]
 
             if dedisperse in ['coherent', 'by-channel']:
-                fine = fh.thisfft(vals[i], axis=0, overwrite_x=True,
-                                  **_fftargs)
+                fine = fh.thisfft(vals[i], axis=0, **fh.fftargs)
                 if fh.thisfft is rfft:
                     fine_cmplx = fine[1:-1].view(np.complex64)
                     # overwrites parts of fine, as intended
                     fine_cmplx *= fh.dd_coh
                 else:
                     fine *= dd_coh
-                vals[i] = fh.thisifft(fine, axis=0, overwrite_x=True,
-                                      **_fftargs)
+                vals[i] = fh.thisifft(fine, axis=0, **fh.fftargs)
 
             if fh.nchan == 1:
                 # ARO data should fall here
                 chans[i] = fh.thisfft(vals[i].reshape(-1, nchan * 2), axis=-1,
-                                      overwrite_x=True, **_fftargs)
+                                      **fh.fftargs)
             else:  # lofar and gmrt-phased are already channelised
                 chans[i] = vals[i]
 
@@ -1,35 +1,26 @@
 from __future__ import division, print_function
 
+import os
 from inspect import getargspec
 import numpy as np
-import os
 import astropy.units as u
 
-
-try:
-    # do *NOT* use on-disk cache; blue gene doesn't work; slower anyway
-    # import pyfftw
-    # pyfftw.interfaces.cache.enable()
-    from pyfftw.interfaces.numpy_fft import (rfft, irfft,
-                                             fft, ifft, fftfreq)
-    from numpy.fft import rfftfreq  # Missing from pyfftw for some reason.
-    # By default, scipy_fftpack just uses scipy.rfftfreq, but this is
-    # inconsistent with the order actually in the arrays, which is that
-    # also used by numpy.
-    _fftargs = {'threads': int(os.environ.get('OMP_NUM_THREADS', 2)),
-                'planner_effort': 'FFTW_ESTIMATE',
-                'overwrite_input': True}
-    _rfftargs = _fftargs
-except(ImportError):
-    print("Consider installing pyfftw: https://github.com/hgomersall/pyFFTW")
-    # Use complex FFT from scipy, since unlike numpy it does not cast up to
-    # complex128.  However, use rfft from numpy, since the scipy data order
-    # is too tricky to use.
-    from scipy.fftpack import fft, ifft, fftfreq
-    from numpy.fft import rfft, irfft, rfftfreq
-
-    _fftargs = {'overwrite_x': True}
-    _rfftargs = {}
+from .accumulators import accumulator, flush
+from .channelized import ChannelizedWriter
+from .checkpoint import (checkpoint_name, save_checkpoint,
+                         restore_checkpoint, output_arrays)
+from .chirp import coherent_chirp
+from .kernels import (fold_power, waterfall_power, add_waterfall,
+                      PowerBuffers)
+from .overlap import (dispersion_overlap, overlap_fft_length,
+                      overlap_segments)
+from .phases import InterpolatedPhase
+from .pipeline import pipeline
+from .schedule import (static_range, dynamic_blocks, shared_counter,
+                       check_coverage, CHUNKS_PER_RANK)
+from .search import WaterfallStream
+from ..fftengine import fft, ifft, rfft, irfft
+from numpy.fft import fftfreq, rfftfreq
 
 dispersion_delay_constant = 4149. * u.s * u.MHz**2 * u.cm**3 / u.pc
 
@@ -39,7 +30,13 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
          dedisperse='incoherent',
          do_waterfall=True, do_foldspec=True, verbose=True,
          progress_interval=100, rfi_filter_raw=None, rfi_filter_power=None,
-         return_fits=False):
+         fits_output=None, skip_blocks=None, channelized_output=None,
+         nworkers=0, nqueue=None, targets=None, checkpoint=None,
+         checkpoint_interval=10, phase_tolerance=None,
+         cross_products=True, search_output=None, search_nbits=32,
+         accumulator_dir=None, waterfall_dtype=np.float64,
+         overlap_save=False, fft_length=None, schedule='static',
+         chunk_blocks=None, rfi_excision=None):
     """
     FFT data, fold by phase/time and make a waterfall series
 
@@ -48,9 +45,11 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
     Parameters
     ----------
     fh : file handle
-        handle to file holding voltage timeseries
+        handle to file holding voltage timeseries, or a ChannelizedArchive
+        holding power spectra written by an earlier call to fold
     comm: MPI communicator or None
-        will use size, rank attributes
+        will use size, rank attributes (for processes on a single machine,
+        can be a `~scintellometry.folding.parallel.LocalComm`)
     samplerate : Quantity
         rate at which samples were originally taken and thus double the
         band width (frequency units)
@@ -70,9 +69,11 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
     ntw : int
         number of time samples to combine for waterfall (does not have to be
         integer fraction of nt)
-    dm : float
+    dm : float or array
         dispersion measure of pulsar, used to correct for ism delay
-        (column number density)
+        (column number density).  If an array, the data are read and
+        channelized once, and folded for each dispersion measure, with
+        foldspec, icount and waterfall getting an extra first dimension.
     fref: float
         reference frequency for dispersion measure
     phasepol : callable
@@ -87,21 +88,123 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
         whether to give some progress information (default: True)
     progress_interval : int
         Ping every progress_interval sets
-    return_fits : bool (default: False)
-        return a subint fits table for rank == 0 (None otherwise)
+    fits_output : None or str
+        If given, file to which the folded spectra are written in PSRFITS
+        fold mode (see io.psrfits_writer.FoldWriter) by rank 0.  Subints are
+        summed over MPI ranks and written one at a time.  For multiple
+        dispersion measures, one file is written for each, with the
+        dispersion measure appended to the file name.
+    skip_blocks : None or array of bool
+        blocks (counting from the current position) not to fold, e.g.,
+        because they contain invalid data (see io.integrity.bad_blocks)
+    channelized_output : None or str
+        directory to which the power spectra should be written, so that
+        they can be folded again quickly with a ChannelizedArchive
+    nworkers : int
+        If larger than 0, read blocks in a separate thread, and channelize
+        them with this number of worker threads, while folding in the main
+        thread (default: 0, i.e., do everything in sequence).
+    nqueue : int or None
+        Maximum number of blocks being processed concurrently
+        (default: 2 * nworkers).
+    targets : None or list of (phasepol, ngate, ntbin)
+        If given, fold with each of these (e.g., for several pulsars in
+        the beam, or different ephemerides) instead of the phasepol, ngate
+        and ntbin given above, sharing the reading and channelization.
+        foldspec and icount are then returned as lists, one per target.
+    checkpoint : None or str
+        Directory in which to regularly save the accumulated results (one
+        file per MPI rank).  If a checkpoint exists already, folding is
+        resumed from it.
+    checkpoint_interval : int
+        Number of blocks after which to save a checkpoint (default: 10).
+    phase_tolerance : None, True, or float
+        If given, rather than evaluating phasepol for every sample and
+        channel, use a Taylor expansion for each block (see
+        phases.InterpolatedPhase), with at most this error (in cycles).
+        If True, the error is kept below 1% of a phase bin.
+    cross_products : bool
+        For two polarisations, whether to calculate the cross products
+        (default: True).  If False, only the power in each polarisation is
+        kept, and the last dimension of foldspec and waterfall has length 2.
+    search_output : None or str
+        If given, file to which the waterfall is written as it is
+        accumulated, rather than being returned (as None).  Files ending in
+        '.fil' are written in SIGPROC filterbank format, others in PSRFITS
+        search mode (see io.searchmode); only the total intensity is
+        stored.  For multiple dispersion measures, one file is written for
+        each.  Requires a single process and no checkpointing.
+    search_nbits : 8 or 32
+        Whether to requantize the search-mode output to 8 bits per sample,
+        or to store 32-bit floats (default).
+    accumulator_dir : None or str
+        If given, foldspec, icount and waterfall are memory-mapped to files
+        in this directory (one set per MPI rank), rather than kept in
+        memory, and are flushed to disk whenever a time bin is completed.
+        The returned arrays are memory-mapped as well.
+    waterfall_dtype : `~numpy.dtype`
+        Data type of the waterfall (default: float64; float32 halves the
+        memory or disk space needed).
+    overlap_save : bool
+        For coherent and by-channel dedispersion, whether to dedisperse
+        by overlap-save, in segments of fft_length samples that overlap by
+        the number of samples smeared by dispersion, rather than by
+        transforming whole blocks (default: False).  This avoids wrapping
+        around at block edges, with the end of each block prepended to
+        the next one.  Since the result for a sample needs later ones, the
+        output is delayed by up to the largest dispersion advance.  For
+        coherent dedispersion with ``fedge_at_top``, the time order within
+        blocks is kept, whereas transforming whole blocks reverses it.
+    fft_length : None or int
+        Length of the segments for overlap-save (for coherent
+        dedispersion in samples of the input series, for by-channel in
+        samples of the input channels).  By default, the fast FFT size
+        that minimizes the work per sample is used.
+    schedule : 'static' or 'dynamic'
+        How blocks are distributed over ranks: in fixed, contiguous ranges
+        (default), or in chunks handed out to ranks as they are ready for
+        more, so that slow ranks do not hold up the others.  Blocks are
+        still folded exactly once, and a warning is given for any not
+        folded (e.g., because of an early end of file).  Cannot be used
+        with checkpoints.
+    chunk_blocks : None or int
+        Number of blocks per chunk for dynamic scheduling (default: such
+        that there are 8 chunks per rank).
+    rfi_excision : None or `~scintellometry.folding.rfi.RFIExcision`
+        If given, applied to the power of every block as it is calculated
+        from the channelized (and possibly dedispersed) voltages, zapping
+        samples flagged by spectral kurtosis or time-domain clipping, so
+        that they are excluded from foldspec and icount.  Not applied to
+        spectra read from an archive (which are stored after excision).
 
     """
     assert dedisperse in (None, 'incoherent', 'by-channel', 'coherent')
     need_fine_channels = dedisperse in ['by-channel', 'coherent']
-    assert nchan % fh.nchan == 0
-    if dedisperse in ['incoherent', 'by-channel'] and fh.nchan > 1:
-        oversample = nchan // fh.nchan
-        assert ntint % oversample == 0
+    # power spectra calculated before can be read from an archive.
+    from_archive = fh.telescope == 'channelized'
+    # several dispersion measures can be tried in a single pass.
+    multi_dm = not dm.isscalar
+    dms = dm.reshape(-1)
+    ndm = len(dms)
+    if multi_dm and need_fine_channels and channelized_output is not None:
+        raise ValueError("Cannot archive spectra coherently dedispersed "
+                         "with multiple dispersion measures.")
+    if fits_output is not None and (targets is not None or not do_foldspec):
+        raise ValueError("Can only write folded spectra to PSRFITS for "
+                         "a single target.")
+    if from_archive:
+        fh.check(nchan, ntint, dedisperse, dm, nt=nt, fref=fref)
+        oversample = fh.oversample
     else:
-        oversample = 1
+        assert nchan % fh.nchan == 0
+        if dedisperse in ['incoherent', 'by-channel'] and fh.nchan > 1:
+            oversample = nchan // fh.nchan
+            assert ntint % oversample == 0
+        else:
+            oversample = 1
 
-    if dedisperse == 'coherent' and fh.nchan > 1:
-        raise ValueError("Cannot coherently dedisperse channelized data.")
+        if dedisperse == 'coherent' and fh.nchan > 1:
+            raise ValueError("Cannot coherently dedisperse channelized data.")
 
     if comm is None:
         mpi_rank = 0
@@ -112,36 +215,76 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
 
     npol = getattr(fh, 'npol', 1)
     assert npol == 1 or npol == 2
+    # number of power and cross products
+    npow = 4 if npol == 2 and cross_products else npol
+    if from_archive and fh.header.get('npow', npol**2) != npow:
+        raise ValueError("Archive has {0} power products per channel; "
+                         "cannot fold {1}.".format(
+                             fh.header.get('npow', npol**2), npow))
     if verbose > 1 and mpi_rank == 0:
         print("Number of polarisations={}".format(npol))
 
+    if schedule not in ('static', 'dynamic'):
+        raise ValueError("Schedule should be 'static' or 'dynamic'.")
+    dynamic = schedule == 'dynamic' and mpi_size > 1
+    if dynamic and checkpoint is not None:
+        raise ValueError("Cannot resume from checkpoints if blocks are "
+                         "distributed dynamically.")
+
+    if search_output is not None:
+        if mpi_size > 1 or checkpoint is not None or not do_waterfall:
+            raise ValueError("Can only stream the waterfall to search-mode "
+                             "output from a single process, without "
+                             "checkpoints (use nworkers for more cores).")
+
     # initialize folded spectrum and waterfall
     # TODO: use estimated number of points to set dtype
+    # one can fold for multiple targets in one go.
+    fold_targets = ([(phasepol, ngate, ntbin)] if targets is None
+                    else list(targets))
     if do_foldspec:
-        foldspec = np.zeros((ntbin, nchan, ngate, npol**2), dtype=np.float32)
-        icount = np.zeros((ntbin, nchan, ngate), dtype=np.int32)
+        foldspec = [accumulator((ndm, _ntbin, nchan, _ngate, npow),
+                                np.float32, accumulator_dir,
+                                'foldspec{0}'.format(i), mpi_rank)
+                    for i, (_phasepol, _ngate, _ntbin)
+                    in enumerate(fold_targets)]
+        icount = [accumulator((ndm, _ntbin, nchan, _ngate), np.int32,
+                              accumulator_dir, 'icount{0}'.format(i),
+                              mpi_rank)
+                  for i, (_phasepol, _ngate, _ntbin)
+                  in enumerate(fold_targets)]
     else:
         foldspec = None
         icount = None
 
+    if phase_tolerance is not None:
+        # True: use the default, which depends on the number of phase bins.
+        _tolerance = None if phase_tolerance is True else phase_tolerance
+        fold_targets = [(InterpolatedPhase(_phasepol, _ngate, _tolerance),
+                         _ngate, _ntbin)
+                        for _phasepol, _ngate, _ntbin in fold_targets]
+
     if do_waterfall:
         nwsize = nt*ntint//ntw//oversample
-        waterfall = np.zeros((nwsize, nchan, npol**2), dtype=np.float64)
+        # if streamed to search-mode output, only partial rows are kept.
+        waterfall = (accumulator((ndm, nwsize, nchan, npow), waterfall_dtype,
+                                 accumulator_dir, 'waterfall', mpi_rank)
+                     if search_output is None else None)
     else:
         waterfall = None
 
     if verbose and mpi_rank == 0:
         print('Reading from {}'.format(fh))
 
-    nskip = fh.tell()/fh.blocksize
-    if nskip > 0:
+    nskip = fh.nskip if from_archive else fh.tell()/fh.blocksize
+    if nskip > 0 and not from_archive:
         if verbose and mpi_rank == 0:
             print('Starting {0} blocks = {1} bytes out from start.'
                   .format(nskip, nskip*fh.blocksize))
 
     dt1 = (1./samplerate).to(u.s)
     # need 2*nchan real-valued samples for each FFT
-    if fh.telescope == 'lofar':
+    if fh.telescope in ('lofar', 'channelized'):
         dtsample = fh.dtsample
     else:
         dtsample = nchan // oversample * 2 * dt1
@@ -151,7 +294,11 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
     # for channelized data, frequencies are known
 
     tb = -1. if fedge_at_top else +1.
-    if fh.nchan == 1:
+    if from_archive:
+        freq = fh.freq
+        freq_in = fh.freq_in
+
+    elif fh.nchan == 1:
         if getattr(fh, 'data_is_complex', False):
             # for complex data, really each complex sample consists of
             # 2 real ones, so multiply dt1 by 2.
@@ -186,9 +333,15 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
     ifreq = freq[:nchan].ravel().argsort()
 
     # pre-calculate time offsets in (input) channelized streams
-    dt = dispersion_delay_constant * dm * (1./freq_in**2 - 1./fref**2)
-
-    if need_fine_channels:
+    dt = (dispersion_delay_constant * dms[:, np.newaxis] *
+          (1./freq_in**2 - 1./fref**2))
+    # Within the loop over blocks, all times are plain floats in seconds,
+    # since operations with Quantity arrays are relatively slow.
+    dt_s = dt.to(u.s).value
+    dtsample_s = dtsample.to(u.s).value
+    tstart_s = tstart.to(u.s).value
+
+    if need_fine_channels and not from_archive:
         # pre-calculate required turns due to dispersion.
         #
         # set frequency relative to which dispersion is coherently corrected
@@ -198,49 +351,91 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
             _fref = freq_in[np.newaxis, :]
         # (check via eq. 5.21 and following in
         # Lorimer & Kramer, Handbook of Pulsar Astronomy
-        dang = (dispersion_delay_constant * dm * fcoh *
-                (1./_fref-1./fcoh)**2) * u.cycle
-        with u.set_enabled_equivalencies(u.dimensionless_angles()):
-            dd_coh = np.exp(dang * 1j).conj().astype(np.complex64)
-
         # add dimension for polarisation
-        dd_coh = dd_coh[..., np.newaxis]
-
-    # Calculate the part of the whole file this node should handle.
-    size_per_node = (nt-1)//mpi_size + 1
-    start_block = mpi_rank*size_per_node
-    end_block = min((mpi_rank+1)*size_per_node, nt)
-    for j in range(start_block, end_block):
-        if verbose and j % progress_interval == 0:
-            print('#{:4d}/{:4d} is doing {:6d}/{:6d} [={:6d}/{:6d}]; '
-                  'time={:18.12f}'
-                  .format(mpi_rank, mpi_size, j+1, nt,
-                          j-start_block+1, end_block-start_block,
-                          (tstart+dtsample*j*ntint).value))  # time since start
-
-        # Just in case numbers were set wrong -- break if file ends;
-        # better keep at least the work done.
-        try:
-            raw = fh.seek_record_read(int((nskip+j)*fh.blocksize),
-                                      fh.blocksize)
-        except(EOFError, IOError) as exc:
-            print("Hit {0!r}; writing data collected.".format(exc))
-            break
-        if verbose >= 2:
-            print("#{:4d}/{:4d} read {} items"
-                  .format(mpi_rank, mpi_size, raw.size), end="")
+        dd_coh = [coherent_chirp(_dm, fcoh, _fref)[..., np.newaxis]
+                  for _dm in dms]
+
+    # number of output samples by which the dedispersed data are delayed.
+    nshift = fh.header.get('nshift', 0) if from_archive else 0
+    overlap_save = overlap_save and need_fine_channels and not from_archive
+    if overlap_save:
+        complex_data = getattr(fh, 'data_is_complex', False)
+        nfine_chan = nchan if complex_data else 2 * nchan
+        # get samples along the axis being dedispersed, and the number of
+        # those per output sample and per row of raw data.
+        if dedisperse == 'coherent':
+            dt_fine = 2.*dt1 if complex_data else dt1
+            nper, nrow = nfine_chan, 1
+        else:
+            dt_fine = dtsample
+            nper, nrow = oversample, nfine_chan if fh.nchan == 1 else 1
+        nlag, nlead = dispersion_overlap(dms, fcoh, _fref, dt_fine)
+        # Ensure output samples do not straddle the start of the block.
+        nlead = -(-nlead // nper) * nper
+        nshift = nlead // nper
+        noverlap = nlag + nlead
+        nblock_fine = ntint * nper if dedisperse == 'coherent' else ntint
+        if noverlap > nblock_fine:
+            raise ValueError("Overlap of {0} samples needed for overlap-save "
+                             "is longer than a block; use larger blocks."
+                             .format(noverlap))
+        if fft_length is None:
+            fft_length = overlap_fft_length(noverlap, nblock_fine + noverlap)
+        elif fft_length <= noverlap:
+            raise ValueError("FFT length should be larger than the overlap "
+                             "of {0} samples.".format(noverlap))
+        # Chirps for the segments rather than the whole block.
+        if dedisperse == 'coherent':
+            fcoh = fedge + tb * (fftfreq(fft_length, 2.*dt1) if complex_data
+                                 else rfftfreq(fft_length, dt1))
+            fcoh.shape = (-1, 1)
+        else:
+            fcoh = ((freq if fh.nchan == 1 else freq_in) +
+                    tb * fftfreq(fft_length, dtsample)[:, np.newaxis])
+        dd_coh = [coherent_chirp(_dm, fcoh, _fref)[..., np.newaxis]
+                  for _dm in dms]
+        if dedisperse == 'coherent' and fedge_at_top:
+            # Rather than conjugating the spectrum, which reverses the time
+            # order, conjugate the chirp (and complex output, see from_fine).
+            dd_coh = [_dd_coh.conj() for _dd_coh in dd_coh]
+        if verbose and mpi_rank == 0:
+            print("Overlap-save with FFT length {0} and overlap {1}+{2}"
+                  .format(fft_length, nlag, nlead))
 
+    def as_samples(raw):
+        """Reshape raw data to have time along the first axis."""
         if npol == 2 and raw.dtype.fields is not None:
             raw = raw.view(raw.dtype.fields.values()[0][0])
 
         if fh.nchan == 1:  # raw.shape=(ntint*npol)
-            raw = raw.reshape(-1, npol)
+            return raw.reshape(-1, npol)
         else:              # raw.shape=(ntint, nchan*npol)
-            raw = raw.reshape(-1, fh.nchan, npol)
+            return raw.reshape(-1, fh.nchan, npol)
+
+    def channelize(raw, previous=None):
+        """Channelize and possibly dedisperse raw data.
+
+        For overlap-save, previous holds the raw data of the preceding
+        block, or None if these are not available.
+
+        Returns a list with the power for each dispersion measure, or,
+        if the power is not coherently dedispersed, a single power that
+        applies to all.
+        """
+        raw = as_samples(raw)
+        if overlap_save:
+            ntail = noverlap * nrow
+            if previous is None:
+                tail = np.zeros((ntail,) + raw.shape[1:], raw.dtype)
+            else:
+                previous = as_samples(previous)
+                # (not [-ntail:], which gives everything for ntail=0)
+                tail = previous[len(previous)-ntail:]
+            raw = np.concatenate([tail, raw])
 
         if dedisperse == 'incoherent' and oversample > 1:
-            raw = ifft(raw, axis=1, **_fftargs).reshape(-1, nchan, npol)
-            raw = fft(raw, axis=1, **_fftargs)
+            raw = ifft(raw, axis=1).reshape(-1, nchan, npol)
+            raw = fft(raw, axis=1)
 
         if rfi_filter_raw is not None:
             raw, ok = rfi_filter_raw(raw)
@@ -258,152 +453,399 @@ def fold(fh, comm, samplerate, fedge, fedge_at_top, nchan,
         # and should have shape (ntint, nchan, npol).
         # For baseband data, we wish to get to the same shape for
         # incoherent or by_channel, or just to fully channelized for coherent.
-        if fh.nchan == 1:
+        if fh.nchan == 1 and not (overlap_save and dedisperse == 'coherent'):
             # If we need coherent dedispersion, do FT of whole thing,
             # otherwise to output channels, mimicking pre-channelized data.
             if raw.dtype.kind == 'c':  # complex data
                 nsamp = len(vals) if dedisperse == 'coherent' else nchan
-                vals = fft(vals.reshape(-1, nsamp, npol), axis=1,
-                           **_fftargs)
+                vals = fft(vals.reshape(-1, nsamp, npol), axis=1)
             else:  # real data
                 nsamp = len(vals) if dedisperse == 'coherent' else nchan * 2
-                vals = rfft(vals.reshape(-1, nsamp, npol), axis=1,
-                            **_rfftargs)
+                vals = rfft(vals.reshape(-1, nsamp, npol), axis=1)
                 # Sadly, the way data are stored depends on what FFT routine
                 # one is using.  We cannot deal with scipy's.
                 if vals.dtype.kind == 'f':
                     raise TypeError("Can no longer deal with scipy's format "
                                     "for storing FTs of real data.")
 
-        if fedge_at_top:
+        if fedge_at_top and not (overlap_save and dedisperse == 'coherent'):
             # take complex conjugate to ensure by-channel de-dispersion is
             # applied correctly.
             # This needs to be done for ARO data, since we are in 2nd Nyquist
             # zone; not clear it is needed for other telescopes.
             np.conj(vals, out=vals)
 
-        # Now we coherently dedisperse, either all of it or by channel.
-        if need_fine_channels:
-            # for by_channel, we have vals.shape=(ntint, nchan, npol),
-            # and want to FT over ntint to get fine channels;
-            if vals.shape[0] > 1:
-                fine = fft(vals, axis=0, **_fftargs)
-            else:
-                # for coherent, we just reshape:
-                # (1, ntint*nchan, npol) -> (ntint*nchan, 1, npol)
-                fine = vals.reshape(-1, 1, npol)
+        if not need_fine_channels:
+            return [detect(vals)]
 
-            # Dedisperse.
-            fine *= dd_coh
-
-            # Still have fine.shape=(ntint, nchan, npol),
-            # w/ nchan=1 for coherent.
-            if fine.shape[1] > 1 or raw.dtype.kind == 'c':
-                vals = ifft(fine, axis=0, **_fftargs)
+        # Now we coherently dedisperse, either all of it or by channel.
+        # for by_channel, we have vals.shape=(ntint, nchan, npol),
+        # and want to FT over ntint to get fine channels;
+        nout = None
+        if overlap_save:
+            # FT overlapping segments instead, getting
+            # fine.shape=(nseg, fft_length, nchan, npol), w/ nchan=1 for
+            # coherent, for which vals is still the time series.
+            if vals.ndim == 2:
+                vals = vals[:, np.newaxis]
+            nout = len(vals) - noverlap
+            segments = overlap_segments(vals, fft_length, noverlap)
+            if segments.dtype.kind == 'c':
+                fine = fft(segments, axis=1)
             else:
-                vals = irfft(fine, axis=0, **_rfftargs)
-
-            if fine.shape[1] == 1 and nchan > 1:
-                # final FT to get requested channels
-                if vals.dtype.kind == 'f':
-                    vals = vals.reshape(-1, nchan*2, npol)
-                    vals = rfft(vals, axis=1, **_rfftargs)
-                else:
-                    vals = vals.reshape(-1, nchan, npol)
-                    vals = fft(vals, axis=1, **_fftargs)
-            elif dedisperse == 'by-channel' and oversample > 1:
-                vals = vals.reshape(-1, oversample, fh.nchan, npol)
-                vals = fft(vals, axis=1, **_fftargs)
-                vals = vals.transpose(0, 2, 1, 3).reshape(-1, nchan, npol)
-
-            # vals[time, chan, pol]
+                fine = rfft(segments, axis=1)
+        elif vals.shape[0] > 1:
+            fine = fft(vals, axis=0)
+        else:
+            # for coherent, we just reshape:
+            # (1, ntint*nchan, npol) -> (ntint*nchan, 1, npol)
+            fine = vals.reshape(-1, 1, npol)
+
+        powers = []
+        for idm, _dd_coh in enumerate(dd_coh):
+            # Dedisperse (in-place for the last, or only, trial).
+            dd_fine = fine if idm == ndm - 1 else fine.copy()
+            dd_fine *= _dd_coh
+            powers.append(detect(from_fine(dd_fine, raw.dtype.kind == 'c',
+                                           nout)))
             if verbose >= 2:
                 print("... dedispersed", end="")
 
-        if npol == 1:
-            power = vals.real**2 + vals.imag**2
+        return powers
+
+    def from_fine(fine, complex_data, nout=None):
+        """Transform dedispersed fine channels back to output channels.
+
+        For overlap-save, only the valid part of each segment is kept,
+        up to a total of nout samples.
+        """
+        # Still have fine.shape=(ntint, nchan, npol),
+        # w/ nchan=1 for coherent (with a leading segment axis for
+        # overlap-save).
+        axis = 1 if overlap_save else 0
+        if fine.shape[-2] > 1 or complex_data:
+            vals = ifft(fine, axis=axis)
+        elif overlap_save:
+            vals = irfft(fine, n=fft_length, axis=axis)
         else:
-            p0 = vals[..., 0]
-            p1 = vals[..., 1]
-            power = np.empty(vals.shape[:-1] + (4,), np.float32)
-            power[..., 0] = p0.real**2 + p0.imag**2
-            power[..., 1] = p0.real*p1.real + p0.imag*p1.imag
-            power[..., 2] = p0.imag*p1.real - p0.real*p1.imag
-            power[..., 3] = p1.real**2 + p1.imag**2
+            vals = irfft(fine, axis=axis)
+
+        if overlap_save:
+            vals = vals[:, nlag:fft_length-nlead]
+            vals = vals.reshape((-1,) + vals.shape[2:])[:nout]
+            if (dedisperse == 'coherent' and fedge_at_top and
+                    vals.dtype.kind == 'c'):
+                np.conj(vals, out=vals)
+
+        if vals.shape[1] == 1 and nchan > 1:
+            # final FT to get requested channels
+            if vals.dtype.kind == 'f':
+                vals = vals.reshape(-1, nchan*2, npol)
+                vals = rfft(vals, axis=1)
+            else:
+                vals = vals.reshape(-1, nchan, npol)
+                vals = fft(vals, axis=1)
+        elif dedisperse == 'by-channel' and oversample > 1:
+            vals = vals.reshape(-1, oversample, fh.nchan, npol)
+            vals = fft(vals, axis=1)
+            vals = vals.transpose(0, 2, 1, 3).reshape(-1, nchan, npol)
+
+        # vals[time, chan, pol]
+        return vals
+
+    if rfi_excision is not None and not from_archive:
+        # the zero and Nyquist channels of a real-valued transform have
+        # real-valued voltages.
+        real_channels = ((0, nchan) if fh.nchan == 1 and
+                         not getattr(fh, 'data_is_complex', False) else ())
+
+    # output arrays are returned to buffers once a block has been folded.
+    buffers = PowerBuffers()
+
+    def detect(vals):
+        """Calculate power (and cross-products for two polarisations)."""
+        power = buffers.power_products(vals, cross=cross_products)
 
         if verbose >= 2:
             print("... power", end="")
 
+        if rfi_excision is not None:
+            power, ok = rfi_excision(power, real_channels)
+            if verbose >= 2:
+                print("... RFI excision (zap {0}/{1})"
+                      .format(np.count_nonzero(~ok), ok.size), end="")
+
+        return power
+
+    if fits_output is not None or search_output is not None:
+        primary = {} if from_archive else fh['PRIMARY'].header
+        time0 = getattr(fh, 'time0', None)
+        start_time = None if time0 is None else time0 + tstart
+
+    if search_output is not None:
+        # imported here, since importing io requires all readers'
+        # dependencies.
+        from ..io.searchmode import search_writer
+        stream = WaterfallStream([
+            search_writer(output_name(search_output, _dm, multi_dm),
+                          freq=freq[:nchan].ravel()[ifreq],
+                          tsamp=ntw*oversample*dtsample,
+                          start_time=start_time, nbits=search_nbits,
+                          dm=_dm if dedisperse is not None else None,
+                          primary_header=primary)
+            for _dm in dms], nwsize)
+    else:
+        stream = None
+
+    if channelized_output is not None:
+        archive = ChannelizedWriter(
+            channelized_output, comm=comm, header=dict(
+                nchan=nchan, npol=npol, npow=npow, oversample=oversample,
+                ntint=ntint, nt=nt, nskip=nskip, dtsample=dtsample,
+                tstart=tstart, freq=freq, freq_in=freq_in,
+                dedisperse=dedisperse, dm=dm, fref=fref, nshift=nshift))
+
+    # Calculate the part of the whole file this node should handle.
+    if dynamic:
+        # hand out chunks on demand; any rank can get any block.
+        if chunk_blocks is None:
+            chunk_blocks = max(1, nt // (CHUNKS_PER_RANK * mpi_size))
+        counter = shared_counter(comm)
+        folded = np.zeros(nt, dtype=np.int32)
+        start_block, end_block = 0, nt
+    else:
+        start_block, end_block = static_range(nt, mpi_rank, mpi_size)
+
+    # If we are resuming, continue after the last block saved.
+    first_block = start_block
+    if checkpoint is not None:
+        checkpoint_file = checkpoint_name(checkpoint, mpi_rank)
+        checkpoint_info = dict(start_block=start_block, end_block=end_block,
+                               nt=nt, ntint=ntint, nchan=nchan, npol=npol,
+                               multi_dm=multi_dm,
+                               single_target=targets is None)
+        last_block = restore_checkpoint(checkpoint_file, foldspec, icount,
+                                        waterfall, **checkpoint_info)
+        if last_block is not None:
+            first_block = last_block + 1
+            if verbose:
+                print('#{:4d}/{:4d} resuming from checkpoint at block {:6d}'
+                      .format(mpi_rank, mpi_size, first_block))
+
+    def save(block):
+        """Checkpoint all results up to and including block."""
+        if channelized_output is not None:
+            archive.flush()
+        save_checkpoint(checkpoint_file, block, foldspec, icount, waterfall,
+                        **checkpoint_info)
+
+    def blocks():
+        """Yield block numbers and data to process, up to the end of file.
+
+        For an archive, the data are power spectra, otherwise raw data
+        (for overlap-save, together with the raw data of the previous
+        block, or None if these are not available).
+        """
+        previous = previous_block = None
+        for j in (dynamic_blocks(counter, nt, chunk_blocks) if dynamic
+                  else range(first_block, end_block)):
+            if verbose and j % progress_interval == 0:
+                print('#{:4d}/{:4d} is doing {:6d}/{:6d} [={:6d}/{:6d}]; '
+                      'time={:18.12f}'
+                      .format(mpi_rank, mpi_size, j+1, nt,
+                              j-start_block+1, end_block-start_block,
+                              tstart_s+dtsample_s*j*ntint))
+
+            if skip_blocks is not None and skip_blocks[j]:
+                if verbose >= 2:
+                    print("#{:4d}/{:4d} skipping bad block {}"
+                          .format(mpi_rank, mpi_size, j))
+                continue
+
+            if from_archive:
+                try:
+                    power = fh.read_power(j)
+                except EOFError:
+                    # e.g., skipped when the archive was written.
+                    if verbose >= 2:
+                        print("#{:4d}/{:4d} block {} not in archive"
+                              .format(mpi_rank, mpi_size, j))
+                    continue
+                yield j, power
+            else:
+                # Just in case numbers were set wrong -- stop if file ends;
+                # better keep at least the work done.
+                try:
+                    raw = fh.seek_record_read(int((nskip+j)*fh.blocksize),
+                                              fh.blocksize)
+                except(EOFError, IOError) as exc:
+                    print("Hit {0!r}; writing data collected.".format(exc))
+                    return
+                if verbose >= 2:
+                    print("#{:4d}/{:4d} read {} items"
+                          .format(mpi_rank, mpi_size, raw.size), end="")
+                if overlap_save:
+                    if previous_block is None or j != previous_block + 1:
+                        # get the end of the preceding block, if it is
+                        # to be folded, but was not read by us.
+                        previous = None
+                        if j > 0 and not (skip_blocks is not None and
+                                          skip_blocks[j-1]):
+                            previous = fh.seek_record_read(
+                                int((nskip+j-1)*fh.blocksize), fh.blocksize)
+                    yield j, (raw, previous)
+                    previous, previous_block = raw, j
+                else:
+                    yield j, raw
+
+    if from_archive:
+        process = lambda power: [power]
+    elif overlap_save:
+        process = lambda data: channelize(*data)
+    else:
+        process = channelize
+    if nworkers > 0:
+        # read, channelize and fold concurrently; since blocks are returned
+        # in order, results are identical to those of the serial loop.
+        processed = pipeline(blocks(), process, nworkers, nqueue)
+    else:
+        processed = ((j, process(data)) for j, data in blocks())
+
+    last_saved = last_block = first_block - 1
+    last_tbin = None
+    for j, powers in processed:
+        if accumulator_dir is not None:
+            # write out completed time bins, so their memory can be freed.
+            tbin = (j*ntbin) // nt
+            if last_tbin is not None and tbin != last_tbin:
+                flush(foldspec, icount, waterfall)
+            last_tbin = tbin
+
+        if channelized_output is not None:
+            archive.write(j, powers[0])
+
         # current sample positions and corresponding time in stream
-        isr = j*(ntint // oversample) + np.arange(ntint // oversample)
-        tsr = (isr*dtsample*oversample)[:, np.newaxis]
+        # (corrected for any delay due to overlap-save dedispersion).
+        isr = (j*(ntint // oversample) - nshift +
+               np.arange(ntint // oversample))
+        tsr = (isr*dtsample_s*oversample)[:, np.newaxis]
 
+        detected = powers
         if rfi_filter_power is not None:
-            power = rfi_filter_power(power, tsr.squeeze())
+            powers = [rfi_filter_power(power, tsr.squeeze() * u.s)
+                      for power in powers]
             print("... power RFI", end="")
 
-        # correct for delay if needed
-        if dedisperse in ['incoherent', 'by-channel']:
-            # tsample.shape=(ntint/oversample, nchan_in)
-            tsr = tsr - dt
-
-        if do_waterfall:
-            # # loop over corresponding positions in waterfall
-            # for iw in range(isr[0]//ntw, isr[-1]//ntw + 1):
-            #     if iw < nwsize:  # add sum of corresponding samples
-            #         waterfall[iw, :] += np.sum(power[isr//ntw == iw],
-            #                                    axis=0)[ifreq]
-            iw = np.round((tsr / dtsample / oversample).to(1)
-                          .value / ntw).astype(int)
-            for k, kfreq in enumerate(ifreq):  # sort in frequency while at it
-                iwk = iw[:, (0 if iw.shape[1] == 1 else kfreq // oversample)]
-                iwk = np.clip(iwk, 0, nwsize-1, out=iwk)
-                iwkmin = iwk.min()
-                iwkmax = iwk.max()+1
-                for ipow in range(npol**2):
-                    waterfall[iwkmin:iwkmax, k, ipow] += np.bincount(
-                        iwk-iwkmin, power[:, kfreq, ipow], iwkmax-iwkmin)
-            if verbose >= 2:
-                print("... waterfall", end="")
-
-        if do_foldspec:
-            ibin = (j*ntbin) // nt  # bin in the time series: 0..ntbin-1
-
-            # times and cycles since start time of observation.
-            tsample = tstart + tsr
-            phase = (phasepol(tsample.to(u.s).value.ravel())
-                     .reshape(tsample.shape))
-            # corresponding PSR phases
-            iphase = np.remainder(phase*ngate, ngate).astype(np.int)
-
-            for k, kfreq in enumerate(ifreq):  # sort in frequency while at it
-                iph = iphase[:, (0 if iphase.shape[1] == 1
-                                 else kfreq // oversample)]
-                # sum and count samples by phase bin
-                for ipow in range(npol**2):
-                    foldspec[ibin, k, :, ipow] += np.bincount(
-                        iph, power[:, kfreq, ipow], ngate)
-                icount[ibin, k, :] += np.bincount(
-                    iph, power[:, kfreq, 0] != 0., ngate).astype(np.int32)
+        for idm in range(ndm):
+            # unless dedispersed coherently, power is the same for all DMs.
+            power = powers[idm] if len(powers) > 1 else powers[0]
 
-            if verbose >= 2:
-                print("... folded", end="")
+            # correct for delay if needed
+            if dedisperse in ['incoherent', 'by-channel']:
+                # tsample.shape=(ntint/oversample, nchan_in)
+                delay = dt_s[idm]
+                tsr_dm = tsr - delay
+            else:
+                delay = np.zeros(1)
+                tsr_dm = tsr
+
+            if do_waterfall:
+                # # loop over corresponding positions in waterfall
+                # for iw in range(isr[0]//ntw, isr[-1]//ntw + 1):
+                #     if iw < nwsize:  # add sum of corresponding samples
+                #         waterfall[iw, :] += np.sum(power[isr//ntw == iw],
+                #                                    axis=0)[ifreq]
+                iw = np.round((tsr_dm / dtsample_s / oversample) /
+                              ntw).astype(int)
+                # sum samples by waterfall bin, sorting in frequency
+                iwmin, wf_sum = waterfall_power(power, iw, nwsize, ifreq,
+                                                oversample)
+                if stream is None:
+                    add_waterfall(waterfall[idm], iwmin, wf_sum)
+                else:
+                    stream.add(idm, iwmin, wf_sum)
+                if verbose >= 2:
+                    print("... waterfall", end="")
+
+            if do_foldspec:
+                # times since start time of observation.
+                tsample = tstart_s + tsr_dm
+                for itarget, (_phasepol, _ngate, _ntbin) in enumerate(
+                        fold_targets):
+                    # bin in the time series: 0.._ntbin-1
+                    ibin = (j*_ntbin) // nt
+
+                    # cycles since start time of observation.
+                    if phase_tolerance is None:
+                        phase = (_phasepol(tsample.ravel())
+                                 .reshape(tsample.shape))
+                    else:
+                        phase = _phasepol.offset_phases(
+                            tstart_s + tsr[:, 0], delay)
+                    # corresponding PSR phases
+                    iphase = np.remainder(phase*_ngate,
+                                          _ngate).astype(np.int)
+
+                    # sum and count samples by phase bin, sorting in freq.
+                    fold_sum, fold_count = fold_power(power, iphase, _ngate,
+                                                      ifreq, oversample)
+                    foldspec[itarget][idm, ibin] += fold_sum
+                    icount[itarget][idm, ibin] += fold_count.astype(np.int32)
+
+                if verbose >= 2:
+                    print("... folded", end="")
+
+        if stream is not None:
+            # write waterfall rows no later block can contribute to.
+            stream.flush()
+
+        if not from_archive:
+            buffers.release(detected)
 
         if verbose >= 2:
             print("... done")
 
+        last_block = j
+        if dynamic:
+            folded[j] += 1
+        if checkpoint is not None and j - last_saved >= checkpoint_interval:
+            save(j)
+            last_saved = j
+
+    if checkpoint is not None and last_block != last_saved:
+        save(last_block)
+
+    flush(foldspec, icount, waterfall)
+
+    if dynamic:
+        counter.free()
+        check_coverage(comm, folded, skip_blocks, verbose)
+
+    if channelized_output is not None:
+        archive.close()
+
+    if stream is not None:
+        stream.close()
+
+    if fits_output is not None:
+        tsubint = nt * ntint * dtsample / ntbin
+        period = tsubint / (phasepol(tstart_s + tsubint.to(u.s).value) -
+                            phasepol(tstart_s))
+        for idm in range(ndm):
+            save_fits(output_name(fits_output, dms[idm], multi_dm),
+                      foldspec[0][idm], icount[0][idm], comm,
+                      freq=freq[:nchan].ravel()[ifreq], tsubint=tsubint,
+                      dm=dms[idm] if dedisperse is not None else None,
+                      period=period, primary_header=primary,
+                      start_time=start_time)
+
     #Commented out as workaround, this was causing "Referenced before assignment" errors with JB data
     #if verbose >= 2 or verbose and mpi_rank == 0:
     #    print('#{:4d}/{:4d} read {:6d} out of {:6d}'
     #          .format(mpi_rank, mpi_size, j+1, nt))
 
-    if npol == 1:
-        if do_foldspec:
-            foldspec = foldspec.reshape(foldspec.shape[:-1])
-        if do_waterfall:
-            waterfall = waterfall.reshape(waterfall.shape[:-1])
-
-    return foldspec, icount, waterfall
+    return output_arrays(foldspec, icount, waterfall, multi_dm, npol,
+                         single_target=targets is None)
 
 
 class Folder(dict):
@@ -461,80 +903,62 @@ def normalize_counts(q, count=None):
                    np.sum(nonzero, -1, keepdims=True), 0.)
     return qn
 
-# if return_fits and mpi_rank == 0:
-#     # subintu HDU
-#     # update table columns
-#     # TODO: allow multiple polarizations
-#     npol = 1
-#     newcols = []
-#     # FITS table creation difficulties...
-#     # assign data *after* 'new_table' creation
-#     array2assign = {}
-#     tsubint = ntint*dtsample
-#     for col in fh['subint'].columns:
-#         attrs = col.copy().__dict__
-#         # remove non-init args
-#         for nn in ['_pseudo_unsigned_ints', '_dims', '_physical_values',
-#                    'dtype', '_phantom', 'array']:
-#             attrs.pop(nn, None)
-
-#         if col.name == 'TSUBINT':
-#             array2assign[col.name] = np.array(tsubint)
-#         elif col.name == 'OFFS_SUB':
-#             array2assign[col.name] = np.arange(ntbin) * tsubint
-#         elif col.name == 'DAT_FREQ':
-#             # TODO: sort from lowest freq. to highest
-#             # ('DATA') needs sorting as well
-#             array2assign[col.name] = freq.to(u.MHz).value.astype(np.double)
-#             attrs['format'] = '{0}D'.format(freq.size)
-#         elif col.name == 'DAT_WTS':
-#             array2assign[col.name] = np.ones(freq.size, dtype=np.float32)
-#             attrs['format'] = '{0}E'.format(freq.size)
-#         elif col.name == 'DAT_OFFS':
-#             array2assign[col.name] = np.zeros(freq.size*npol,
-#                                               dtype=np.float32)
-#             attrs['format'] = '{0}E'.format(freq.size*npol)
-#         elif col.name == 'DAT_SCL':
-#             array2assign[col.name] = np.ones(freq.size*npol,
-#                                              dtype=np.float32)
-#             attrs['format'] = '{0}E'.format(freq.size)
-#         elif col.name == 'DATA':
-#             array2assign[col.name] = np.zeros((ntbin, npol, freq.size,
-#                                                ngate), dtype='i1')
-#             attrs['dim'] = "({},{},{})".format(ngate, freq.size, npol)
-#             attrs['format'] = "{0}I".format(ngate*freq.size*npol)
-#         newcols.append(FITS.Column(**attrs))
-#     newcoldefs = FITS.ColDefs(newcols)
-
-#     oheader = fh['SUBINT'].header.copy()
-#     newtable = FITS.new_table(newcoldefs, nrows=ntbin, header=oheader)
-#     # update the 'subint' header and create a new one to be returned
-#     # owing to the structure of the code (MPI), we need to assign
-#     # the 'DATA' outside of fold.py
-#     newtable.header.update('NPOL', 1)
-#     newtable.header.update('NBIN', ngate)
-#     newtable.header.update('NBIN_PRD', ngate)
-#     newtable.header.update('NCHAN', freq.size)
-#     newtable.header.update('INT_UNIT', 'PHS')
-#     newtable.header.update('TBIN', tsubint.to(u.s).value)
-#     chan_bw = np.abs(np.diff(freq.to(u.MHz).value).mean())
-#     newtable.header.update('CHAN_BW', chan_bw)
-#     if dedisperse in ['coherent', 'by-channel', 'incoherent']:
-#         newtable.header.update('DM', dm.value)
-#     # finally assign the table data
-#     for name, array in array2assign.iteritems():
-#         try:
-#             newtable.data.field(name)[:] = array
-#         except ValueError:
-#             print("FITS error... work in progress",
-#                   name, array.shape, newtable.data.field(name)[:].shape)
-
-#     phdu = fh['PRIMARY'].copy()
-#     subinttable = FITS.HDUList([phdu, newtable])
-#     subinttable[1].header.update('EXTNAME', 'SUBINT')
-#     subinttable['PRIMARY'].header.update('DATE-OBS', fh.time0.isot)
-#     subinttable['PRIMARY'].header.update('STT_IMJD', int(fh.time0.mjd))
-#     subinttable['PRIMARY'].header.update(
-#         'STT_SMJD', int(str(fh.time0.mjd - int(fh.time0.mjd))[2:])*86400)
-
-# return subinttable
+
+def output_name(name, dm, multi_dm):
+    """File name for output for a given dispersion measure.
+
+    If several dispersion measures are folded, the value is appended to the
+    file name, before the extension.
+    """
+    if not multi_dm:
+        return name
+    root, ext = os.path.splitext(name)
+    return '{0}_dm{1:.4f}{2}'.format(root, dm.to(u.pc / u.cm**3).value, ext)
+
+
+def save_fits(name, foldspec, icount, comm=None, **kwargs):
+    """Write folded spectra to a PSRFITS file, one subint at a time.
+
+    Each subint is summed over all MPI ranks before it is written by rank 0,
+    so that rank 0 never needs to hold the complete folded spectrum of all
+    ranks.  This should be called by all ranks.
+
+    Parameters
+    ----------
+    name : str
+        Name of the output file.
+    foldspec : array
+        Folded power, with shape (ntbin, nchan, ngate, npow).
+    icount : array
+        Corresponding counts, with shape (ntbin, nchan, ngate).
+    comm : MPI communicator or None
+        Used to sum the subints over ranks.
+    **kwargs
+        Further arguments for `~scintellometry.io.psrfits_writer.FoldWriter`
+        (freq, dm, period, primary_header, start_time), and tsubint, the
+        duration of each subint.
+    """
+    # imported here, since importing io requires all readers' dependencies.
+    from ..io.psrfits_writer import FoldWriter
+
+    tsubint = kwargs.pop('tsubint')
+    rank = 0 if comm is None else comm.rank
+    reduce = comm is not None and comm.size > 1
+    ntbin, nchan, ngate, npow = foldspec.shape
+    writer = (FoldWriter(name, ngate=ngate, npow=npow, **kwargs)
+              if rank == 0 else None)
+    try:
+        for ibin in range(ntbin):
+            subint, count = foldspec[ibin], icount[ibin]
+            if reduce:
+                subint_sum = np.zeros_like(subint) if rank == 0 else None
+                count_sum = np.zeros_like(count) if rank == 0 else None
+                comm.Reduce(subint, subint_sum, root=0)
+                comm.Reduce(count, count_sum, root=0)
+                subint, count = subint_sum, count_sum
+            if writer is not None:
+                writer.write_subint(subint, count, tsubint,
+                                    (ibin + 0.5) * tsubint)
+    finally:
+        if writer is not None:
+            writer.close()
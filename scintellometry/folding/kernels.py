@@ -0,0 +1,248 @@
+"""Vectorized kernels used by fold to accumulate power in bins.
+
+Rather than looping over channels, each kernel builds a single flat index
+into the output for all samples in a block, and sums the power with one
+call to ``np.bincount`` per polarisation product.  Since ``bincount`` adds
+samples in order, results are identical to those of per-channel loops.
+"""
+from __future__ import division, print_function
+
+import collections
+import threading
+
+import numpy as np
+
+
+def channel_columns(nchan, ncol, oversample):
+    """Column in a (time, channel) index array to use for each channel.
+
+    Index arrays such as phases or waterfall bins have either a single
+    column (same for all channels), or one per input channel, in which case
+    output channel k uses column k // oversample.
+    """
+    if ncol == 1:
+        return np.zeros(nchan, dtype=int)
+    return np.arange(nchan) // oversample
+
+
+def fold_power(power, iphase, ngate, ifreq, oversample=1):
+    """Sum power and count non-zero samples by channel and phase bin.
+
+    Parameters
+    ----------
+    power : array
+        With shape (ntime, nchan[+1], npol**2) (any extra channel is
+        ignored, such as the Nyquist channel for real data).
+    iphase : array of int
+        Phase bin for each sample, with shape (ntime, 1) or
+        (ntime, nchan_in), with nchan_in = nchan // oversample.
+    ngate : int
+        Number of phase bins.
+    ifreq : array of int
+        Channel order to apply to the output (e.g., to sort in frequency).
+    oversample : int
+        Number of output channels per column of iphase.
+
+    Returns
+    -------
+    foldspec : array of float64
+        Summed power, with shape (nchan, ngate, npol**2), channels in the
+        order given by ifreq.
+    count : array of int
+        Number of samples with non-zero power, shape (nchan, ngate).
+    """
+    nchan = len(ifreq)
+    npow = power.shape[-1]
+    power = power[:, :nchan]
+    columns = channel_columns(nchan, iphase.shape[1], oversample)
+    # flat index into (phase, channel) for all samples; with phase first,
+    # samples taken at the same time fall in nearby bins, which is much
+    # more cache-friendly than the (channel, phase) order of the output.
+    index = (iphase[:, columns] * nchan + np.arange(nchan)).ravel()
+    count = np.bincount(index, (power[..., 0] != 0.).ravel(),
+                        ngate * nchan).reshape(ngate, nchan)
+    # one pass per polarisation is faster than building an index that
+    # includes the polarisation (npol**2 times larger).
+    foldspec = np.empty((ngate, nchan, npow))
+    for ipow in range(npow):
+        foldspec[..., ipow] = np.bincount(index, power[..., ipow].ravel(),
+                                          ngate * nchan).reshape(ngate, nchan)
+    return foldspec.transpose(1, 0, 2)[ifreq], count.T[ifreq]
+
+
+def waterfall_power(power, iw, nwsize, ifreq, oversample=1):
+    """Sum power by channel and waterfall time bin.
+
+    Parameters
+    ----------
+    power : array
+        With shape (ntime, nchan[+1], npol**2).
+    iw : array of int
+        Waterfall bin for each sample, with shape (ntime, 1) or
+        (ntime, nchan_in) (e.g., if shifted for dispersion delays).
+        Bins outside of the range 0..nwsize-1 are clipped.
+    nwsize : int
+        Number of waterfall bins.
+    ifreq : array of int
+        Channel order to apply to the output.
+    oversample : int
+        Number of output channels per column of iw.
+
+    Returns
+    -------
+    iwmin : array of int
+        First waterfall bin covered by each channel, in the order given by
+        ifreq.
+    waterfall : array of float64
+        Summed power, with shape (nbin, nchan, npol**2), where row k holds
+        bin iwmin+k of each channel (see `add_waterfall`).
+
+    Notes
+    -----
+    Bins are counted from the first one of each channel, rather than from
+    the first one of all channels, so that the output is not larger than
+    the number of bins covered by the block, however large the dispersion
+    delays across the band.
+    """
+    nchan = len(ifreq)
+    npow = power.shape[-1]
+    power = power[:, :nchan]
+    columns = channel_columns(nchan, iw.shape[1], oversample)
+    iw = np.clip(iw, 0, nwsize-1)
+    colmin = iw.min(0)
+    nbin = (iw.max(0) - colmin).max() + 1
+    # ensure the last row is within the waterfall for all channels.
+    iwmin = np.minimum(colmin[columns], nwsize - nbin)
+    # flat index into (time bin, channel) for all samples.
+    index = ((iw[:, columns] - iwmin) * nchan + np.arange(nchan)).ravel()
+    waterfall = np.empty((nbin, nchan, npow))
+    for ipow in range(npow):
+        waterfall[..., ipow] = np.bincount(index, power[..., ipow].ravel(),
+                                           nbin * nchan).reshape(nbin, nchan)
+    return iwmin[ifreq], waterfall[:, ifreq]
+
+
+def add_waterfall(waterfall, iwmin, wf_sum):
+    """Add the output of `waterfall_power` to a waterfall, in place.
+
+    Parameters
+    ----------
+    waterfall : array
+        With shape (nwsize, nchan, npol**2).
+    iwmin : array of int
+        Bin corresponding to the first row of wf_sum, for each channel.
+    wf_sum : array
+        Summed power, with shape (nbin, nchan, npol**2).
+    """
+    rows = iwmin + np.arange(len(wf_sum))[:, np.newaxis]
+    # each (row, channel) pair occurs once, so buffered addition is fine.
+    waterfall[rows, np.arange(wf_sum.shape[1])] += wf_sum
+    return waterfall
+
+
+def _sum_of_products(a, b, c, d, out, scratch, subtract=False):
+    """Set out = a*b + c*d (or a*b - c*d) without further temporaries.
+
+    The products are stored in the two scratch arrays, so that the sum is
+    calculated at their precision, and only rounded when stored in out.
+    """
+    np.multiply(a, b, out=scratch[0])
+    np.multiply(c, d, out=scratch[1])
+    if subtract:
+        np.subtract(scratch[0], scratch[1], out=out)
+    else:
+        np.add(scratch[0], scratch[1], out=out)
+    return out
+
+
+def _power_layout(vals, cross):
+    """Shape and default dtype of the output of `power_products`."""
+    npol = vals.shape[-1]
+    npow = 4 if npol == 2 and cross else npol
+    return (vals.shape[:-1] + (npow,),
+            np.dtype(np.float32) if npol == 2 else vals.real.dtype)
+
+
+def power_products(vals, cross=True, out=None, scratch=None):
+    """Power, and possibly cross products, of complex voltages.
+
+    Parameters
+    ----------
+    vals : array of complex
+        With shape (..., npol), with npol = 1 or 2.
+    cross : bool
+        For two polarisations, whether to include the cross products
+        (default: True).
+    out : array or None
+        Array in which to store the result (e.g., to reuse a buffer).
+    scratch : list of array or None
+        Two arrays with shape ``vals.shape[:-1]`` and the precision of the
+        input, used for intermediate products.  By default, allocated.
+
+    Returns
+    -------
+    power : array of float
+        With shape (..., npow), where for npol=2 the products are
+        AA, Re(AB*), Im(AB*), BB with cross=True, and AA, BB otherwise.
+        By default, for npol=2 the products are stored as float32, and
+        otherwise with the precision of the input.
+
+    Notes
+    -----
+    Each product is written directly into the output, with only two
+    scratch arrays of the size of one product reused for all of them.
+    Products are calculated at the precision of the input, and rounded
+    only once, so the result is the same as for a direct calculation.
+    """
+    npol = vals.shape[-1]
+    real = vals.real
+    imag = vals.imag
+    if out is None:
+        out = np.empty(*_power_layout(vals, cross))
+    if scratch is None:
+        scratch = [np.empty(vals.shape[:-1], real.dtype) for i in range(2)]
+    r0, i0 = real[..., 0], imag[..., 0]
+    _sum_of_products(r0, r0, i0, i0, out[..., 0], scratch)
+    if npol == 2:
+        r1, i1 = real[..., 1], imag[..., 1]
+        _sum_of_products(r1, r1, i1, i1, out[..., -1], scratch)
+        if cross:
+            _sum_of_products(r0, r1, i0, i1, out[..., 1], scratch)
+            _sum_of_products(i0, r1, r0, i1, out[..., 2], scratch,
+                             subtract=True)
+    return out
+
+
+class PowerBuffers(object):
+    """Arrays for `power_products` that are reused between blocks.
+
+    Scratch arrays are only needed during the calculation, and are kept
+    per thread.  Output arrays, however, are passed on to be folded, and
+    may still be in use while a worker thread detects the next block; they
+    are therefore taken from a pool shared by all threads, and should be
+    returned to it with `release` once they are no longer needed.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        # deque.append and pop are atomic, so no lock is needed.
+        self._free = collections.deque()
+
+    def power_products(self, vals, cross=True):
+        """Calculate `power_products` using reused buffers."""
+        shape, dtype = _power_layout(vals, cross)
+        try:
+            out = self._free.pop()
+        except IndexError:
+            out = None
+        if out is None or out.shape != shape or out.dtype != dtype:
+            out = np.empty(shape, dtype)
+        scratch = getattr(self._local, 'scratch', None)
+        if (scratch is None or scratch[0].shape != shape[:-1] or
+                scratch[0].dtype != vals.real.dtype):
+            scratch = self._local.scratch = [
+                np.empty(shape[:-1], vals.real.dtype) for i in range(2)]
+        return power_products(vals, cross, out, scratch)
+
+    def release(self, arrays):
+        """Make output arrays available for reuse."""
+        self._free.extend(arrays)
@@ -0,0 +1,120 @@
+"""Helpers for coherent dedispersion by overlap-save.
+
+Multiplying the Fourier transform of a whole block by the dedispersion
+chirp gives a circular convolution: samples near the edges of the block
+get wrapped-around contributions from the other end.  With overlap-save,
+the data are instead split into overlapping segments of a (short) FFT
+length, and from each dedispersed segment only the samples that are not
+contaminated are kept.  Since consecutive blocks need to overlap as well,
+``fold`` prepends the end of the previous block to each block.
+
+In the dedispersed series, the sample at index m is calculated from input
+samples from ``m - nlag`` to ``m + nlead``, where ``nlag`` and ``nlead``
+are the maximum delay and advance (in samples) applied to any frequency.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+import astropy.units as u
+
+from .chirp import dispersion_delay_constant
+
+MIN_FFT_LENGTH = 256  # to avoid the overhead of many tiny transforms
+
+
+def fast_fft_sizes(nmin, nmax):
+    """Even numbers between nmin and nmax of the form 2^a 3^b 5^c."""
+    sizes = []
+    n2 = 2
+    while n2 <= nmax:
+        n3 = n2
+        while n3 <= nmax:
+            n5 = n3
+            while n5 <= nmax:
+                if n5 >= nmin:
+                    sizes.append(n5)
+                n5 *= 5
+            n3 *= 3
+        n2 *= 2
+    return sorted(sizes)
+
+
+def next_fast_size(n):
+    """Smallest even number >= n of the form 2^a 3^b 5^c."""
+    nmax = max(n, 2)
+    while True:
+        sizes = fast_fft_sizes(n, nmax)
+        if sizes:
+            return sizes[0]
+        nmax *= 2
+
+
+def dispersion_overlap(dm, f, fref, dt):
+    """Number of samples needed before and after for dedispersion.
+
+    Parameters
+    ----------
+    dm : `~astropy.units.Quantity`
+        Dispersion measure(s).
+    f : `~astropy.units.Quantity`
+        Frequencies in the band, e.g., those of the fine channels.
+    fref : `~astropy.units.Quantity`
+        Frequency relative to which dispersion is corrected; should
+        broadcast against f.
+    dt : `~astropy.units.Quantity`
+        Time per sample.
+
+    Returns
+    -------
+    nlag, nlead : int
+        Samples needed before and after each dedispersed sample.
+    """
+    dm = np.atleast_1d(dm)
+    # delay applied by the chirp to frequency f (negative below fref).
+    delay = (dispersion_delay_constant * dm[:, np.newaxis] *
+             (1. / fref**2 - 1. / f**2).ravel()).to(u.s)
+    samples = (delay / dt).to(u.dimensionless_unscaled).value
+    nlag = int(np.ceil(max(samples.max(), 0.)))
+    nlead = int(np.ceil(max(-samples.min(), 0.)))
+    return nlag, nlead
+
+
+def overlap_fft_length(noverlap, nmax):
+    """Choose a fast FFT length for a given overlap.
+
+    The cost per useful sample, ``n log(n) / (n - noverlap)``, is
+    minimized over fast FFT sizes between twice the overlap (or
+    ``MIN_FFT_LENGTH``) and the first one that covers nmax samples.
+    """
+    nmin = max(2 * noverlap, MIN_FFT_LENGTH)
+    nmax = max(next_fast_size(nmax), nmin)
+    sizes = np.array(fast_fft_sizes(nmin, nmax) or [next_fast_size(nmin)])
+    cost = sizes * np.log(sizes) / (sizes - noverlap)
+    return int(sizes[cost.argmin()])
+
+
+def overlap_segments(x, nfft, noverlap):
+    """Split data into segments overlapping by noverlap samples.
+
+    Parameters
+    ----------
+    x : array
+        Data, with time along the first axis.
+    nfft : int
+        Length of each segment.
+    noverlap : int
+        Number of samples each segment overlaps with the next one.
+
+    Returns
+    -------
+    segments : array
+        With shape (nseg, nfft) + x.shape[1:], where the last segment is
+        padded with zeros as needed.
+    """
+    nvalid = nfft - noverlap
+    nseg = max(-(-(len(x) - noverlap) // nvalid), 1)
+    segments = np.zeros((nseg, nfft) + x.shape[1:], dtype=x.dtype)
+    for i in range(nseg):
+        part = x[i*nvalid:i*nvalid+nfft]
+        segments[i, :len(part)] = part
+    return segments
@@ -0,0 +1,299 @@
+"""Run fold or reduce in several processes on one machine, without MPI.
+
+``fold`` and ``reduce`` split the blocks over the ranks of an MPI
+communicator, and sum the results with ``comm.Reduce``.  On a single
+machine, `LocalComm` provides the small part of the communicator
+interface they use (``rank``, ``size``, ``Barrier``, ``bcast``, a
+summing ``Reduce``, and a shared counter for handing out blocks) for
+processes forked by `spawn`.  Arrays are reduced
+through a buffer in shared memory, in pieces, so that nothing large is
+pickled or sent through pipes.
+
+`fold_processes` runs fold in several processes, with the accumulators of
+each process memory-mapped to files in a shared-memory directory (see
+``accumulators``), from which the parent sums them at the end.
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .accumulators import ACCUMULATOR
+from .checkpoint import output_arrays
+
+# Files here are kept in memory, and can be mapped by all processes.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Size of the shared buffer through which arrays are reduced.
+SCRATCH_SIZE = 2**26
+
+
+def fork_context():
+    """Multiprocessing context that forks, so children inherit everything.
+
+    This allows running functions and arguments that cannot be pickled
+    (such as RFI filters defined in scripts), and sharing buffers created
+    before forking.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing  # python 2 always forks.
+
+
+class _Barrier(object):
+    """Barrier for a fixed number of processes (like python3's Barrier)."""
+    def __init__(self, parties, context):
+        self.parties = parties
+        self.count = context.Value('i', 0, lock=False)
+        self.generation = context.Value('i', 0, lock=False)
+        self.condition = context.Condition()
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            else:
+                while generation == self.generation.value:
+                    self.condition.wait()
+
+
+class LocalComm(object):
+    """Minimal stand-in for an MPI communicator for forked processes.
+
+    Use `LocalComm.create` to set up communicators for a number of
+    processes before forking; by default, a communicator for a single
+    process is made, for which all operations are trivial.
+
+    Parameters
+    ----------
+    rank, size : int
+        Rank of this process, and the total number of processes.
+    shared : dict or None
+        Synchronization primitives and shared buffer, as set up by
+        `LocalComm.create`.
+    """
+    def __init__(self, rank=0, size=1, shared=None):
+        self.rank = rank
+        self.size = size
+        self._shared = shared
+
+    @classmethod
+    def create(cls, size, scratch_size=SCRATCH_SIZE, context=None):
+        """Create communicators for size processes (one for each rank)."""
+        if context is None:
+            context = fork_context()
+        shared = dict(lock=context.Lock(),
+                      barrier=_Barrier(size, context),
+                      queues=[context.Queue() for rank in range(size)],
+                      scratch=context.RawArray('b', scratch_size),
+                      counter=context.Value('l', 0))
+        return [cls(rank, size, shared) for rank in range(size)]
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def Barrier(self):
+        """Wait until all processes have reached the barrier."""
+        if self.size > 1:
+            self._shared['barrier'].wait()
+
+    def bcast(self, obj, root=0):
+        """Send a (small, picklable) object from root to all processes."""
+        if self.size == 1:
+            return obj
+        if self.rank == root:
+            for rank, queue in enumerate(self._shared['queues']):
+                if rank != root:
+                    queue.put(obj)
+            return obj
+        return self._shared['queues'][self.rank].get()
+
+    def counter(self):
+        """Reset and return a counter shared by all processes (collective).
+
+        The counter has a ``fetch_and_add`` method like
+        `~scintellometry.folding.schedule.MPICounter`.
+        """
+        if self.size == 1:
+            return LocalCounter(None)
+        # ensure no process still uses the counter before resetting it.
+        self.Barrier()
+        if self.rank == 0:
+            self._shared['counter'].value = 0
+        self.Barrier()
+        return LocalCounter(self._shared['counter'])
+
+    def Reduce(self, sendbuf, recvbuf, op=None, root=0):
+        """Sum arrays of all processes into recvbuf on root.
+
+        Only summation is supported (op is accepted for compatibility with
+        MPI, but ignored).  The arrays are added in pieces that fit in the
+        shared buffer, so that no copies are needed besides recvbuf.
+        """
+        send = np.asarray(sendbuf)
+        if self.size == 1:
+            if recvbuf is not None and recvbuf is not sendbuf:
+                recvbuf[...] = send
+            return
+        send = send.reshape(-1)
+        if self.rank == root:
+            recv = np.asarray(recvbuf)
+            assert recv.size == send.size and recv.flags.c_contiguous
+            recv = recv.reshape(-1)
+        scratch = np.frombuffer(self._shared['scratch'], dtype=np.int8)
+        nchunk = scratch.size // send.dtype.itemsize
+        scratch = scratch[:nchunk * send.dtype.itemsize].view(send.dtype)
+        for start in range(0, send.size, nchunk):
+            part = send[start:start+nchunk]
+            total = scratch[:len(part)]
+            if self.rank == root:
+                total[...] = 0
+            self.Barrier()
+            with self._shared['lock']:
+                total += part
+            self.Barrier()
+            if self.rank == root:
+                recv[start:start+len(part)] = total
+            self.Barrier()
+
+
+class LocalCounter(object):
+    """Counter in shared memory that processes can increment atomically."""
+    def __init__(self, value=None):
+        self.value = value
+        self.count = 0  # used if not shared.
+
+    def fetch_and_add(self, increment):
+        """Add increment, returning the value before."""
+        if self.value is None:
+            count, self.count = self.count, self.count + increment
+            return count
+        with self.value.get_lock():
+            count = self.value.value
+            self.value.value += increment
+        return count
+
+    def free(self):
+        pass
+
+
+def spawn(function, nprocs, *args, **kwargs):
+    """Run a function in nprocs forked processes.
+
+    Each process calls ``function(*args, comm=comm, **kwargs)``, with
+    ``comm`` a `LocalComm` for its rank.  Raises `RuntimeError` if any
+    process fails (in which case the others are terminated, since they
+    may be waiting for it).
+    """
+    context = fork_context()
+    comms = LocalComm.create(nprocs, context=context)
+
+    def run(comm):
+        function(*args, comm=comm, **kwargs)
+
+    processes = [context.Process(target=run, args=(comm,)) for comm in comms]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            for process in processes:
+                process.join(0.5)
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError("Process {0} failed with exit code "
+                                       "{1}.".format(processes.index(process),
+                                                     process.exitcode))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    failed = [process.exitcode for process in processes
+              if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("Processes failed with exit codes {0}."
+                           .format(failed))
+
+
+def sum_accumulator(directory, name, nprocs):
+    """Sum the memory-mapped accumulators of all ranks, or None if absent."""
+    files = [os.path.join(directory, ACCUMULATOR.format(name, rank))
+             for rank in range(nprocs)]
+    if not all(os.path.exists(filename) for filename in files):
+        return None
+    total = np.array(np.load(files[0], mmap_mode='r'))
+    for filename in files[1:]:
+        total += np.load(filename, mmap_mode='r')
+    return total
+
+
+def fold_processes(open_fh, nprocs, **kwargs):
+    """Fold data in several processes, returning summed results.
+
+    Parameters
+    ----------
+    open_fh : callable
+        Called without arguments in each process to open its own reader
+        (readers keep file positions, so cannot be shared).  If the reader
+        has a ``close`` method, it is called at the end.
+    nprocs : int
+        Number of processes; the blocks are split between these as they
+        would be between MPI ranks.
+    **kwargs
+        Arguments for `~scintellometry.folding.fold.fold`, except ``fh``
+        and ``comm``.  If ``accumulator_dir`` is given, the accumulators of
+        all processes are kept there; by default, they are kept in a
+        temporary directory in shared memory, which is removed at the end.
+
+    Returns
+    -------
+    foldspec, icount, waterfall : array, list of array, or None
+        Summed over all processes, as returned by fold.
+    """
+    from .fold import fold
+
+    directory = kwargs.pop('accumulator_dir', None)
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix='fold', dir=SHM_DIR)
+
+    def run(comm):
+        fh = open_fh()
+        try:
+            fold(fh, comm, accumulator_dir=directory, **kwargs)
+        finally:
+            if hasattr(fh, 'close'):
+                fh.close()
+
+    try:
+        spawn(run, nprocs)
+        foldspec = []
+        icount = []
+        while True:
+            target = len(foldspec)
+            _foldspec = sum_accumulator(directory,
+                                        'foldspec{0}'.format(target), nprocs)
+            if _foldspec is None:
+                break
+            foldspec.append(_foldspec)
+            icount.append(sum_accumulator(directory,
+                                          'icount{0}'.format(target), nprocs))
+        waterfall = sum_accumulator(directory, 'waterfall', nprocs)
+    finally:
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    dm = kwargs['dm']
+    npow = (foldspec[0] if foldspec else waterfall).shape[-1]
+    return output_arrays(foldspec or None, icount or None, waterfall,
+                         multi_dm=not dm.isscalar, npol=1 if npow == 1 else 2,
+                         single_target=kwargs.get('targets') is None)
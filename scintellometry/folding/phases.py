@@ -0,0 +1,188 @@
+"""Fast approximate evaluation of pulsar phases for all channels of a block.
+
+In ``fold``, the phase predictor is evaluated for every sample in a block,
+and, for dedispersed data, for every input channel, since each channel has
+its own dispersion delay.  For high-order polynomials or polycos, this can
+be a substantial fraction of the time spent per block.
+
+Over the short time span of a block, however, the phase of each channel is
+very well described by a low-order Taylor expansion.  Hence, it suffices to
+evaluate the predictor at a few times per channel (which differ only by the
+constant dispersion delays), and calculate the phases for all samples from
+the resulting expansion coefficients.  The block is split in more segments
+if needed to keep an upper limit to the error below a given tolerance.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+# Default maximum error in the phase, as a fraction of a phase bin.
+GATE_FRACTION = 0.01
+
+
+class InterpolatedPhase(object):
+    """Wrap a phase predictor, evaluating it by piecewise Taylor expansion.
+
+    Parameters
+    ----------
+    phasepol : callable
+        Function that returns the pulsar phase (in cycles) for times in
+        seconds, such as a `~numpy.polynomial.Polynomial`.
+    ngate : int
+        Number of phase bins for which the phases are used.
+    tolerance : float or None
+        Maximum allowed error in the phase, in cycles.  By default,
+        ``GATE_FRACTION / ngate``, i.e., 1% of a phase bin.
+
+    Notes
+    -----
+    Within each segment, the phase is approximated by the second-order
+    polynomial through the predicted phases at the start, middle and end.
+    For a segment with half-width h, the remainder is the third derivative
+    at some point in the segment times (x+h) x (x-h) / 6, which is at most
+    M3 h**3 / (9 sqrt(3)), where M3 is the maximum absolute third
+    derivative in the segment.  If phasepol has a ``deriv`` method (as for
+    polynomials), M3 is bounded by the sum of the absolute Taylor
+    coefficients of the third derivative around the middle of the segment,
+    giving a strict upper limit.  Otherwise, the third and fourth
+    derivatives are estimated from the phases at the start, end, middle and
+    quarter points, which is exact if the predictor is a polynomial of at
+    most fourth order over the segment.  The number of segments needed is
+    kept for subsequent blocks.
+
+    Calling an instance simply evaluates the phase predictor.
+    """
+    def __init__(self, phasepol, ngate, tolerance=None):
+        self.phasepol = phasepol
+        self.tolerance = (GATE_FRACTION / ngate if tolerance is None
+                          else tolerance)
+        self.nsegment = 1
+
+    def __call__(self, t):
+        return self.phasepol(t)
+
+    def cubic_bound(self, times, half, phase):
+        """Upper limit to h**3 times the absolute third derivative.
+
+        Parameters
+        ----------
+        times : array
+            Times at -1, -1/2, 0, 1/2, and 1 times the half-width from the
+            middle of each segment, shape (5, nsegment, nchan).
+        half : array
+            Half-width h of each segment, shape (nsegment, 1).
+        phase : array
+            Predicted phases at times.
+
+        Returns
+        -------
+        bound : array
+            For each segment and channel.
+        """
+        deriv = getattr(self.phasepol, 'deriv', None)
+        if deriv is None:
+            # differences for steps of h/2, multiplied by h**3 and h**4
+            # divided by the step size to the corresponding power.
+            d3 = phase[4] - 2. * phase[3] + 2. * phase[1] - phase[0]
+            d4 = (phase[4] - 4. * phase[3] + 6. * phase[2] -
+                  4. * phase[1] + phase[0])
+            return 4. * np.abs(d3) + 16. * np.abs(d4)
+
+        term = deriv(3)
+        bound = np.zeros(times.shape[1:])
+        factor = half**3
+        for k in range(term.degree() + 1):
+            bound += np.abs(term(times[2])) * factor
+            term = term.deriv()
+            factor = factor * half / (k + 1)
+        return bound
+
+    def coefficients(self, t, offsets, edges):
+        """Taylor coefficients of the phase for segments of the times t.
+
+        Parameters
+        ----------
+        t : array
+            Times at which the phase is needed, in seconds, increasing.
+        offsets : array
+            Delays for each channel, subtracted from t.
+        edges : array of int
+            Indices into t of the segment boundaries.
+
+        Returns
+        -------
+        tmid : array
+            Central time of each segment.
+        coeffs : array
+            Phase, first and second derivative (divided by 2) at tmid for
+            each segment and channel, shape (3, nsegment, nchan).
+        error : float
+            Upper limit to the error of the expansion.
+        """
+        tstart = t[edges[:-1]]
+        tstop = t[edges[1:] - 1]
+        tmid = 0.5 * (tstart + tstop)
+        half = 0.5 * (tstop - tstart)
+        # evaluate at -1, -1/2, 0, 1/2, and 1 times the half-width.
+        nodes = np.array([-1., -0.5, 0., 0.5, 1.])
+        times = ((tmid + nodes[:, np.newaxis] * half)[..., np.newaxis] -
+                 offsets)
+        phase = self.phasepol(times.ravel()).reshape(times.shape)
+        half = half[:, np.newaxis]
+        # quadratic through start, middle, end
+        coeffs = np.array([phase[2],
+                           (phase[4] - phase[0]) / 2.,
+                           (phase[4] - 2. * phase[2] + phase[0]) / 2.])
+        # |(x+1) x (x-1)| is at most 2 / (3 sqrt(3)) for -1 < x < 1.
+        error = (self.cubic_bound(times, half, phase).max() /
+                 (9. * np.sqrt(3.)))
+        # convert derivatives from per half-width to per second.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coeffs[1] = np.where(half > 0., coeffs[1] / half, 0.)
+            coeffs[2] = np.where(half > 0., coeffs[2] / half**2, 0.)
+        return tmid, coeffs, error
+
+    def offset_phases(self, t, offsets):
+        """Phases for times t minus channel delays.
+
+        Parameters
+        ----------
+        t : array
+            Times for each sample in a block, in seconds, increasing.
+        offsets : array
+            Delays for each channel (in seconds) to be subtracted from t.
+
+        Returns
+        -------
+        phase : array
+            With shape (len(t), len(offsets)).
+        """
+        t = np.asanyarray(t, dtype=np.float64)
+        offsets = np.atleast_1d(offsets)
+        while True:
+            nsegment = self.nsegment
+            if 5 * nsegment >= len(t):
+                # expansion would not be faster than direct evaluation.
+                return self.phasepol((t[:, np.newaxis] - offsets).ravel()
+                                     ).reshape(len(t), len(offsets))
+            edges = np.linspace(0, len(t), nsegment + 1).astype(int)
+            tmid, coeffs, error = self.coefficients(t, offsets, edges)
+            if error <= self.tolerance:
+                break
+            # error scales with the cube of the segment length.
+            self.nsegment = max(nsegment + 1, int(np.ceil(
+                nsegment * 1.2 * (error / self.tolerance)**(1. / 3.))))
+
+        phase = np.empty((len(t), len(offsets)))
+        for i in range(nsegment):
+            x = (t[edges[i]:edges[i+1]] - tmid[i])[:, np.newaxis]
+            out = phase[edges[i]:edges[i+1]]
+            np.multiply(x, coeffs[2, i], out=out)
+            out += coeffs[1, i]
+            out *= x
+            out += coeffs[0, i]
+        return phase
+
+    def __repr__(self):
+        return ("<InterpolatedPhase of {0} with tolerance {1} cycles>"
+                .format(self.phasepol, self.tolerance))
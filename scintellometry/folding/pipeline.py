@@ -0,0 +1,104 @@
+"""Concurrent execution of the stages of fold within a single process.
+
+Reading, channelizing and folding a block are done one after the other in
+``fold``.  With ``pipeline``, blocks are read by one thread, channelized by
+a pool of worker threads (numpy and FFTW release the GIL for most of the
+work), and handed back in their original order, so that folding them gives
+results that are identical to those of serial processing.  This allows
+using all cores of a node with a single MPI process, rather than needing
+one process (with its own foldspec and waterfall) per core.
+"""
+from __future__ import division, print_function
+
+import threading
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+def pipeline(items, function, nworkers=1, nqueue=None):
+    """Apply a function to data concurrently, yielding results in order.
+
+    Parameters
+    ----------
+    items : iterable
+        Yielding ``(key, data)`` pairs; it is iterated over in a separate
+        (reader) thread.  Exceptions raised are passed on to the caller.
+    function : callable
+        Called with ``data`` by one of the worker threads.
+    nworkers : int
+        Number of worker threads.
+    nqueue : int or None
+        Maximum number of items that are read but not yet handed back,
+        to bound memory use.  Default: ``2 * nworkers``.
+
+    Yields
+    ------
+    key, result : tuple
+        Where ``result = function(data)``, in the order given by items.
+    """
+    if nqueue is None:
+        nqueue = 2 * nworkers
+    # Each item is tracked as [key, data, event, result].  The ordered queue
+    # holds items in sequence and limits how far reading can run ahead.
+    ordered = queue.Queue(maxsize=max(nqueue, 1))
+    todo = queue.Queue()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for key, data in items:
+                if stop.is_set():
+                    break
+                item = [key, data, threading.Event(), None]
+                ordered.put(item)
+                todo.put(item)
+        except Exception as exc:
+            item = [None, None, threading.Event(), exc]
+            item[2].set()
+            ordered.put(item)
+        finally:
+            ordered.put(None)
+            for i in range(nworkers):
+                todo.put(None)
+
+    def worker():
+        while True:
+            item = todo.get()
+            if item is None:
+                break
+            if not stop.is_set():
+                try:
+                    item[3] = function(item[1])
+                except Exception as exc:
+                    item[3] = exc
+            item[1] = None
+            item[2].set()
+
+    threads = [threading.Thread(target=reader)]
+    threads += [threading.Thread(target=worker) for i in range(nworkers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = ordered.get()
+            if item is None:
+                break
+            item[2].wait()
+            if isinstance(item[3], Exception):
+                raise item[3]
+            yield item[0], item[3]
+    finally:
+        # Ensure the reader is not blocked on a full queue, and all threads
+        # finish, also if we stopped early.
+        stop.set()
+        while threads[0].is_alive():
+            try:
+                ordered.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for thread in threads:
+            thread.join()
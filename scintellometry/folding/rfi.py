@@ -0,0 +1,163 @@
+"""Excision of radio-frequency interference from channelized data.
+
+`RFIExcision` can be passed to fold, which applies it to the power of the
+channelized voltages of every block, as part of the channelization (and
+thus in the worker threads if nworkers > 0).  Two tests are done:
+
+* The spectral kurtosis (Nita & Gary 2010, MNRAS 406, L60) of each channel
+  in chunks of ``nsk`` samples.  For Gaussian noise, the power of a complex
+  voltage is exponentially distributed and the estimator is unity, with a
+  standard deviation of about ``2/sqrt(nsk)``; persistent narrow-band
+  signals lower it, and intermittent ones raise it.
+* Median-absolute-deviation clipping of the power averaged over channels,
+  which removes short, broad-band bursts.
+
+Flagged samples are set to zero.  Since fold counts only samples with
+non-zero power, they are then excluded from both the sums in foldspec and
+the counts in icount, and thus do not bias the averages.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+# Ratio of standard deviation to median absolute deviation for a Gaussian.
+MAD_TO_STD = 1.4826
+
+
+def auto_products(npow):
+    """Indices of the power (rather than cross) products in detected data.
+
+    For npow=4, the products are AA, Re(AB*), Im(AB*), BB (see
+    kernels.power_products).
+    """
+    return [0, 3] if npow == 4 else list(range(npow))
+
+
+def spectral_kurtosis(power, nsk, d=1.):
+    """Generalized spectral kurtosis estimator in chunks of samples.
+
+    Zero samples (e.g., flagged before) are ignored.
+
+    Parameters
+    ----------
+    power : array
+        Power, with time along the first axis.
+    nsk : int
+        Number of samples per chunk; the last chunk may be shorter.
+    d : float or array
+        Shape parameter of the gamma distribution of the power: 1 for the
+        power of complex voltages, 0.5 for real ones (such as the zero
+        and Nyquist channels of a real-valued transform).  Should
+        broadcast against ``power.shape[1:]``.
+
+    Returns
+    -------
+    sk : array
+        Estimator for each chunk, with shape (nchunk,) + power.shape[1:];
+        NaN where a chunk has fewer than two non-zero samples.
+    number : array of int
+        Number of non-zero samples in each chunk.
+    """
+    starts = np.arange(0, len(power), nsk)
+    power = power.astype(np.float64)
+    number = np.add.reduceat(power != 0., starts, axis=0)
+    s1 = np.add.reduceat(power, starts, axis=0)
+    s2 = np.add.reduceat(power**2, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sk = ((number * d + 1.) / (number - 1.) *
+              (number * s2 / s1**2 - 1.))
+    sk[number < 2] = np.nan
+    return sk, number
+
+
+def sk_limits(number, threshold, d=1.):
+    """Range of the spectral kurtosis expected for Gaussian noise.
+
+    Uses the large-N variance of the estimator, ``2 (d+1) / (d N)``.
+    """
+    with np.errstate(divide='ignore'):
+        sigma = np.sqrt(2. * (d + 1.) / (d * number))
+    return 1. - threshold * sigma, 1. + threshold * sigma
+
+
+def mad_outliers(series, threshold):
+    """Whether samples deviate more than threshold robust sigma from median.
+
+    The standard deviation is estimated from the median absolute deviation
+    of the non-zero samples.
+    """
+    good = series[series != 0.]
+    if len(good) < 2:
+        return np.zeros(series.shape, dtype=bool)
+    median = np.median(good)
+    sigma = MAD_TO_STD * np.median(np.abs(good - median))
+    return (series != 0.) & (np.abs(series - median) > threshold * sigma)
+
+
+class RFIExcision(object):
+    """Zap samples affected by RFI, based on spectral kurtosis and MAD.
+
+    Parameters
+    ----------
+    nsk : int or None
+        Number of samples per channel over which to calculate the spectral
+        kurtosis.  If None, the spectral kurtosis is not used.
+    sk_threshold : float
+        Chunks are flagged if their spectral kurtosis deviates from unity
+        by more than this number of standard deviations (default: 5).
+    mad_threshold : float or None
+        If given, samples for which the power averaged over channels
+        deviates from the median by more than this number of standard
+        deviations (estimated from the median absolute deviation in the
+        block) are flagged in all channels.  For few channels, the power
+        is far from Gaussian, and a high threshold is needed.
+
+    Notes
+    -----
+    Very bright pulses raise the spectral kurtosis too, so for strong
+    pulsars the threshold should be set such that they are not zapped.
+    """
+    def __init__(self, nsk=256, sk_threshold=5., mad_threshold=None):
+        if nsk is not None and nsk < 2:
+            raise ValueError("Need at least two samples for the spectral "
+                             "kurtosis.")
+        self.nsk = nsk
+        self.sk_threshold = sk_threshold
+        self.mad_threshold = mad_threshold
+
+    def __call__(self, power, real_channels=()):
+        """Flag RFI in the power of one block, setting it to zero in place.
+
+        Parameters
+        ----------
+        power : array
+            With shape (ntime, nchan, npow), as calculated in fold.
+        real_channels : sequence of int
+            Channels with real-valued voltages, such as the zero and
+            Nyquist channels of a real-valued transform.
+
+        Returns
+        -------
+        power : array
+            The input, with flagged samples set to zero.
+        ok : array of bool
+            With shape (ntime, nchan), False for flagged samples.
+        """
+        auto = power[..., auto_products(power.shape[-1])]
+        ok = np.ones(power.shape[:2], dtype=bool)
+        if self.nsk is not None:
+            d = np.ones((power.shape[1], 1))
+            d[list(real_channels)] = 0.5
+            sk, number = spectral_kurtosis(auto, self.nsk, d)
+            low, high = sk_limits(number, self.sk_threshold, d)
+            # NaN (chunks with too few samples) compare as not bad.
+            bad = ((sk < low) | (sk > high)).any(-1)
+            ok &= ~np.repeat(bad, self.nsk, axis=0)[:len(ok)]
+        if self.mad_threshold is not None:
+            # average over good channels only, so that zapped ones and
+            # strong narrow-band signals do not dominate.
+            total = (auto.sum(-1) * ok).sum(-1)
+            nok = np.maximum(ok.sum(-1), 1)
+            ok &= ~mad_outliers(total / nok, self.mad_threshold)[:, np.newaxis]
+        power[~ok] = 0.
+        return power, ok
@@ -0,0 +1,118 @@
+"""Distribution of the blocks to fold over MPI ranks.
+
+By default, each rank folds a fixed, contiguous range of blocks.  If some
+ranks are slower (e.g., since their files are on a slow disk), the others
+then wait for them at the end.  With `dynamic_blocks`, ranks instead take
+chunks of blocks from a shared counter whenever they are ready for more,
+so that faster ranks fold more blocks.  Since chunks are handed out in
+order, each rank still sees its blocks in increasing order.
+
+The counter uses MPI one-sided communication (`MPICounter`), or, for
+processes on a single machine, shared memory (see ``parallel``).
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+# By default, make this many chunks per rank for dynamic scheduling.
+CHUNKS_PER_RANK = 8
+
+
+def static_range(nt, rank, size):
+    """First and end block a rank folds if the blocks are split evenly."""
+    size_per_node = (nt-1)//size + 1
+    return rank*size_per_node, min((rank+1)*size_per_node, nt)
+
+
+class MPICounter(object):
+    """Counter that all ranks can increment atomically.
+
+    Held in an MPI window on rank 0.  Creating (and freeing) the counter
+    are collective operations.
+    """
+    def __init__(self, comm):
+        from mpi4py import MPI
+        self.MPI = MPI
+        itemsize = np.dtype(np.int64).itemsize
+        self.window = MPI.Win.Allocate(itemsize if comm.rank == 0 else 0,
+                                       itemsize, comm=comm)
+        if comm.rank == 0:
+            self.window.Lock(0)
+            self.window.Put(np.zeros(1, dtype=np.int64), 0)
+            self.window.Unlock(0)
+        comm.Barrier()
+
+    def fetch_and_add(self, increment):
+        """Add increment, returning the value before."""
+        result = np.zeros(1, dtype=np.int64)
+        self.window.Lock(0, self.MPI.LOCK_SHARED)
+        self.window.Fetch_and_op(np.array([increment], dtype=np.int64),
+                                 result, 0, 0, self.MPI.SUM)
+        self.window.Unlock(0)
+        return int(result[0])
+
+    def free(self):
+        self.window.Free()
+
+
+def shared_counter(comm):
+    """Create a counter shared by all ranks of comm (collective)."""
+    if hasattr(comm, 'counter'):  # LocalComm
+        return comm.counter()
+    return MPICounter(comm)
+
+
+def dynamic_blocks(counter, nt, chunk):
+    """Yield blocks from chunks taken from a shared counter, until done.
+
+    Parameters
+    ----------
+    counter : `MPICounter` or `~scintellometry.folding.parallel.LocalCounter`
+        Counter of chunks handed out, shared by all ranks.
+    nt : int
+        Total number of blocks.
+    chunk : int
+        Number of blocks per chunk.
+    """
+    while True:
+        start = counter.fetch_and_add(1) * chunk
+        if start >= nt:
+            return
+        for j in range(start, min(start+chunk, nt)):
+            yield j
+
+
+def check_coverage(comm, folded, skip_blocks=None, verbose=True):
+    """Check that all blocks were folded once, summing over ranks.
+
+    Parameters
+    ----------
+    comm : communicator
+        Communicator of the ranks that folded (collective).
+    folded : array of int32
+        Number of times each block was folded by this rank.
+    skip_blocks : array of bool, optional
+        Blocks that were not supposed to be folded.
+    verbose : bool
+        Whether to report blocks not folded (e.g., due to the end of file).
+
+    Returns
+    -------
+    total : array or None
+        On rank 0, number of times each block was folded.
+    """
+    total = np.zeros_like(folded) if comm.rank == 0 else None
+    comm.Reduce(folded, total, root=0)
+    if comm.rank != 0:
+        return None
+    if np.any(total > 1):
+        raise RuntimeError("Blocks {0} were folded more than once."
+                           .format(np.flatnonzero(total > 1)))
+    missing = total == 0
+    if skip_blocks is not None:
+        missing &= ~np.asarray(skip_blocks, dtype=bool)
+    if verbose and missing.any():
+        print("Warning: {0} of {1} blocks were not folded, starting at "
+              "block {2}.".format(np.count_nonzero(missing), len(total),
+                                  np.flatnonzero(missing)[0]))
+    return total
@@ -0,0 +1,103 @@
+"""Stream the waterfall of fold to search-mode files as it is accumulated.
+
+Normally, ``fold`` keeps the full waterfall in memory, and returns it at
+the end.  For long series at high time resolution, this is not possible.
+Since the blocks are folded in order, however, the waterfall rows are
+completed in order as well: once a block has been processed, no later
+block will add to rows before the first one touched by that block.
+`WaterfallStream` therefore only keeps the rows that can still change,
+and hands completed ones to writers (e.g., from ``io.searchmode``).
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from .kernels import add_waterfall
+
+
+def total_intensity(waterfall):
+    """Sum the power in both polarisations, if present.
+
+    The last axis of waterfall should hold the power products calculated
+    by fold, i.e., AA, or AA, BB, or AA, Re(AB*), Im(AB*), BB.
+    """
+    if waterfall.shape[-1] == 1:
+        return waterfall[..., 0]
+    return waterfall[..., 0] + waterfall[..., -1]
+
+
+class WaterfallStream(object):
+    """Accumulate waterfall rows, passing them on once they are complete.
+
+    Parameters
+    ----------
+    writers : list
+        One for each dispersion measure, each with a ``write`` method that
+        takes total-intensity spectra with shape (nrow, nchan), and a
+        ``close`` method.
+    nrow : int
+        Total number of rows in the waterfall; on closing, rows that were
+        never added to are written as zeros up to this number.
+    """
+    def __init__(self, writers, nrow):
+        self.writers = writers
+        self.nrow = nrow
+        self.buffer = None
+        self.row0 = 0
+        self.lowest = None
+
+    def _extend(self, nrow, shape):
+        """Ensure the buffer covers nrow rows, starting at row0."""
+        if self.buffer is None:
+            self.buffer = np.zeros((len(self.writers), 0) + shape)
+        if nrow > self.buffer.shape[1]:
+            extra = np.zeros((len(self.writers), nrow - self.buffer.shape[1])
+                             + self.buffer.shape[2:])
+            self.buffer = np.concatenate([self.buffer, extra], axis=1)
+
+    def add(self, idm, iwmin, waterfall):
+        """Add summed power to the rows starting at iwmin.
+
+        Parameters
+        ----------
+        idm : int
+            Index of the dispersion measure (and hence writer).
+        iwmin : array of int
+            First row covered, for each channel.
+        waterfall : array
+            Summed power, with shape (nrow, nchan, npow), as calculated by
+            ``kernels.waterfall_power``.
+        """
+        start = iwmin - self.row0
+        if start.min() < 0:
+            raise ValueError("Cannot add to rows that were written already.")
+        self._extend(start.max() + len(waterfall), waterfall.shape[1:])
+        add_waterfall(self.buffer[idm], start, waterfall)
+        lowest = start.min() + self.row0
+        self.lowest = lowest if self.lowest is None else min(self.lowest,
+                                                             lowest)
+
+    def flush(self, upto=None):
+        """Write rows before upto.
+
+        By default, all rows before the lowest one added to since the
+        previous flush are written, i.e., those that are complete if
+        ``flush`` is called after each block.
+        """
+        if upto is None:
+            upto, self.lowest = self.lowest, None
+        if upto is None or self.buffer is None or upto <= self.row0:
+            return
+        nrow = upto - self.row0
+        self._extend(nrow, self.buffer.shape[2:])
+        for writer, rows in zip(self.writers, self.buffer[:, :nrow]):
+            writer.write(total_intensity(rows))
+        self.buffer = self.buffer[:, nrow:].copy()
+        self.row0 = upto
+
+    def close(self):
+        """Write all remaining rows, and close the writers."""
+        if self.buffer is not None:
+            self.flush(max(self.nrow, self.row0 + self.buffer.shape[1]))
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,47 @@
+"""Check that folding archived spectra gives the same result as the data."""
+from __future__ import division, print_function
+
+import shutil
+import tempfile
+
+import numpy as np
+import astropy.units as u
+
+from .channelized import ChannelizedArchive
+from .fold import fold
+from .test_fold import NCHAN, NT, NTINT, SyntheticReader, setup
+
+
+def test_archive_with_gaps():
+    kwargs = setup(SyntheticReader(NCHAN, NTINT), 1.e-2 * u.pc / u.cm**3,
+                   'by-channel')[0]
+    skip_blocks = np.zeros(NT, dtype=bool)
+    skip_blocks[[2, 3, 6]] = True
+    tmpdir = tempfile.mkdtemp()
+    try:
+        expected = fold(SyntheticReader(NCHAN, NTINT), None,
+                        skip_blocks=skip_blocks, channelized_output=tmpdir,
+                        **kwargs)
+        # gaps left by skipped blocks should not end the fold.
+        with ChannelizedArchive(tmpdir) as archive:
+            result = fold(archive, None, **kwargs)
+        for value, expected_value in zip(result, expected):
+            assert np.all(value == expected_value)
+
+        with ChannelizedArchive(tmpdir) as archive:
+            for name, value in (('nt', NT // 2), ('npol', 2), ('nskip', 1)):
+                try:
+                    archive.check(NCHAN, NTINT, 'by-channel', kwargs['dm'],
+                                  **{name: value})
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("Mismatch in {0} not caught."
+                                         .format(name))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_archive_with_gaps()
+    print("All archive checks passed.")
@@ -0,0 +1,73 @@
+"""Check that resuming from a checkpoint gives the same result as folding
+without interruption."""
+from __future__ import division, print_function
+
+import shutil
+import tempfile
+
+import numpy as np
+import astropy.units as u
+
+from .fold import fold
+from .test_fold import NCHAN, NTINT, SyntheticReader, setup
+
+
+class RecordingReader(SyntheticReader):
+    """Reader that remembers which blocks were read."""
+    def __init__(self, nchan, ntint):
+        super(RecordingReader, self).__init__(nchan, ntint)
+        self.blocks = []
+
+    def seek_record_read(self, offset, size):
+        self.blocks.append(offset // self.blocksize)
+        return super(RecordingReader, self).seek_record_read(offset, size)
+
+
+class CrashingReader(SyntheticReader):
+    """Reader that fails when asked for block crash_block or later."""
+    def __init__(self, nchan, ntint, crash_block):
+        super(CrashingReader, self).__init__(nchan, ntint)
+        self.crash_block = crash_block
+
+    def seek_record_read(self, offset, size):
+        if offset >= self.crash_block * self.blocksize:
+            raise RuntimeError("Simulated crash.")
+        return super(CrashingReader, self).seek_record_read(offset, size)
+
+
+def test_resume():
+    for nchan, dedisperse, overlap_save in (
+            (1, 'incoherent', False), (1, 'coherent', True),
+            (NCHAN, 'by-channel', False), (NCHAN, 'by-channel', True)):
+        dm = (1.e-4 if nchan == 1 else 1.e-2) * u.pc / u.cm**3
+        kwargs = setup(SyntheticReader(nchan, NTINT), dm, dedisperse)[0]
+        kwargs['overlap_save'] = overlap_save
+        expected = fold(SyntheticReader(nchan, NTINT), None, **kwargs)
+        for nworkers in (0, 2):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                # checkpoints are saved after blocks 1 and 3.
+                try:
+                    fold(CrashingReader(nchan, NTINT, 5), None,
+                         checkpoint=tmpdir, checkpoint_interval=2,
+                         nworkers=nworkers, **kwargs)
+                except RuntimeError:
+                    pass
+                else:
+                    raise AssertionError("Reader did not crash.")
+                fh = RecordingReader(nchan, NTINT)
+                result = fold(fh, None, checkpoint=tmpdir,
+                              checkpoint_interval=2, nworkers=nworkers,
+                              **kwargs)
+            finally:
+                shutil.rmtree(tmpdir)
+            # only the blocks after the checkpoint should have been read
+            # (and, for overlap-save, the one before).
+            assert min(fh.blocks) == (3 if overlap_save else 4)
+            for value, expected_value in zip(result, expected):
+                assert np.all(value == expected_value)
+
+
+if __name__ == '__main__':
+    test_resume()
+    print("All checkpoint checks passed.")
@@ -0,0 +1,254 @@
+"""Check fold against a direct calculation, with times kept as Quantities.
+
+Synthetic real baseband and channelized complex streams are folded, and
+the folded spectra, counts and waterfall compared with those found by
+channelizing the data directly and binning the power in phase and time
+using sample times calculated with units.  For coherent and by-channel
+dedispersion, this is done at zero dispersion measure (where dedispersion
+does not change the data); at non-zero dispersion measure, the times
+passed to the phase polynomial are compared for all dedispersion modes.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from numpy.fft import rfft, rfftfreq
+from numpy.polynomial import Polynomial
+import astropy.units as u
+
+from . import fold as fold_module
+from .fold import fold, dispersion_delay_constant
+
+NT = 8  # blocks to fold
+NCHAN = 16
+NTINT = 64
+NGATE = 8
+NTBIN = 2
+NTW = 16
+PHASEPOL = Polynomial([0.1, 1.e5])
+
+
+class SyntheticReader(object):
+    """Reader of random data, real baseband or channelized complex."""
+    telescope = 'aro'
+
+    def __init__(self, nchan, ntint, seed=1):
+        rng = np.random.RandomState(seed)
+        self.nchan = nchan
+        self.npol = 1
+        if nchan == 1:
+            self.samplerate = 200. * u.MHz
+            self.fedge = 200. * u.MHz
+            self.data_is_complex = False
+            self.blocksize = ntint * NCHAN * 2
+            self.data = rng.normal(size=NT * self.blocksize).astype(np.float32)
+        else:
+            self.samplerate = 100. / 6. * u.MHz
+            self.fedge = 156. * u.MHz
+            self.data_is_complex = True
+            self.blocksize = ntint
+            self.frequencies = self.fedge + (np.arange(nchan) *
+                                             self.samplerate / 2. / nchan)
+            shape = (NT * ntint, nchan)
+            self.data = (rng.normal(size=shape) +
+                         1j * rng.normal(size=shape)).astype(np.complex64)
+
+    def tell(self):
+        return 0
+
+    def seek_record_read(self, offset, size):
+        if offset + size > len(self.data):
+            raise EOFError
+        return self.data[offset:offset + size]
+
+
+class RecordingPhase(object):
+    """Phase polynomial that remembers the times it is evaluated at."""
+    def __init__(self, polynomial):
+        self.polynomial = polynomial
+        self.times = []
+
+    def __call__(self, t):
+        self.times.append(np.array(t))
+        return self.polynomial(t)
+
+
+def setup(fh, dm, dedisperse, fedge_at_top=False):
+    """Arguments for fold, and sample times, frequencies, and power."""
+    tb = -1. if fedge_at_top else 1.
+    if fh.nchan == 1:
+        dtsample = (2 * NCHAN / fh.samplerate).to(u.s)
+        freq = fh.fedge + tb * rfftfreq(NCHAN * 2,
+                                        (1. / fh.samplerate).to(u.s))
+        power = np.abs(rfft(fh.data.reshape(-1, NCHAN * 2), axis=1))**2
+        fref = fh.fedge + 50. * u.MHz
+        phasepol = PHASEPOL
+    else:
+        dtsample = (2 * fh.nchan / fh.samplerate).to(u.s)
+        freq = fh.frequencies
+        power = np.abs(fh.data.astype(np.complex128))**2
+        fref = fh.fedge + 4. * u.MHz
+        phasepol = PHASEPOL / 10.
+    kwargs = dict(samplerate=fh.samplerate, fedge=fh.fedge,
+                  fedge_at_top=fedge_at_top, nchan=NCHAN, nt=NT, ntint=NTINT,
+                  ngate=NGATE, ntbin=NTBIN, ntw=NTW, dm=dm, fref=fref,
+                  phasepol=phasepol, dedisperse=dedisperse, verbose=False)
+    # sample times, corrected for dispersion delays where fold does so.
+    t = np.arange(NT * NTINT)[:, np.newaxis] * dtsample
+    if dedisperse in ('incoherent', 'by-channel'):
+        t = t - dispersion_delay_constant * dm * (1. / freq**2 -
+                                                  1. / fref**2)
+    else:
+        t = t + np.zeros(len(freq)) * u.s
+    return kwargs, t, dtsample, freq[:NCHAN], power[:, :NCHAN]
+
+
+def reference_fold(t, dtsample, freq, power, phasepol):
+    """Fold power directly, with one sample at a time."""
+    nwsize = NT * NTINT // NTW
+    foldspec = np.zeros((NTBIN, NCHAN, NGATE))
+    icount = np.zeros((NTBIN, NCHAN, NGATE), dtype=np.int64)
+    waterfall = np.zeros((nwsize, NCHAN))
+    # for real data, the last column is for the Nyquist channel.
+    t = t[:, :NCHAN]
+    phase = phasepol(t.to(u.s).value)
+    iphase = np.remainder(phase * NGATE, NGATE).astype(int)
+    iw = np.clip(np.round((t / dtsample).to(u.dimensionless_unscaled)
+                          .value / NTW).astype(int), 0, nwsize - 1)
+    ibin = (np.arange(len(t)) // NTINT * NTBIN) // NT
+    chan = np.arange(NCHAN)
+    for isample in range(len(t)):
+        np.add.at(foldspec, (ibin[isample], chan, iphase[isample]),
+                  power[isample])
+        np.add.at(icount, (ibin[isample], chan, iphase[isample]),
+                  power[isample] != 0)
+        np.add.at(waterfall, (iw[isample], chan), power[isample])
+    # fold sorts the channels in frequency.
+    ifreq = freq.argsort()
+    return foldspec[:, ifreq], icount[:, ifreq], waterfall[:, ifreq]
+
+
+def check_fold(nchan, dedisperse, dm):
+    fh = SyntheticReader(nchan, NTINT)
+    kwargs, t, dtsample, freq, power = setup(fh, dm, dedisperse)
+    foldspec, icount, waterfall = fold(fh, None, **kwargs)
+    ref_foldspec, ref_icount, ref_waterfall = reference_fold(
+        t, dtsample, freq, power, kwargs['phasepol'])
+    assert np.all(icount == ref_icount)
+    assert np.allclose(foldspec, ref_foldspec, rtol=1.e-5)
+    assert np.allclose(waterfall, ref_waterfall, rtol=1.e-5)
+
+
+def check_phases(nchan, dedisperse, dm):
+    fh = SyntheticReader(nchan, NTINT)
+    kwargs, t, dtsample, freq, power = setup(fh, dm, dedisperse)
+    phasepol = kwargs['phasepol'] = RecordingPhase(kwargs['phasepol'])
+    fold(fh, None, **kwargs)
+    # fold uses a single column of times if these are the same for all
+    # channels.
+    times = np.vstack([_t.reshape(NTINT, -1) for _t in phasepol.times])
+    expected = t.to(u.s).value[:, :times.shape[1]]
+    assert np.allclose(times, expected, rtol=0., atol=1.e-15)
+    assert np.allclose(phasepol.polynomial(times),
+                       phasepol.polynomial(expected), rtol=0., atol=1.e-9)
+
+
+def test_fold_incoherent():
+    for nchan in (1, NCHAN):
+        check_fold(nchan, 'incoherent', 1.e-4 * u.pc / u.cm**3
+                   if nchan == 1 else 1.e-2 * u.pc / u.cm**3)
+
+
+def test_fold_no_dedispersion():
+    check_fold(1, None, 0. * u.pc / u.cm**3)
+
+
+def test_fold_zero_dm():
+    for nchan, dedisperse in ((1, 'by-channel'), (1, 'coherent'),
+                              (NCHAN, 'by-channel')):
+        check_fold(nchan, dedisperse, 0. * u.pc / u.cm**3)
+
+
+def test_overlap_save_zero_dm():
+    # without dispersion, there is no overlap, and no delay.
+    for nchan, dedisperse in ((1, 'by-channel'), (1, 'coherent'),
+                              (NCHAN, 'by-channel')):
+        fh = SyntheticReader(nchan, NTINT)
+        kwargs, t, dtsample, freq, power = setup(fh, 0. * u.pc / u.cm**3,
+                                                 dedisperse)
+        foldspec, icount, waterfall = fold(fh, None, overlap_save=True,
+                                           **kwargs)
+        ref_foldspec, ref_icount, ref_waterfall = reference_fold(
+            t, dtsample, freq, power, kwargs['phasepol'])
+        assert np.all(icount == ref_icount)
+        assert np.allclose(foldspec, ref_foldspec, rtol=1.e-5)
+        assert np.allclose(waterfall, ref_waterfall, rtol=1.e-5)
+
+
+def unity_chirp(dm, f, fref):
+    return np.ones((f + 0. * fref).shape, dtype=complex)
+
+
+def test_overlap_save_delay():
+    # With the chirp set to unity, dedispersion does nothing, but the
+    # overlap is still set by the dispersion measure.  The dedispersed
+    # series are then the input delayed by nshift samples, for which fold
+    # corrects the times, so the waterfall should be unchanged, except
+    # near the end, where the last nshift samples are missing.
+    chirp = fold_module.coherent_chirp
+    fold_module.coherent_chirp = unity_chirp
+    try:
+        for nchan, dedisperse in ((1, 'by-channel'), (1, 'coherent'),
+                                  (NCHAN, 'by-channel')):
+            fh = SyntheticReader(nchan, NTINT)
+            dm = (1.e-4 if nchan == 1 else 1.e-2) * u.pc / u.cm**3
+            kwargs = setup(fh, dm, dedisperse)[0]
+            overlap = fold(fh, None, overlap_save=True, **kwargs)
+            direct = fold(fh, None, **kwargs)
+            # (the zeros before the start get rounding-level power).
+            nw = len(direct[2]) // 2
+            assert np.allclose(overlap[2][:nw], direct[2][:nw], rtol=1.e-5,
+                               atol=1.e-10 * direct[2].max())
+    finally:
+        fold_module.coherent_chirp = chirp
+
+
+def test_overlap_save_fedge_at_top():
+    # For coherent dedispersion with the band edge at the top, fold used to
+    # conjugate the spectrum of the whole block, which reverses the time
+    # order within each block (circularly).  Overlap-save conjugates the
+    # chirp instead, and keeps the time order.
+    fh = SyntheticReader(1, NTINT)
+    kwargs, t, dtsample, freq, power = setup(fh, 0. * u.pc / u.cm**3,
+                                             'coherent', fedge_at_top=True)
+    raw = fh.data.reshape(NT, -1)
+    reversed_raw = np.roll(raw[:, ::-1], 1, axis=1)
+    reversed_power = np.abs(rfft(reversed_raw.reshape(-1, NCHAN * 2),
+                                 axis=1))[:, :NCHAN]**2
+    for overlap_save, expected_power in ((True, power),
+                                         (False, reversed_power)):
+        foldspec, icount, waterfall = fold(fh, None,
+                                           overlap_save=overlap_save,
+                                           **kwargs)
+        ref_foldspec, ref_icount, ref_waterfall = reference_fold(
+            t, dtsample, freq, expected_power, kwargs['phasepol'])
+        assert np.allclose(foldspec, ref_foldspec, rtol=1.e-5)
+        assert np.allclose(waterfall, ref_waterfall, rtol=1.e-5)
+
+
+def test_phases():
+    for nchan, dedisperse in ((1, 'incoherent'), (1, 'by-channel'),
+                              (1, 'coherent'), (NCHAN, 'incoherent'),
+                              (NCHAN, 'by-channel')):
+        check_phases(nchan, dedisperse, 1.e-4 * u.pc / u.cm**3
+                     if nchan == 1 else 1.e-2 * u.pc / u.cm**3)
+
+
+if __name__ == '__main__':
+    test_fold_incoherent()
+    test_fold_no_dedispersion()
+    test_fold_zero_dm()
+    test_overlap_save_zero_dm()
+    test_overlap_save_delay()
+    test_overlap_save_fedge_at_top()
+    test_phases()
+    print("All fold checks passed.")
@@ -0,0 +1,84 @@
+"""Check the power kernel against a direct calculation."""
+from __future__ import division, print_function
+
+import numpy as np
+
+from .kernels import (waterfall_power, add_waterfall, power_products,
+                      PowerBuffers)
+
+
+def direct_power(vals):
+    """Power and cross products, calculated as fold used to."""
+    if vals.shape[-1] == 1:
+        return vals.real**2 + vals.imag**2
+    p0, p1 = vals[..., 0], vals[..., 1]
+    power = np.empty(vals.shape[:-1] + (4,), np.float32)
+    power[..., 0] = p0.real**2 + p0.imag**2
+    power[..., 1] = p0.real*p1.real + p0.imag*p1.imag
+    power[..., 2] = p0.imag*p1.real - p0.real*p1.imag
+    power[..., 3] = p1.real**2 + p1.imag**2
+    return power
+
+
+def test_power_products():
+    rng = np.random.RandomState(1)
+    for dtype in (np.complex64, np.complex128):
+        for npol in (1, 2):
+            shape = (100, 16, npol)
+            vals = (rng.normal(size=shape) +
+                    1j * rng.normal(size=shape)).astype(dtype)
+            power = power_products(vals)
+            expected = direct_power(vals)
+            assert power.dtype == expected.dtype
+            assert np.all(power == expected)
+            if npol == 2:
+                power = power_products(vals, cross=False)
+                assert power.dtype == np.float32
+                assert np.all(power == expected[..., [0, 3]])
+
+
+def test_power_buffers():
+    rng = np.random.RandomState(2)
+    buffers = PowerBuffers()
+    shape = (100, 16, 2)
+    vals = (rng.normal(size=shape) + 1j * rng.normal(size=shape))
+    first = buffers.power_products(vals)
+    assert np.all(first == direct_power(vals))
+    # without release, a new output array is needed.
+    second = buffers.power_products(vals[::-1])
+    assert second is not first
+    buffers.release([first])
+    third = buffers.power_products(vals[::-1])
+    assert third is first and np.all(third == second)
+    # arrays of the wrong shape are not reused.
+    buffers.release([second])
+    assert buffers.power_products(vals[:10]).shape == (10, 16, 4)
+
+
+def test_waterfall_power():
+    # with large dispersion delays, the output should only cover the bins
+    # of one block, yet give the same waterfall as a direct sum.
+    rng = np.random.RandomState(1)
+    nwsize, nchan, ntime, ntw = 40, 8, 16, 4
+    ifreq = np.arange(nchan)[::-1]
+    waterfall = np.zeros((nwsize, nchan, 1))
+    expected = np.zeros((nwsize, nchan, 1))
+    for j in range(10):
+        t = (np.arange(j * ntime, (j + 1) * ntime)[:, np.newaxis] -
+             7 * np.arange(nchan) + 30)
+        iw = t // ntw
+        power = rng.uniform(size=(ntime, nchan, 1))
+        iwmin, wf_sum = waterfall_power(power, iw, nwsize, ifreq)
+        assert len(wf_sum) <= ntime // ntw + 1
+        add_waterfall(waterfall, iwmin, wf_sum)
+        iw = np.clip(iw, 0, nwsize - 1)
+        for ichan, chan in enumerate(ifreq):
+            np.add.at(expected[:, ichan], iw[:, chan], power[:, chan])
+    assert np.allclose(waterfall, expected)
+
+
+if __name__ == '__main__':
+    test_power_products()
+    test_power_buffers()
+    test_waterfall_power()
+    print("All kernel checks passed.")
@@ -0,0 +1,62 @@
+"""Check interpolated phases against the phase predictor at random times."""
+from __future__ import division, print_function
+
+import numpy as np
+from numpy.polynomial import Polynomial
+
+from .phases import InterpolatedPhase
+
+NGATE = 8
+# with large higher-order terms, so that a block needs several segments.
+PHASEPOL = Polynomial([0.3, 100., 5., 3., 2., 1., 0.5])
+
+
+class PlainPhase(object):
+    """Phase predictor without a deriv method, like polyco wrappers."""
+    def __init__(self, polynomial):
+        self.polynomial = polynomial
+
+    def __call__(self, t):
+        return self.polynomial(t)
+
+
+def check_random_times(phasepol, seed):
+    rng = np.random.RandomState(seed)
+    interpolated = InterpolatedPhase(phasepol, NGATE)
+    assert interpolated.tolerance == 0.01 / NGATE
+    offsets = rng.uniform(0., 0.1, size=5)
+    for start in (0., 1., 2.):
+        t = np.sort(rng.uniform(start, start + 1., size=1000))
+        phase = interpolated.offset_phases(t, offsets)
+        expected = PHASEPOL(t[:, np.newaxis] - offsets)
+        assert np.abs(phase - expected).max() <= interpolated.tolerance
+    assert interpolated.nsegment > 1
+
+
+def test_polynomial():
+    check_random_times(PHASEPOL, 1)
+
+
+def test_plain_callable():
+    check_random_times(PlainPhase(PHASEPOL), 2)
+
+
+def test_error_is_upper_limit():
+    # a single segment, with tolerance such that it is not split.
+    rng = np.random.RandomState(3)
+    t = np.sort(rng.uniform(0., 1., size=1000))
+    offsets = np.array([0., 0.05])
+    for phasepol in (PHASEPOL, PlainPhase(PHASEPOL)):
+        interpolated = InterpolatedPhase(phasepol, NGATE, tolerance=np.inf)
+        edges = np.array([0, len(t)])
+        error = interpolated.coefficients(t, offsets, edges)[2]
+        phase = interpolated.offset_phases(t, offsets)
+        actual = np.abs(phase - PHASEPOL(t[:, np.newaxis] - offsets)).max()
+        assert actual <= error < 10. * actual
+
+
+if __name__ == '__main__':
+    test_polynomial()
+    test_plain_callable()
+    test_error_is_upper_limit()
+    print("All phase checks passed.")
@@ -0,0 +1,81 @@
+"""Check that RFI excision zaps interference, but not Gaussian noise."""
+from __future__ import division, print_function
+
+import numpy as np
+import astropy.units as u
+
+from .fold import fold
+from .kernels import power_products
+from .rfi import RFIExcision
+from .test_fold import (NCHAN, NT, NTINT, SyntheticReader, setup,
+                        reference_fold)
+
+NTIME = 4096
+
+
+def noise_power(seed=1):
+    """Power of complex Gaussian voltages, shape (NTIME, NCHAN, 1)."""
+    rng = np.random.RandomState(seed)
+    shape = (NTIME, NCHAN, 1)
+    return np.abs(rng.normal(size=shape) + 1j * rng.normal(size=shape))**2
+
+
+def test_noise_not_flagged():
+    for seed in (1, 2, 3):
+        power, ok = RFIExcision()(noise_power(seed))
+        assert ok.all()
+        power, ok = RFIExcision(mad_threshold=8.)(noise_power(seed))
+        assert ok.all()
+
+
+def test_narrow_band_tone():
+    rng = np.random.RandomState(6)
+    shape = (NTIME, NCHAN, 1)
+    vals = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    # a steady tone, much stronger than the noise, in channel 5.
+    vals[:, 5, 0] += 10. * np.exp(2j * np.pi * 0.01 * np.arange(NTIME))
+    power, ok = RFIExcision()(np.abs(vals)**2)
+    assert not ok[:, 5].any()
+    assert ok[:, np.arange(NCHAN) != 5].all()
+    assert np.all(power[:, 5] == 0.)
+
+
+def test_broad_band_burst():
+    power = noise_power(5)
+    burst = slice(1000, 1010)
+    power[burst] *= 20.
+    power, ok = RFIExcision(nsk=None, mad_threshold=8.)(power)
+    assert not ok[burst].any()
+    assert np.count_nonzero(~ok) == 10 * NCHAN
+    assert np.all(power[burst] == 0.)
+
+
+def test_fold_excludes_zapped():
+    fh = SyntheticReader(NCHAN, NTINT)
+    t = np.arange(len(fh.data))
+    fh.data[:, 3] += 10. * np.exp(2j * np.pi * 0.01 * t)
+    kwargs, t, dtsample, freq, power = setup(fh, 1.e-2 * u.pc / u.cm**3,
+                                             'incoherent')
+    # for few samples, a lower threshold is needed to catch the tone.
+    rfi_excision = RFIExcision(nsk=NTINT, sk_threshold=3.)
+    foldspec, icount, waterfall = fold(fh, None, rfi_excision=rfi_excision,
+                                       **kwargs)
+    # flag block by block, as fold does.
+    for block in range(NT):
+        rows = slice(block * NTINT, (block + 1) * NTINT)
+        ok = rfi_excision(power_products(fh.data[rows, :, np.newaxis]))[1]
+        power[rows][~ok] = 0.
+    assert np.all(power[:, 3] == 0.)
+    ref_foldspec, ref_icount, ref_waterfall = reference_fold(
+        t, dtsample, freq, power, kwargs['phasepol'])
+    assert np.all(icount == ref_icount)
+    assert icount.sum() == np.count_nonzero(power)
+    assert np.allclose(foldspec, ref_foldspec, rtol=1.e-5)
+
+
+if __name__ == '__main__':
+    test_noise_not_flagged()
+    test_narrow_band_tone()
+    test_broad_band_burst()
+    test_fold_excludes_zapped()
+    print("All RFI checks passed.")
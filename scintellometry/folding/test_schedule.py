@@ -0,0 +1,79 @@
+"""Check that dynamic scheduling gives the same results as static.
+
+Uses processes on this machine (see ``parallel``), so MPI is not needed.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+import astropy.units as u
+
+from .parallel import LocalComm, LocalCounter, spawn, fold_processes
+from .schedule import static_range, dynamic_blocks, check_coverage
+from .test_fold import NCHAN, NT, NTINT, SyntheticReader, setup
+
+NPROCS = 3
+
+
+def test_dynamic_blocks():
+    for chunk in (1, 3, NT):
+        blocks = list(dynamic_blocks(LocalCounter(), NT, chunk))
+        assert blocks == list(range(NT))
+    covered = []
+    for rank in range(NPROCS):
+        covered.extend(range(*static_range(NT, rank, NPROCS)))
+    assert covered == list(range(NT))
+
+
+def test_dynamic_equals_static():
+    for nchan, dedisperse in ((1, 'incoherent'), (1, 'coherent'),
+                              (NCHAN, 'by-channel')):
+        dm = (1.e-4 if nchan == 1 else 1.e-2) * u.pc / u.cm**3
+        kwargs = setup(SyntheticReader(nchan, NTINT), dm, dedisperse)[0]
+
+        def open_fh():
+            return SyntheticReader(nchan, NTINT)
+
+        static = fold_processes(open_fh, NPROCS, **kwargs)
+        for chunk in (None, 1, 3):
+            dynamic = fold_processes(open_fh, NPROCS, schedule='dynamic',
+                                     chunk_blocks=chunk, **kwargs)
+            foldspec, icount, waterfall = dynamic
+            assert np.all(icount == static[1])
+            # sums are done in a different order.
+            assert np.allclose(foldspec, static[0], rtol=1.e-5)
+            assert np.allclose(waterfall, static[2], rtol=1.e-5)
+
+
+def test_check_coverage():
+    folded = np.ones(NT, dtype=np.int32)
+    folded[5] = 0
+    # this prints a warning about block 5.
+    total = check_coverage(LocalComm(), folded, verbose=True)
+    assert np.all(total == folded) and np.flatnonzero(total == 0) == [5]
+    # a block not folded since it was to be skipped is fine as well.
+    skip_blocks = np.zeros(NT, dtype=bool)
+    skip_blocks[5] = True
+    assert np.all(check_coverage(LocalComm(), folded, skip_blocks) == folded)
+
+
+def test_check_coverage_duplicate():
+    def fold_block_zero(comm):
+        folded = np.zeros(NT, dtype=np.int32)
+        folded[0] = 1
+        check_coverage(comm, folded)
+
+    try:
+        # rank 0 raises, which spawn reports.
+        spawn(fold_block_zero, NPROCS)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("Block folded by all ranks was not caught.")
+
+
+if __name__ == '__main__':
+    test_dynamic_blocks()
+    test_dynamic_equals_static()
+    test_check_coverage()
+    test_check_coverage_duplicate()
+    print("All scheduling checks passed.")
@@ -0,0 +1,332 @@
+"""Choose block sizes and channelization for fold by benchmarking.
+
+How fast fold gets through the data depends mostly on the FFTs done for
+each block, whose speed depends strongly on their shapes (lengths with
+large prime factors are slow), while the memory needed depends on the
+block size, the number of channels and, for coherent or by-channel
+dedispersion, the chirps.  Conversely, the dispersion smearing constrains
+the choice: with incoherent dedispersion, channels should be narrow enough
+that the smearing within them does not dominate the time resolution, and
+with coherent or by-channel dedispersion, blocks should be long compared
+to the dispersion sweep, since the chirp wraps around the block edges.
+
+`tune` enumerates candidate block sizes and numbers of channels that meet
+these constraints for a given reader, estimates their memory footprint,
+benchmarks the transforms for those within the memory budget on the
+local machine, and returns them ranked by throughput.
+"""
+from __future__ import division, print_function
+
+import time
+
+import numpy as np
+import astropy.units as u
+
+from .chirp import dispersion_delay_constant
+from ..fftengine import fft, ifft, rfft, irfft
+
+# Blocks should be at least this many times longer than the dispersion
+# sweep that is coherently corrected, to limit the part wrapped around.
+MIN_SWEEP_FRACTION = 2.
+# Bytes per element of the arrays used in channelizing.
+COMPLEX_SIZE = np.dtype(np.complex64).itemsize
+POWER_SIZE = np.dtype(np.float32).itemsize
+
+
+def dispersion_sweep(dm, f_lo, f_hi):
+    """Delay between the two frequencies due to dispersion."""
+    return (dispersion_delay_constant * dm *
+            (1. / f_lo**2 - 1. / f_hi**2)).to(u.s)
+
+
+def band(fh):
+    """Lowest frequency and bandwidth of the data in a reader."""
+    if fh.nchan == 1:
+        bandwidth = fh.samplerate / 2.
+        f_lo = fh.fedge - bandwidth if fh.fedge_at_top else fh.fedge
+    else:
+        bandwidth = fh.nchan / fh.dtsample
+        f_lo = fh.frequencies.min() - 0.5 / fh.dtsample
+    return f_lo.to(u.MHz), bandwidth.to(u.MHz)
+
+
+def block_sizes(fh, min_factor=1/16., max_factor=16):
+    """Block sizes that a reader can use, around its current one.
+
+    Readers of frame-based formats (with a ``framesize`` attribute) can
+    read any number of frames at a time, and get powers of two times the
+    number of frames in their current block size.  For others, the block
+    size reflects how the data are stored, and cannot be changed.
+    """
+    framesize = getattr(fh, 'framesize', None)
+    if framesize is None:
+        return [fh.blocksize]
+    nframe = max(fh.blocksize // framesize, 1)
+    sizes = []
+    factor = 2**int(np.floor(np.log2(min_factor)))
+    while factor <= max_factor:
+        n = int(nframe * factor)
+        if n >= 1 and n * framesize not in sizes:
+            sizes.append(n * framesize)
+        factor *= 2
+    return [size for size in sizes if size % fh.recordsize == 0]
+
+
+def channel_numbers(fh, dedisperse, nchan=None, max_nchan=2**14):
+    """Numbers of channels to try.
+
+    For unchannelized data, powers of two from 16 up to max_nchan, for
+    channelized data multiples of the input number of channels (for
+    incoherent or by-channel dedispersion, which can oversample).
+    """
+    if nchan is not None:
+        return [nchan]
+    if fh.nchan == 1:
+        return [2**i for i in range(4, int(np.log2(max_nchan)) + 1)]
+    if dedisperse in ('incoherent', 'by-channel'):
+        return [fh.nchan * 2**i for i in range(5)
+                if fh.nchan * 2**i <= max_nchan]
+    return [fh.nchan]
+
+
+def memory_footprint(nfine, blocksize, npol, ndm, dedisperse,
+                     nblock_in_flight=1, accumulators=0):
+    """Estimate of the memory used by fold, in bytes.
+
+    Parameters
+    ----------
+    nfine : int
+        Number of complex samples per polarisation in a channelized block.
+    blocksize : int
+        Bytes of raw data per block.
+    npol : int
+        Number of polarisations.
+    ndm : int
+        Number of dispersion measures.
+    dedisperse : str or None
+        Type of dedispersion (chirps are needed for coherent and
+        by-channel).
+    nblock_in_flight : int
+        Number of blocks processed concurrently.
+    accumulators : int
+        Bytes needed for the folded spectra, counts and waterfall.
+    """
+    npow = npol**2
+    # raw data, channelized data and fine channels (with a copy for all
+    # but the last dispersion measure), and the powers.
+    per_block = (blocksize + 3 * COMPLEX_SIZE * nfine * npol +
+                 POWER_SIZE * nfine * npow * max(ndm, 1))
+    chirps = (COMPLEX_SIZE * nfine * ndm
+              if dedisperse in ('coherent', 'by-channel') else 0)
+    return per_block * nblock_in_flight + chirps + accumulators
+
+
+def time_block(nchan_in, nchan, ntint, npol, complex_data, dedisperse,
+               repeat=3):
+    """Time the transforms done by fold for one block, in seconds.
+
+    Random data with the shape of a block are channelized (and, for
+    coherent and by-channel dedispersion, transformed to fine channels,
+    multiplied with a dummy chirp, and transformed back) and detected,
+    using the same FFT engine as fold.  The fastest of repeat runs is
+    returned, after a first run that sets up FFT plans.
+    """
+    rng = np.random.RandomState(0)
+    if nchan_in == 1:
+        nsamp = nchan if complex_data else 2 * nchan
+        shape = (ntint * nsamp, npol)
+    else:
+        shape = (ntint, nchan_in, npol)
+    raw = rng.normal(size=shape).astype(np.float32)
+    if complex_data:
+        raw = raw + 1j * rng.normal(size=shape).astype(np.float32)
+    forward, backward = (fft, ifft) if complex_data else (rfft, irfft)
+
+    def run():
+        if nchan_in == 1:
+            vals = raw.copy()
+            if dedisperse == 'coherent':
+                fine = forward(vals, axis=0)
+                fine *= np.complex64(1.)
+                vals = backward(fine, axis=0)
+            vals = forward(vals.reshape(-1, nsamp, npol), axis=1)
+        else:
+            vals = raw.copy()
+        if dedisperse == 'by-channel':
+            fine = fft(vals, axis=0)
+            fine *= np.complex64(1.)
+            vals = ifft(fine, axis=0)
+        return vals.real**2 + vals.imag**2
+
+    run()
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        run()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def tune(fh, dm, dedisperse='incoherent', nchan=None, blocksizes=None,
+         memory=None, nt=None, ngate=256, ntbin=1, ntw_min=1,
+         do_waterfall=True, nworkers=0, repeat=3, verbose=True):
+    """Benchmark block sizes and channelizations for folding data in fh.
+
+    Parameters
+    ----------
+    fh : file handle
+        Reader of the data to fold.
+    dm : `~astropy.units.Quantity`
+        Dispersion measure(s) to fold with.
+    dedisperse : None or str
+        Type of dedispersion, as for fold.
+    nchan : None or int
+        Number of output channels; by default, several are tried.
+    blocksizes : None or list of int
+        Block sizes (in bytes) to try; by default, those given by
+        `block_sizes`.
+    memory : None or `~astropy.units.Quantity`
+        Memory available per process; candidates needing more are not
+        benchmarked.
+    nt : None or int
+        Number of blocks folded at the current block size, used to estimate
+        the size of the waterfall (which is ignored if None).
+    ngate, ntbin : int
+        Number of phase and time bins of the folded spectra.
+    ntw_min : int
+        Minimum number of samples to combine in the waterfall.  For
+        incoherent dedispersion, it is increased to the smearing within a
+        channel, and, if needed, further to fit the memory budget.
+    do_waterfall : bool
+        Whether a waterfall is made.
+    nworkers : int
+        Number of worker threads fold will use (which each hold a block).
+    repeat : int
+        Number of times each candidate is timed.
+    verbose : bool
+        Whether to print a summary of the candidates.
+
+    Returns
+    -------
+    candidates : list of dict
+        With, for each candidate meeting the constraints, ``blocksize``,
+        ``nchan``, ``ntint``, ``ntw``, ``oversample``, ``resolution``
+        (time resolution including smearing), ``memory`` (estimated, in
+        bytes), and ``speed`` (seconds of data processed per second, or
+        None if not benchmarked since the memory budget is exceeded).
+        Ordered by decreasing speed, so the first is the recommendation.
+    """
+    dms = np.atleast_1d(dm)
+    ndm = len(dms)
+    dm_max = dms.max()
+    npol = getattr(fh, 'npol', 1)
+    complex_data = getattr(fh, 'data_is_complex', False)
+    f_lo, bandwidth = band(fh)
+    f_hi = f_lo + bandwidth
+    budget = None if memory is None else memory.to(u.byte).value
+    if blocksizes is None:
+        blocksizes = block_sizes(fh)
+    nblock_in_flight = 1 if nworkers == 0 else 2 * nworkers + 1
+
+    candidates = []
+    for nchan_out in channel_numbers(fh, dedisperse, nchan):
+        nchan_ref = nchan_out if fh.nchan == 1 else fh.nchan
+        if fh.nchan == 1 or dedisperse not in ('incoherent', 'by-channel'):
+            oversample = 1
+        else:
+            oversample = nchan_out // fh.nchan
+        dtsample = (nchan_out / bandwidth).to(u.s)
+        chan_bw = bandwidth / nchan_out
+        # smearing within the lowest channel, and, for by-channel
+        # dedispersion, that within the lowest input channel.
+        smearing = dispersion_sweep(dm_max, f_lo, f_lo + chan_bw)
+        if fh.nchan == 1:
+            sweep = dispersion_sweep(dm_max, f_lo, f_hi)
+        else:
+            sweep = dispersion_sweep(dm_max, f_lo,
+                                     f_lo + bandwidth / fh.nchan)
+        # sweep corrected coherently, and smearing left after dedispersion.
+        if dedisperse == 'coherent':
+            coherent_sweep, residual = sweep, 0. * u.s
+        elif dedisperse == 'by-channel':
+            coherent_sweep = smearing if fh.nchan == 1 else sweep
+            residual = 0. * u.s
+        elif dedisperse == 'incoherent':
+            coherent_sweep, residual = 0. * u.s, smearing
+        else:
+            coherent_sweep = 0. * u.s
+            residual = dispersion_sweep(dm_max, f_lo, f_hi)
+
+        for blocksize in blocksizes:
+            ntint = fh.ntint(nchan_ref) * blocksize // fh.blocksize
+            if ntint == 0 or ntint % oversample != 0:
+                continue
+            tblock = (ntint // oversample * dtsample).to(u.s)
+            if tblock < MIN_SWEEP_FRACTION * coherent_sweep:
+                continue
+            ntw = max(ntw_min, int(np.ceil((residual / dtsample)
+                                           .to(u.dimensionless_unscaled)
+                                           .value)))
+            nfine = ntint * nchan_ref
+            npow = npol**2
+            foldspec_size = ndm * ntbin * nchan_out * ngate * (npow + 1) * 4
+            nsample = (None if nt is None else
+                       nt * fh.blocksize // blocksize * ntint // oversample)
+            while True:
+                if do_waterfall and nsample is not None:
+                    waterfall_size = (ndm * (nsample // ntw) * nchan_out *
+                                      npow * 8)
+                else:
+                    waterfall_size = 0
+                need = memory_footprint(nfine, blocksize, npol, ndm,
+                                        dedisperse, nblock_in_flight,
+                                        foldspec_size + waterfall_size)
+                if (budget is None or need <= budget or
+                        waterfall_size == 0 or
+                        ntw * 2 > nsample):
+                    break
+                ntw *= 2
+
+            candidate = dict(blocksize=blocksize, nchan=nchan_out,
+                             ntint=ntint, ntw=ntw, oversample=oversample,
+                             resolution=np.hypot(dtsample * ntw, residual),
+                             memory=need, speed=None)
+            if budget is None or need <= budget:
+                seconds = time_block(fh.nchan, nchan_out, ntint, npol,
+                                     complex_data, dedisperse, repeat)
+                candidate['speed'] = tblock.value / max(seconds, 1.e-9)
+            candidates.append(candidate)
+
+    if dedisperse in ('incoherent', None) and nchan is None and candidates:
+        # only keep channelizations within a factor of two of the best
+        # possible time resolution.
+        best = min(candidate['resolution'] for candidate in candidates)
+        candidates = [candidate for candidate in candidates
+                      if candidate['resolution'] <= 2. * best]
+
+    candidates.sort(key=lambda candidate: -(candidate['speed'] or -1.))
+    if verbose:
+        if candidates:
+            print(format_candidates(candidates))
+        else:
+            print("No block size is long enough compared to the dispersion "
+                  "sweep of {0}.".format(coherent_sweep))
+    return candidates
+
+
+def format_candidates(candidates):
+    """Summarize candidates from `tune` as a table."""
+    lines = ['{0:>12s} {1:>6s} {2:>9s} {3:>6s} {4:>12s} {5:>10s} {6:>9s}'
+             .format('blocksize', 'nchan', 'ntint', 'ntw', 'resolution',
+                     'memory', 'speed')]
+    for candidate in candidates:
+        speed = candidate['speed']
+        lines.append('{0:12d} {1:6d} {2:9d} {3:6d} {4:12.3e} {5:8.1f}MB '
+                     '{6:>9s}'.format(
+                         candidate['blocksize'], candidate['nchan'],
+                         candidate['ntint'], candidate['ntw'],
+                         candidate['resolution'].to(u.s).value,
+                         candidate['memory'] / 2.**20,
+                         'n/a' if speed is None
+                         else '{0:.2f}x'.format(speed)))
+    return '\n'.join(lines)
@@ -23,7 +23,14 @@ class AROdata(MultiFile):
 
     def __init__(self, sequence_file, raw_voltage_files, blocksize=2**25,
                  dtype='4bit', samplerate=200.*u.MHz,
-                 utc_offset=-4.*u.hr, time_offset=0.0*u.s, comm=None):
+                 utc_offset=-4.*u.hr, time_offset=0.0*u.s, prefetch=0,
+                 comm=None):
+        """ARO data, stored in blocks spread over several raw_voltage files.
+
+        If prefetch > 0, blocks are read concurrently from the different
+        files (typically on separate disks), reading up to prefetch blocks
+        ahead of the one requested.
+        """
 
         self.sequence_file = sequence_file
         seq, indices = np.loadtxt(sequence_file, np.int32, unpack=True)
@@ -52,6 +59,8 @@ class AROdata(MultiFile):
 
         super(AROdata, self).__init__(raw_voltage_files, blocksize, dtype, 1,
                                       comm=comm)
+        if prefetch:
+            self.enable_striped_reads(prefetch)
         # update headers for fun
         self['PRIMARY'].header['DATE-OBS'] = self.time0.iso
         self[0].header.update('TBIN', (1./samplerate).to('s').value),
@@ -7,7 +7,6 @@
 
 from __future__ import division
 import io
-import os
 
 import numpy as np
 from numpy.fft import fftfreq, fftshift
@@ -19,27 +18,21 @@ from . import SequentialFile, header_defaults
 from ..ppf import pfb
 from baseband import vdif
 
-try:
-    from pyfftw.interfaces.numpy_fft import rfft, irfft
-    _fftargs = {'threads': int(os.environ.get('OMP_NUM_THREADS', 2)),
-                'planner_effort': 'FFTW_ESTIMATE',
-                'overwrite_input': True}
-    _rfftargs = _fftargs
-except:
-    from numpy.fft import rfft, irfft
-    print('pyfftw not installed, resorting to numpy fft. This will be less memory efficient')
-    _fftargs = {'overwrite_x': True}
-    _rfftargs = {}
+from ..fftengine import rfft, irfft
 
 class AROCHIMEData(SequentialFile):
 
     telescope = 'arochime'
 
     def __init__(self, raw_files, blocksize, samplerate, fedge, fedge_at_top,
-                 time_offset=0.0*u.s, dtype='cu4bit,cu4bit', comm=None):
+                 time_offset=0.0*u.s, dtype='cu4bit,cu4bit', comm=None,
+                 channels=None):
         """ARO data aqcuired with a CHIME correlator containts 1024 channels
         over the 400MHz BW, 2 polarizations, and 2 unsigned 8-byte ints for
         real and imaginary for each timestamp.
+
+        If channels is given, only those are decoded and returned
+        (see ``select_channels``).
         """
         self.meta = eval(open(raw_files[0] + '.meta').read())
         nchan = self.meta['nfreq']
@@ -69,6 +62,8 @@ class AROCHIMEData(SequentialFile):
 
         super(AROCHIMEData, self).__init__(raw_files, blocksize, dtype, nchan,
                                            comm=comm)
+        if channels is not None:
+            self.select_channels(channels)
 
 
 class ARORawFile(object):
@@ -119,12 +114,16 @@ class AROCHIMERawData(SequentialFile):
     telescope = 'arochime-raw'
 
     def __init__(self, raw_files, blocksize, samplerate, fedge, fedge_at_top,
-                 time_offset=0.0*u.s, dtype='cu4bit,cu4bit', comm=None):
+                 time_offset=0.0*u.s, dtype='cu4bit,cu4bit', comm=None,
+                 channels=None):
         """ARO data acquired with a CHIME correlator, but not passed through
         the decode_stream script.
 
         Header has 58 bytes, data typically 4*1024*2=8192, hence total is
         8250.  Files seem to typically have 8192 of these packets.
+
+        If channels is given, only those are decoded and returned
+        (see ``select_channels``).
         """
         header = np.fromfile(raw_files[0], dtype=header_dtype, count=1)[0]
         assert header['valid']
@@ -165,6 +164,8 @@ class AROCHIMERawData(SequentialFile):
         # fake a filesize that would be correct without headers
         self.filesize = (self.filesize * self.data_size //
                          (self.data_size + header_dtype.itemsize))
+        if channels is not None:
+            self.select_channels(channels)
 
     def open(self, number=0):
         """Open a new file in the sequence.
@@ -347,20 +348,20 @@ class AROCHIMEInvPFB(SequentialFile):
         nyq_pad = np.zeros((raw.shape[0], 1, self.npol), dtype=raw.dtype)
         raw = np.concatenate((raw, nyq_pad), axis=1)
         # Get pseudo-timestream
-        pd = irfft(raw, axis=1, **_rfftargs)
+        pd = irfft(raw, axis=1)
         # Set up for deconvolution
-        fpd = rfft(pd, axis=0, **_rfftargs)
+        fpd = rfft(pd, axis=0)
         del pd
         if self.fh is None or self.fh.shape[0] != fpd.shape[0]:
             lh = np.zeros((raw.shape[0], self.h.shape[1]))
             lh[:self.h.shape[0]] = self.h
-            self.fh = rfft(lh, axis=0, **_rfftargs).conj()
+            self.fh = rfft(lh, axis=0).conj()
             del lh
         # FT of Wiener deconvolution kernel
         fg = self.fh.conj() / (np.abs(self.fh)**2 + (1/self.sn)**2)
         # Deconvolve and get deconvolved timestream
         rd = irfft(fpd * fg[..., np.newaxis],
-                          axis=0, **_rfftargs).reshape(-1, self.npol)
+                          axis=0).reshape(-1, self.npol)
         # select actual part requested
         self.offset = offset + size
         # view as a record array
@@ -21,8 +21,13 @@ class DADAData(SequentialFile):
 
     telescope = 'dada'
 
-    def __init__(self, raw_files, blocksize, time_offset=0.0*u.s, comm=None):
-        """Pulsar data stored in the DADA format"""
+    def __init__(self, raw_files, blocksize, time_offset=0.0*u.s, comm=None,
+                 channels=None):
+        """Pulsar data stored in the DADA format
+
+        If channels is given, only those are decoded and returned
+        (see ``select_channels``).
+        """
 
         header = read_header(raw_files[0])
         if header['NBIT'] != 8:
@@ -68,6 +73,8 @@ class DADAData(SequentialFile):
             raise ValueError("File size is not equal to file size given in "
                              "header")
         self['SUBINT'].header.update(header)
+        if channels is not None:
+            self.select_channels(channels)
 
     def __str__(self):
         return ('<DADAData nchan={0} dtype={1} blocksize={2}\n'
@@ -11,12 +11,13 @@ import warnings
 
 from astropy import units as u
 from astropy.time import Time
-from .fromfile import fromfile
+from .fromfile import fromfile, decode
 try:
     from mpi4py import MPI
 except ImportError:
     pass
 from .psrfits_tools import psrFITS
+from .striped import StripedReader
 
 
 # size in bytes of records read from file (simple for ARO: 1 byte/sample)
@@ -34,6 +35,11 @@ header_defaults = {}
 
 class MultiFile(psrFITS):
 
+    # set by enable_striped_reads
+    striped = None
+    # set by select_channels
+    channels = None
+
     def __init__(self, files=None, blocksize=None, dtype=None, nchan=None,
                  comm=None):
         if comm is None:
@@ -70,15 +76,88 @@ class MultiFile(psrFITS):
         self.offset = 0
 
     def close(self):
+        if self.striped is not None:
+            self.striped.close()
+            self.striped = None
         for fh in self.fh_raw:
             fh.close()
 
+    def enable_striped_reads(self, nahead=None):
+        """Read blocks stored in different files concurrently.
+
+        Starts a reader thread for each underlying file, which reads ahead
+        up to nahead blocks (default: number of files), such that the
+        aggregate bandwidth of disks holding the files can be used.
+        Per-file statistics are available via ``self.striped.stats()``.
+        """
+        if self.striped is not None:
+            self.striped.close()
+        self.striped = StripedReader([fh.name for fh in self.fh_raw],
+                                     self.indices, self.blocksize, nahead)
+
+    def select_channels(self, channels):
+        """Only decode and return data for the given channels.
+
+        Parameters
+        ----------
+        channels : slice, array of int, or Quantity
+            Channels to keep.  If a Quantity, it should hold the lower and
+            upper frequency of the band to keep.
+
+        Notes
+        -----
+        Offsets and sizes passed to seek and read still refer to the full
+        data stream (i.e., blocksize and recordsize are unchanged), but
+        ``record_read`` only returns the selected channels, and ``nchan``
+        and ``frequencies`` are updated to match.
+        """
+        if self.itemsize != int(self.itemsize):
+            raise ValueError("Cannot select channels for dtype {0} with "
+                             "fractional number of bytes per sample."
+                             .format(self.dtype))
+        channels = self._channel_indices(channels)
+        self.nchan_raw = self.nchan
+        self.nchan = len(channels)
+        self.frequencies = self.frequencies[channels]
+        # contiguous ranges can be taken with a strided view of each record.
+        if np.all(np.diff(channels) == 1):
+            self.channels = slice(channels[0], channels[-1] + 1)
+        else:
+            self.channels = channels
+
+    def _channel_indices(self, channels):
+        """Convert a channel selection to sorted indices."""
+        if self.channels is not None:
+            raise ValueError("Channels have already been selected.")
+        if isinstance(channels, u.Quantity):
+            flow, fhigh = channels.to(self.frequencies.unit)
+            channels = np.nonzero((self.frequencies >= flow) &
+                                  (self.frequencies <= fhigh))[0]
+        else:
+            channels = np.unique(np.arange(self.nchan)[channels])
+        if len(channels) == 0:
+            raise ValueError("No channels selected.")
+        return channels
+
+    def _select(self, raw):
+        """Extract the selected channels from raw data.
+
+        Works for raw data with any item size (e.g., bytes, or floats
+        for already decompressed data), as long as the data for a given
+        channel are contiguous within a record.
+        """
+        nrecord = raw.nbytes // self.recordsize
+        raw = raw.reshape(nrecord, self.nchan_raw, -1)[:, self.channels]
+        return np.ascontiguousarray(raw).ravel()
+
     def read(self, size):
         """Read size bytes, returning an ndarray with np.int8 dtype.
 
         Incorporate information from multiple underlying files if necessary.
         The individual file pointers are assumed to be pointing at the right
-        locations, i.e., just before data that will be read here.
+        locations, i.e., just before data that will be read here (unless
+        striped reads are enabled, in which case blocks are taken from the
+        concurrent reader).
         """
         if size % self.recordsize != 0:
             raise ValueError("Cannot read a non-integer number of records")
@@ -97,7 +176,10 @@ class MultiFile(psrFITS):
             block, already_read = divmod(self.offset, self.blocksize)
             fh_size = min(size - iz, self.blocksize - already_read)
             fh_index = self.indices[block]
-            if fh_index >= 0:
+            if self.striped is not None:
+                z[iz:iz+fh_size] = self.striped.read_block(block)[
+                    already_read:already_read+fh_size]
+            elif fh_index >= 0:
                 z[iz:iz+fh_size] = np.fromstring(self.fh_raw[fh_index]
                                                  .read(fh_size), dtype=z.dtype)
             else:
@@ -186,8 +268,16 @@ class MultiFile(psrFITS):
         return self.record_read(count)
 
     def record_read(self, count):
-        return fromfile(self, self.dtype,
-                        count).reshape(-1, self.nchan).squeeze()
+        if self.channels is None:
+            return fromfile(self, self.dtype,
+                            count).reshape(-1, self.nchan).squeeze()
+        # only decode the selected channels
+        raw = self.read(count)
+        if raw.nbytes != count:
+            raise EOFError('In record_read, got {0} bytes, expected {1}'
+                           .format(raw.nbytes, count))
+        raw = self._select(raw)
+        return decode(raw, self.dtype).reshape(-1, self.nchan).squeeze()
 
     def nskip(self, date, time0=None):
         """
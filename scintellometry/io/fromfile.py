@@ -35,13 +35,24 @@ def fromfile(file, dtype, count, verbose=False):
         print("Reading {} units of dtype={}".format(count, np_dtype))
     # go via direct read to ensure we can read from gzip'd files
     raw = file.read(count)
-    # but MultiFile returns 1-byte ndarray; viewing much faster than fromstring
+    return decode(raw, dtype, count)
+
+
+def decode(raw, dtype, count=None):
+    """Interpret raw data read from file as dtype, which can be bits.
+
+    See ``fromfile`` for the special dtypes.  If count is given, check that
+    the raw data indeed contained that number of bytes.
+    """
+    np_dtype = NP_DTYPES.get(dtype, dtype)
+    # MultiFile returns 1-byte ndarray; viewing much faster than fromstring
     try:
         raw = raw.view(dtype=np_dtype)
     except:
         raw = np.fromstring(raw, dtype=np_dtype)
 
-    if raw.shape[0] != count // np.dtype(np_dtype).itemsize:
+    if (count is not None and
+            raw.shape[0] != count // np.dtype(np_dtype).itemsize):
         raise EOFError('In fromfile, got {0} items, expected {1}'
                        .format(raw.shape[0],
                                count // np.dtype(np_dtype).itemsize))
@@ -50,11 +50,15 @@ class GMRTPhasedData(GMRTBase):
 
     def __init__(self, timestamp_file, raw_files, blocksize, nchan,
                  samplerate, fedge, fedge_at_top, dtype='ci1',
-                 utc_offset=5.5*u.hr, time_offset=0.0*u.s, comm=None):
+                 utc_offset=5.5*u.hr, time_offset=0.0*u.s, comm=None,
+                 channels=None):
         """GMRT phased data stored in blocks holding 0.25 s worth of data,
         separated over two streams (each with 0.125s).  For 16MHz BW, each
         block is 4 MiB with 2Mi complex samples split in 256 or 512 channels.
         Complex samples consist of two signed ints (custom 'ci1' dtype).
+
+        If channels is given, only those are decoded and returned
+        (see ``select_channels``).
         """
         self.timestamp_file = timestamp_file
         (self.indices, self.timestamps,
@@ -66,6 +70,8 @@ class GMRTPhasedData(GMRTBase):
         super(GMRTPhasedData, self).__init__(raw_files, blocksize, nchan,
                                              samplerate, fedge, fedge_at_top,
                                              dtype, comm)
+        if channels is not None:
+            self.select_channels(channels)
 
 
 class GMRTRawDumpData(GMRTBase):
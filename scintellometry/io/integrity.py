@@ -0,0 +1,343 @@
+"""Scan raw baseband files for gaps and invalid data.
+
+The main routine is ``scan``, which, for an opened reader, checks all
+frame/packet headers (or block indices) in bulk and returns a gap map: a
+Table of contiguous segments in the byte stream the reader provides, with
+for each whether its data are valid, and how many frames were lost (i.e.,
+are missing from the files altogether) just before it.  With ``bad_blocks``
+this can be turned into a list of blocks to be skipped by ``fold``.
+
+Command line usage (from a directory with an observations.conf):
+  python -m scintellometry.io.integrity -t <telescope> -d <observation>
+"""
+from __future__ import division, print_function
+
+import argparse
+import os
+
+import numpy as np
+from astropy.table import Table
+import astropy.units as u
+
+
+def scan(fh):
+    """Create a gap and validity map for the data opened in reader fh.
+
+    Parameters
+    ----------
+    fh : reader instance
+        Any of AROdata, GMRTPhasedData, GMRTRawDumpData, VDIFData,
+        Mark4Data, Mark5BData, DADAData, AROCHIMERawData (or the inverse
+        PFB readers built on the latter).
+
+    Returns
+    -------
+    gapmap : `~astropy.table.Table`
+        With columns 'start', 'stop' (byte offsets in the reader's stream),
+        'tstart', 'tstop' (seconds since the start of the observation),
+        'nframe' (number of frames, packets, or blocks in the segment),
+        'valid', and 'lost' (frames missing just before the segment).
+    """
+    telescope = fh.telescope
+    if telescope.endswith('invpfb'):
+        fh = fh.fh_raw
+        telescope = fh.telescope
+    try:
+        scanner = SCANNERS[telescope]
+    except KeyError:
+        raise ValueError("Cannot scan data of telescope {0}"
+                         .format(telescope))
+    unit_size, valid, lost = scanner(fh)
+    gapmap = collapse(unit_size, valid, lost)
+    gapmap.meta['telescope'] = telescope
+    recordsize = getattr(fh, 'recordsize', 1)
+    dtsample = fh.dtsample.to(u.s).value
+    gapmap['tstart'] = gapmap['start'] / recordsize * dtsample
+    gapmap['tstop'] = gapmap['stop'] / recordsize * dtsample
+    return gapmap
+
+
+def collapse(unit_size, valid, lost):
+    """Combine per-frame validity and losses into contiguous segments.
+
+    A new segment is started wherever validity changes, or frames were lost.
+    """
+    valid = np.asarray(valid, dtype=bool)
+    lost = np.asarray(lost, dtype=np.int64)
+    if len(valid) == 0:
+        return Table(names=['start', 'stop', 'nframe', 'valid', 'lost'],
+                     dtype=[np.int64, np.int64, np.int64, bool, np.int64])
+    change = np.ones(len(valid), dtype=bool)
+    change[1:] = (valid[1:] != valid[:-1]) | (lost[1:] > 0)
+    first = np.nonzero(change)[0]
+    nframe = np.diff(np.append(first, len(valid)))
+    gapmap = Table([first * unit_size, (first + nframe) * unit_size,
+                    nframe, valid[first], lost[first]],
+                   names=['start', 'stop', 'nframe', 'valid', 'lost'])
+    gapmap.meta['nvalid'] = int(np.count_nonzero(valid))
+    gapmap.meta['ninvalid'] = int(len(valid) - gapmap.meta['nvalid'])
+    gapmap.meta['nlost'] = int(lost.sum())
+    return gapmap
+
+
+def bad_blocks(gapmap, blocksize, nskip=0, nt=None):
+    """Determine which blocks overlap with invalid data or losses.
+
+    Parameters
+    ----------
+    gapmap : Table
+        As returned by ``scan``.
+    blocksize : int
+        Size in bytes of the blocks that will be read.
+    nskip : int
+        Number of blocks skipped at the start (default: 0).
+    nt : int or None
+        Number of blocks to consider (default: up to the end of the map).
+
+    Returns
+    -------
+    bad : array of bool
+        True for blocks that should be skipped, counting from nskip.
+    """
+    if nt is None:
+        nt = int(-(-gapmap['stop'][-1] // blocksize)) - nskip
+    bad = np.zeros(nt, dtype=bool)
+    for segment in gapmap:
+        if segment['valid'] and segment['lost'] == 0:
+            continue
+        first = segment['start'] // blocksize - nskip
+        last = (segment['stop'] - 1) // blocksize - nskip
+        if not segment['valid']:
+            bad[max(first, 0):max(last + 1, 0)] = True
+        if segment['lost'] and 0 <= first < nt:
+            bad[first] = True
+    # ensure blocks beyond the end of the data are skipped too.
+    end = int(-(-gapmap['stop'][-1] // blocksize)) - nskip
+    bad[max(end, 0):] = True
+    return bad
+
+
+def _memmap(name, offset=0):
+    return np.memmap(name, dtype=np.uint8, mode='r', offset=offset)
+
+
+def _bcd(x):
+    """Decode binary coded decimal numbers, vectorized."""
+    x = np.asarray(x, dtype=np.int64)
+    result = np.zeros_like(x)
+    factor = 1
+    for shift in range(0, 32, 4):
+        result += ((x >> shift) & 0xf) * factor
+        factor *= 10
+    return result
+
+
+def _sequence_lost(sequence, position=None):
+    """Number of frames missing before each frame in a counter sequence.
+
+    If given, position holds where each frame would be in the sequence if
+    none were lost (e.g., its index in the file).  Counts skipped between
+    frames that are accounted for by positions skipped as well (e.g., of
+    invalid frames left out since their counters are unreliable) are then
+    not taken to be lost.
+    """
+    lost = np.zeros(len(sequence), dtype=np.int64)
+    if len(sequence) > 1:
+        step = 1 if position is None else np.diff(position)
+        lost[1:] = np.maximum(np.diff(sequence) - step, 0)
+    return lost
+
+
+def scan_indexed(fh):
+    """Blocks in files addressed via an index, as for ARO and GMRT.
+
+    Blocks with index -1 are missing, and thus invalid; so are blocks that
+    should be in a file, but lie beyond its end.
+    """
+    indices = np.asarray(fh.indices)
+    valid = indices >= 0
+    sizes = np.array([os.fstat(f.fileno()).st_size for f in fh.fh_raw])
+    for ifh, size in enumerate(sizes):
+        in_file = np.nonzero(indices == ifh)[0]
+        valid[in_file[size // fh.blocksize:]] = False
+    return fh.blocksize, valid, np.zeros(len(indices), dtype=np.int64)
+
+
+def scan_gmrt_raw(fh):
+    """GMRT raw dumps: blocks are all present, but may have time jumps."""
+    dt = np.diff(fh.timestamps.unix)
+    step = np.median(dt)
+    lost = np.zeros(len(fh.timestamps), dtype=np.int64)
+    lost[1:] = np.maximum(np.round(dt / step).astype(np.int64) - 1, 0)
+    return fh.blocksize, np.ones(len(lost), dtype=bool), lost
+
+
+def scan_vdif(fh):
+    """VDIF frame headers: check invalid flags and frame continuity.
+
+    Frames are grouped in sets of one frame per thread, corresponding to
+    the way VDIFData presents the data.
+    """
+    data = _memmap(fh.files[0])
+    nframe = len(data) // fh.framesize
+    words = (data[:nframe * fh.framesize].reshape(nframe, fh.framesize)
+             [:, :16].copy().view('<u4'))
+    invalid = (words[:, 0] >> 31) & 1 == 1
+    seconds = (words[:, 0] & 0x3fffffff).astype(np.int64)
+    frame_nr = (words[:, 1] & 0xffffff).astype(np.int64)
+    thread_id = (words[:, 3] >> 16) & 0x3ff
+    # only trust the headers of valid frames.
+    good = np.flatnonzero(~invalid)
+    lost = np.zeros(nframe, dtype=np.int64)
+    if len(good):
+        frame_rate = frame_nr[good].max() + 1
+        for thread in np.unique(thread_id[good]):
+            in_thread = good[thread_id[good] == thread]
+            # without losses, counters increase by one per set of frames.
+            lost[in_thread] = _sequence_lost(
+                seconds[in_thread] * frame_rate + frame_nr[in_thread],
+                in_thread // fh.nthread)
+    nset = nframe // fh.nthread
+    valid = ~invalid[:nset * fh.nthread].reshape(nset, -1).any(1)
+    lost = lost[:nset * fh.nthread].reshape(nset, -1).max(1)
+    return fh.payloadsize * fh.nthread, valid, lost
+
+
+def scan_mark5b(fh):
+    """Mark 5B frame headers: check sync pattern and frame continuity."""
+    from .mark5b import SYNC_PATTERN
+    valid = []
+    seconds = []
+    frame_nr = []
+    for name in fh.files:
+        data = _memmap(name)
+        nframe = len(data) // fh.framesize
+        words = (data[:nframe * fh.framesize].reshape(nframe, fh.framesize)
+                 [:, :16].copy().view('<u4'))
+        valid.append(words[:, 0] == SYNC_PATTERN)
+        seconds.append(_bcd(words[:, 2] & 0xfffff))
+        frame_nr.append((words[:, 1] & 0x7fff).astype(np.int64))
+    valid = np.hstack(valid)
+    seconds = np.hstack(seconds)
+    frame_nr = np.hstack(frame_nr)
+    # Convert to a continuous counter using the number of frames per second,
+    # using only frames with a valid header.
+    good = np.flatnonzero(valid)
+    lost = np.zeros(len(valid), dtype=np.int64)
+    if len(good):
+        frame_rate = frame_nr[good].max() + 1
+        lost[good] = _sequence_lost(seconds[good] * frame_rate +
+                                    frame_nr[good], good)
+    return fh.payloadsize, valid, lost
+
+
+def scan_mark4(fh):
+    """Mark 4 frames: check that every frame starts with a frame marker.
+
+    Times encoded in the frame headers are not checked.  The position of
+    the reader is left unchanged.
+    """
+    nmarker = fh.ntrack * 4
+    valid = []
+    # opening files to find their first frame moves the reader, so
+    # remember where it was.
+    offset, current_file_number = fh.offset, fh.current_file_number
+    try:
+        for number in range(len(fh.files)):
+            fh.open(number)
+            first_frame = fh.header_size + fh.payloadoffset
+            data = _memmap(fh.files[number])
+            nframe = (len(data) - first_frame) // fh.framesize
+            frames = data[first_frame:first_frame + nframe * fh.framesize]
+            valid.append(np.all(frames.reshape(nframe, fh.framesize)
+                                [:, :nmarker] == 0xff, axis=1))
+    finally:
+        if current_file_number is not None:
+            # also resets the header size for that file.
+            fh.open(current_file_number)
+        fh.seek(offset)
+    valid = np.hstack(valid)
+    return fh.framesize, valid, np.zeros(len(valid), dtype=np.int64)
+
+
+def scan_dada(fh):
+    """DADA files: check that each file holds the data its header claims.
+
+    Each file is divided in blocks; those beyond the end of a truncated file
+    are invalid.
+    """
+    from .dada import read_header
+    valid = []
+    for name in fh.files:
+        header = read_header(name)
+        nblock = header['FILE_SIZE'] // fh.blocksize
+        present = ((os.path.getsize(name) - header['HDR_SIZE']) //
+                   fh.blocksize)
+        valid.append(np.arange(nblock) < present)
+    valid = np.hstack(valid)
+    return fh.blocksize, valid, np.zeros(len(valid), dtype=np.int64)
+
+
+def scan_arochime_raw(fh):
+    """CHIME packets: check valid flags and sequence-number continuity."""
+    from .arochime import header_dtype
+    packet_dtype = np.dtype([('header', header_dtype),
+                             ('data', 'u1', fh.data_size)])
+    headers = np.hstack([np.memmap(name, dtype=packet_dtype, mode='r')
+                         ['header'][['valid', 'seq']] for name in fh.files])
+    valid = headers['valid'] != 0
+    seq = headers['seq'].astype(np.int64)
+    step = np.median(np.diff(seq)) if len(seq) > 1 else 1
+    lost = _sequence_lost(seq // max(int(step), 1))
+    return fh.data_size, valid, lost
+
+
+SCANNERS = {'aro': scan_indexed,
+            'gmrt': scan_indexed,
+            'gmrt-raw': scan_gmrt_raw,
+            'vdif': scan_vdif,
+            'mark5b': scan_mark5b,
+            'mark4': scan_mark4,
+            'dada': scan_dada,
+            'arochime-raw': scan_arochime_raw}
+
+
+def CL_parser():
+    parser = argparse.ArgumentParser(
+        prog='integrity.py',
+        description='Scan raw data for gaps and invalid frames.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-t', '--telescope', type=str, default='aro',
+        help="The telescope, as given in observations.conf.")
+    parser.add_argument(
+        '-d', '--date', '--observation', type=str,
+        help="The date or other identifier of the data to scan.")
+    parser.add_argument(
+        '-o', '--output', type=str, default=None,
+        help="File to write the gap map to (any astropy Table format).")
+    parser.add_argument(
+        '-a', '--all', action='store_true',
+        help="List valid segments too, not just invalid ones and losses.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from scintellometry.meta.observations import obsdata
+
+    args = CL_parser()
+    obs = obsdata()
+    obskey = args.date
+    if obskey not in obs[args.telescope]:
+        obskey = obs[args.telescope].nearest_observation(obskey)
+    with obs[args.telescope].open(obskey) as fh:
+        gapmap = scan(fh)
+    print("{0} {1}: {nvalid} valid, {ninvalid} invalid, {nlost} lost"
+          .format(args.telescope, obskey, **gapmap.meta))
+    if args.all:
+        gapmap.pprint(max_lines=-1)
+    else:
+        bad = ~gapmap['valid'] | (gapmap['lost'] > 0)
+        gapmap[bad].pprint(max_lines=-1)
+    if args.output:
+        gapmap.write(args.output)
@@ -8,6 +8,8 @@
 #
 from __future__ import division
 
+import sys
+
 import numpy as np
 
 try:
@@ -25,16 +27,20 @@ from astropy.time import Time
 
 from . import MultiFile, header_defaults
 
-# hdf5 dtype conversion
+# hdf5 dtype conversion; floats are big-endian unless the STOKES dataset
+# has a BYTE_ORDER attribute (see lofar.digitize).
 _lofar_dtypes = {'float': '>c8', 'int8': 'ci1'}
 
 
 class LOFARdata(MultiFile):
 
     telescope = 'lofar'
+    # set if float data should be converted to native byte order on reading
+    swap_bytes = False
+    _buffer = None
 
     def __init__(self, raw_files, comm=None, blocksize=2**20,
-                 refloat=True):
+                 refloat=True, channels=None):
         """
         Initialize a lofar observation, tracking/joining the two polarizations.
         We also parse the corresponding HDF5 files to initialize:
@@ -54,6 +60,8 @@ class LOFARdata(MultiFile):
             Whether to convert compressed lofar data (stored as int1) back
             to float using the associated scale factors.  If False, simply
             use the integer data, ignoring the scale factors.  Default: True
+        channels : slice, array of int, Quantity, or None
+            If given, only return these channels (see ``select_channels``).
 
         """
         self.nfh = len(raw_files)
@@ -97,6 +105,13 @@ class LOFARdata(MultiFile):
                     dtype = _lofar_dtypes[lofar_dtype]
                     # signal that no scaling is needed
                     self.scales = False
+                    if lofar_dtype == 'float':
+                        # return floats in native order, swapping bytes
+                        # on reading if needed, so that this is not done
+                        # implicitly, repeatedly, in calculations.
+                        byte_order = st0.attrs.get('BYTE_ORDER', 'big')
+                        self.swap_bytes = byte_order != sys.byteorder
+                        dtype = 'c8'
 
                 if self.npol == 2:  # two polarisations -> two complex numbers
                     dtype = dtype + ',' + dtype
@@ -143,6 +158,8 @@ class LOFARdata(MultiFile):
         # update some of the hdu data
         self['PRIMARY'].header['DATE-OBS'] = self.time0.isot
         self[0].header.update('TBIN', (1./self.samplerate).to('s').value)
+        if channels is not None:
+            self.select_channels(channels)
 
     def read(self, size):
         """
@@ -154,19 +171,27 @@ class LOFARdata(MultiFile):
         self.scale has been set (see refloat in initializer).
         """
         if not self.scales:
-            z = np.empty(size, dtype='i1').reshape(self.nfh, -1,
-                                                   self.itemsize // self.nfh)
+            # reuse the receive buffer; the interleaving below makes a copy.
+            if self._buffer is None or self._buffer.size != size:
+                self._buffer = np.empty(size, dtype='i1')
+            z = self._buffer.reshape(self.nfh, -1, self.itemsize // self.nfh)
             for fh, buf in zip(self.fh_raw, z):
                 fh.Iread([buf, MPI.BYTE])
+            if self.swap_bytes:
+                # each file holds single floats; reversing their bytes as
+                # part of the interleaving copy converts them to native.
+                z = z[..., ::-1]
         else:  # rescaling compressed integer data
+            # all channels are read, even if only some were selected.
+            nchan = self.nchan if self.channels is None else self.nchan_raw
             # offset and size in the compressed file
             read_offset = self.offset // self.itemsize
             read_size = size // self.itemsize
             # create float output array (real, imag), possibly times two
             z = np.empty(read_size * self.nfh, dtype='f4').reshape(
-                self.nfh, -1, self.nchan)
+                self.nfh, -1, nchan)
             # and a buffer to receive the compressed data
-            buf = np.empty(read_size, dtype='i1').reshape(-1, self.nchan)
+            buf = np.empty(read_size, dtype='i1').reshape(-1, nchan)
             for ifh, fh in enumerate(self.fh_raw):
                 if self.scales[ifh] is None:  # non-existing file
                     z[ifh] = 0.
@@ -183,8 +208,8 @@ class LOFARdata(MultiFile):
                     i0 = iscale * self.compressed_block_size[ifh]
                     i1 = (iscale + 1) * self.compressed_block_size[ifh]
                     # get part that overlaps with the buffer
-                    i0 = max(0, (i0 - read_offset) // self.nchan)
-                    i1 = min(buf.shape[0], (i1 - read_offset) // self.nchan)
+                    i0 = max(0, (i0 - read_offset) // nchan)
+                    i1 = min(buf.shape[0], (i1 - read_offset) // nchan)
                     # apply scales
                     z[ifh, i0:i1] = buf[i0:i1] * self.scales[ifh][iscale, :]
             z = z.reshape(self.nfh, -1, 1)
@@ -226,8 +251,12 @@ class LOFARdata_Pcombined(MultiFile):
         """
         A list of tuples, to be 'concatenated' together
         (as returned by observations.obsdata[telescope].file_list(obskey) )
+
+        If 'channels' is given, only subbands holding selected channels are
+        read (see ``select_channels``).
         """
         self.per_channel_blocksize = kwargs.pop('blocksize', 2**18)
+        channels = kwargs.pop('channels', None)
         super(LOFARdata_Pcombined, self).__init__(raw_files_list, comm=comm)
         self.fbottom = self.frequencies[0]
         self.fedge = self.frequencies[0]
@@ -236,6 +265,8 @@ class LOFARdata_Pcombined(MultiFile):
         self['PRIMARY'].header['DATE-OBS'] = self.time0.isot
         self['PRIMARY'].header.update('TBIN',
                                       (1./self.samplerate).to('s').value)
+        if channels is not None:
+            self.select_channels(channels)
         self['PRIMARY'].header.update('NCHAN', self.nchan)
 
     def open(self, raw_files_list):
@@ -266,6 +297,32 @@ class LOFARdata_Pcombined(MultiFile):
         for fh in self.fh_raw:
             fh.close()
 
+    def select_channels(self, channels):
+        """Only read the given channels.
+
+        Sets of files that do not hold any of the selected channels are
+        closed and no longer read; in the others, only the selected channels
+        are decoded.  See ``MultiFile.select_channels`` for possible values.
+        """
+        channels = self._channel_indices(channels)
+        self.nchan_raw = self.nchan
+        fh_raw = []
+        start = 0
+        for fh in self.fh_raw:
+            stop = start + fh.nchan
+            local = channels[(channels >= start) & (channels < stop)] - start
+            if len(local) == 0:
+                fh.close()
+            else:
+                if len(local) < fh.nchan:
+                    fh.select_channels(local)
+                fh_raw.append(fh)
+            start = stop
+        self.fh_raw = fh_raw
+        self.nchan = len(channels)
+        self.frequencies = self.frequencies[channels]
+        self.channels = channels
+
     def record_read(self, size):
         assert size % self.recordsize == 0
         nrecords = size // self.recordsize
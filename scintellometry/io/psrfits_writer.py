@@ -0,0 +1,233 @@
+"""Streaming writers of PSRFITS files.
+
+Building a `psrfits_tools.psrFITS` HDU list with a full SUBINT table
+requires all rows to be in memory at once.  Instead, the writers here
+write the primary and SUBINT headers (from the PSRFITS templates in
+``psrfits_tools``) when the file is opened, append each row to the file
+as soon as it is given, and only fix up the number of rows (NAXIS2) and
+the padding of the table when the file is closed.
+
+The table rows have fixed size, so each is simply written as a big-endian
+numpy record with the layout given by the column definitions.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+from .psrfits_tools import psrFITS, _coldefs
+
+BLOCKSIZE = 2880  # FITS files consist of blocks of this many bytes
+
+# PSRFITS polarisation types for the power products calculated by fold,
+# and the order in which these should be stored.  fold calculates
+# AA, Re(AB*), Im(AB*), BB for two polarisations.
+POL_TYPES = {1: ('AA+BB', [0]),
+             2: ('AABB', [0, 1]),
+             4: ('AABBCRCI', [0, 3, 1, 2])}
+
+
+class SubintWriter(object):
+    """Write a PSRFITS file with a SUBINT table row by row.
+
+    Parameters
+    ----------
+    name : str
+        Name of the file to write (an existing file is overwritten).
+    formats : dict
+        Format (and, optionally, dimension) for SUBINT columns whose size
+        depends on the data, e.g., ``{'DAT_FREQ': '256D', 'DATA':
+        ('131072I', '(512,256,1)')}``.  Columns not in the PSRFITS
+        definition are appended.
+    subint_header : dict
+        Values for keywords of the SUBINT header (e.g., NBIN, NCHAN).
+    primary_header : `~astropy.io.fits.Header` or dict, optional
+        Values for keywords of the primary header, e.g., from the
+        ``'PRIMARY'`` HDU of a file handle.
+    exclude : sequence of str
+        Names of columns in the PSRFITS definition not to include
+        (default: INDEXVAL, which is only for non-time subintegrations).
+
+    Notes
+    -----
+    Use as a context manager, or call ``close`` at the end, since until
+    then the file will claim to have zero rows.
+    """
+    def __init__(self, name, formats, subint_header, primary_header=None,
+                 exclude=('INDEXVAL',)):
+        template = psrFITS(hdus=['SUBINT'])
+        phdu = template['PRIMARY']
+        if primary_header is not None:
+            for key, value in primary_header.items():
+                if key not in ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND',
+                               'COMMENT', 'HISTORY', ''):
+                    phdu.header[key] = value
+
+        formats = dict(formats)
+        columns = []
+        for col in _coldefs['SUBINT']:
+            if col.name in exclude:
+                continue
+            fmt = formats.pop(col.name, col.format)
+            fmt, dim = fmt if isinstance(fmt, tuple) else (fmt, None)
+            columns.append(fits.Column(name=col.name, format=fmt,
+                                       unit=col.unit, dim=dim))
+        for colname, fmt in formats.items():
+            fmt, dim = fmt if isinstance(fmt, tuple) else (fmt, None)
+            columns.append(fits.Column(name=colname, format=fmt, dim=dim))
+
+        header = template['SUBINT'].header.copy()
+        for key in ('TFIELDS', 'NAXIS1'):
+            header.remove(key, ignore_missing=True)
+        hdu = fits.BinTableHDU.from_columns(fits.ColDefs(columns),
+                                            header=header, nrows=0)
+        hdu.header['EXTNAME'] = 'SUBINT'
+        for key, value in subint_header.items():
+            hdu.header[key] = value
+        self.header = hdu.header
+        # records in the order and with the sizes used in the FITS file.
+        dtypes = [np.dtype(col.format.recformat) for col in hdu.columns]
+        self.dtype = np.dtype([(col.name, dtype.base.newbyteorder('>'),
+                                dtype.shape)
+                               for col, dtype in zip(hdu.columns, dtypes)])
+        assert self.dtype.itemsize == self.header['NAXIS1']
+
+        self.name = name
+        self.nrows = 0
+        self.fh = open(name, 'wb')
+        self.fh.write(phdu.header.tostring().encode('ascii'))
+        self.offset = self.fh.tell()
+        self.fh.write(self.header.tostring().encode('ascii'))
+
+    def write_row(self, **values):
+        """Append a row, with values given for any of the columns.
+
+        Columns for which no value is given are set to zero.
+        """
+        row = np.zeros((), dtype=self.dtype)
+        for key, value in values.items():
+            row[key] = np.reshape(value, row[key].shape)
+        self.fh.write(row.tobytes())
+        self.nrows += 1
+
+    def close(self):
+        """Pad the table, and update the header with the number of rows."""
+        if self.fh.closed:
+            return
+        self.fh.write(b'\0' * (-self.fh.tell() % BLOCKSIZE))
+        self.header['NAXIS2'] = self.nrows
+        self.fh.seek(self.offset)
+        self.fh.write(self.header.tostring().encode('ascii'))
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return ("<{0} {1}: {2} rows written>"
+                .format(self.__class__.__name__, self.name, self.nrows))
+
+
+class FoldWriter(SubintWriter):
+    """Write folded spectra as a PSRFITS fold-mode file, subint by subint.
+
+    Parameters
+    ----------
+    name : str
+        Name of the file to write.
+    freq : `~astropy.units.Quantity`
+        Frequencies of the channels, in the order used in foldspec.
+    ngate : int
+        Number of phase bins.
+    npow : int
+        Number of power products (1, 2 or 4, as calculated by fold).
+    dm : `~astropy.units.Quantity`, optional
+        Dispersion measure used to dedisperse the data.
+    period : `~astropy.units.Quantity`, optional
+        Approximate pulsar period, used to set the time per bin.
+    primary_header : `~astropy.io.fits.Header` or dict, optional
+        Values for keywords of the primary header.
+    start_time : `~astropy.time.Time`, optional
+        Start of the folded data, used for the start-time keywords.
+
+    Notes
+    -----
+    The profiles are stored as 16-bit integers, using a scale and offset
+    for each channel and polarisation that map the range of the profile
+    onto the full integer range.  Channels without any samples get zero
+    weight.
+    """
+    def __init__(self, name, freq, ngate, npow, dm=None, period=None,
+                 primary_header=None, start_time=None):
+        freq = freq.to('MHz').value.ravel()
+        nchan = len(freq)
+        pol_type, self.pol_order = POL_TYPES[npow]
+        npol = len(self.pol_order)
+        chan_bw = np.abs(np.diff(freq)).mean() if nchan > 1 else 0.
+        primary = ({} if primary_header is None
+                   else dict(primary_header.items()))
+        primary.update({'OBS_MODE': 'PSR',
+                        'OBSFREQ': 0.5 * (freq.min() + freq.max()),
+                        'OBSBW': chan_bw * nchan,
+                        'OBSNCHAN': nchan})
+        if start_time is not None:
+            imjd = int(np.floor(start_time.utc.mjd))
+            seconds = (start_time - Time(imjd, format='mjd', scale='utc')
+                       ).to('s').value
+            primary.update({'DATE-OBS': start_time.utc.isot,
+                            'STT_IMJD': imjd,
+                            'STT_SMJD': int(seconds),
+                            'STT_OFFS': seconds - int(seconds)})
+        subint_header = {
+            'INT_TYPE': 'TIME', 'INT_UNIT': 'SEC', 'SCALE': 'FluxDen',
+            'POL_TYPE': pol_type, 'NPOL': npol, 'NBIN': ngate,
+            'NBIN_PRD': ngate, 'NBITS': 1, 'NCHAN': nchan,
+            'CHAN_BW': chan_bw, 'NSBLK': 1,
+            'TBIN': 0. if period is None else period.to('s').value / ngate,
+            'DM': 0. if dm is None else dm.to('pc/cm3').value}
+        formats = {'DAT_FREQ': '{0}D'.format(nchan),
+                   'DAT_WTS': '{0}E'.format(nchan),
+                   'DAT_OFFS': '{0}E'.format(nchan * npol),
+                   'DAT_SCL': '{0}E'.format(nchan * npol),
+                   'DATA': ('{0}I'.format(ngate * nchan * npol),
+                            '({0},{1},{2})'.format(ngate, nchan, npol))}
+        super(FoldWriter, self).__init__(name, formats, subint_header,
+                                         primary)
+        self.freq = freq
+
+    def write_subint(self, foldspec, icount, tsubint, offs_sub):
+        """Normalize, scale and append a subintegration.
+
+        Parameters
+        ----------
+        foldspec : array
+            Folded power, with shape (nchan, ngate) or (nchan, ngate, npow).
+        icount : array
+            Number of samples added in each bin, shape (nchan, ngate).
+        tsubint : `~astropy.units.Quantity`
+            Duration of the subintegration.
+        offs_sub : `~astropy.units.Quantity`
+            Time of the centre of the subintegration since the start.
+        """
+        foldspec = foldspec.reshape(icount.shape + (-1,))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profile = np.where(icount[..., np.newaxis] > 0,
+                               foldspec / icount[..., np.newaxis], 0.)
+        # (nchan, ngate, npow) -> (npol, nchan, ngate)
+        profile = profile[..., self.pol_order].transpose(2, 0, 1)
+        pmin = profile.min(-1)
+        pmax = profile.max(-1)
+        offs = 0.5 * (pmax + pmin)
+        scl = (pmax - pmin) / (2 * 32767)
+        scl[scl == 0.] = 1.
+        data = np.round((profile - offs[..., np.newaxis]) /
+                        scl[..., np.newaxis]).astype(np.int16)
+        weights = (icount.sum(-1) > 0).astype(np.float32)
+        self.write_row(TSUBINT=tsubint.to('s').value,
+                       OFFS_SUB=offs_sub.to('s').value,
+                       DAT_FREQ=self.freq, DAT_WTS=weights,
+                       DAT_OFFS=offs, DAT_SCL=scl, DATA=data)
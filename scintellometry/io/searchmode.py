@@ -0,0 +1,282 @@
+"""Streaming writers of search-mode (filterbank) data.
+
+Both writers take total-intensity spectra, with shape (nsamp, nchan), in
+chunks of arbitrary length, and append them to the file straight away, so
+that hour-long, high-time-resolution series never need to be in memory.
+
+`FilterbankWriter` writes SIGPROC filterbank files, `SearchWriter` PSRFITS
+search-mode files, and `search_writer` picks one based on the extension.
+Data can be stored as 32-bit floats, or be requantized to 8 bits per
+sample, with a scale and offset for each channel (see `requantize`).
+"""
+from __future__ import division, print_function
+
+import os
+import struct
+
+import numpy as np
+from astropy.time import Time
+
+from .psrfits_writer import SubintWriter
+
+# For 8-bit data, samples are offset such that the mean is in the middle.
+ZERO_OFF = 127.5
+
+
+def requantize(data, nsigma=6., scale=None):
+    """Requantize data to unsigned 8-bit integers, by channel.
+
+    Parameters
+    ----------
+    data : array
+        With shape (nsamp, nchan).
+    nsigma : float
+        Number of standard deviations from the mean that should still be
+        representable (default: 6).
+    scale : tuple of arrays, optional
+        Offset and scale for each channel.  If not given, these are
+        calculated from the mean and standard deviation of data.
+
+    Returns
+    -------
+    quantized : array of uint8
+        Such that ``data ~ (quantized - ZERO_OFF) * scale + offset``.
+    offset, scale : array of float32
+        Offset and scale used for each channel.
+    """
+    if scale is None:
+        offset = data.mean(0).astype(np.float32)
+        scale = (data.std(0) * (nsigma / ZERO_OFF)).astype(np.float32)
+        scale[scale == 0.] = 1.
+    else:
+        offset, scale = scale
+    quantized = np.clip(np.round((data - offset) / scale + ZERO_OFF), 0, 255)
+    return quantized.astype(np.uint8), offset, scale
+
+
+class FilterbankWriter(object):
+    """Write a SIGPROC filterbank file, appending data as they are given.
+
+    Parameters
+    ----------
+    name : str
+        Name of the file to write (an existing file is overwritten).
+    freq : `~astropy.units.Quantity`
+        Frequencies of the channels, in the order used in the data (these
+        should be equally spaced).
+    tsamp : `~astropy.units.Quantity`
+        Time per sample.
+    start_time : `~astropy.time.Time`, optional
+        Time of the first sample.
+    nbits : 8 or 32
+        Whether to requantize data to 8 bits, or store as 32-bit floats.
+    dm : `~astropy.units.Quantity`, optional
+        Dispersion measure with which the data were dedispersed.
+    source_name : str, optional
+        Name of the source.
+    nsigma : float
+        For 8-bit data, the number of standard deviations that can be
+        represented (see `requantize`).
+
+    Notes
+    -----
+    For 8-bit data, the scale and offset of each channel are determined
+    from the first chunk written, since the filterbank format has no way
+    to store them.  Hence, the first chunk should be long enough to give
+    reliable statistics.
+    """
+    def __init__(self, name, freq, tsamp, start_time=None, nbits=32,
+                 dm=None, source_name=None, nsigma=6.):
+        if nbits not in (8, 32):
+            raise ValueError("Can only write 8 or 32 bits per sample.")
+        freq = freq.to('MHz').value.ravel()
+        self.name = name
+        self.nchan = len(freq)
+        self.nbits = nbits
+        self.nsigma = nsigma
+        self.scale = None
+        self.nsamp = 0
+        header = [('telescope_id', 'i', 0), ('machine_id', 'i', 0),
+                  ('data_type', 'i', 1), ('nifs', 'i', 1),
+                  ('nchans', 'i', self.nchan), ('nbits', 'i', nbits),
+                  ('fch1', 'd', freq[0]),
+                  ('foff', 'd', (freq[-1] - freq[0]) / max(self.nchan - 1,
+                                                           1)),
+                  ('tsamp', 'd', tsamp.to('s').value),
+                  ('tstart', 'd', (0. if start_time is None
+                                   else start_time.utc.mjd))]
+        if source_name is not None:
+            header.append(('source_name', 's', source_name))
+        if dm is not None:
+            header.append(('refdm', 'd', dm.to('pc/cm3').value))
+
+        self.fh = open(name, 'wb')
+        self._write_string('HEADER_START')
+        for key, fmt, value in header:
+            self._write_string(key)
+            if fmt == 's':
+                self._write_string(value)
+            else:
+                self.fh.write(struct.pack('<' + fmt, value))
+        self._write_string('HEADER_END')
+
+    def _write_string(self, string):
+        string = string.encode('ascii')
+        self.fh.write(struct.pack('<i', len(string)) + string)
+
+    def write(self, data):
+        """Append spectra, with shape (nsamp, nchan)."""
+        if self.nbits == 8:
+            data, offset, scale = requantize(data, self.nsigma, self.scale)
+            self.scale = offset, scale
+        else:
+            data = data.astype('<f4')
+        self.fh.write(data.tobytes())
+        self.nsamp += len(data)
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return ("<{0} {1}: {2} samples written>"
+                .format(self.__class__.__name__, self.name, self.nsamp))
+
+
+class SearchWriter(SubintWriter):
+    """Write a PSRFITS search-mode file, appending data as they are given.
+
+    Data are collected until a subint of ``nsblk`` samples is complete,
+    which is then written.  The last subint is padded with the channel
+    means when the file is closed.
+
+    Parameters
+    ----------
+    name : str
+        Name of the file to write (an existing file is overwritten).
+    freq : `~astropy.units.Quantity`
+        Frequencies of the channels, in the order used in the data.
+    tsamp : `~astropy.units.Quantity`
+        Time per sample.
+    start_time : `~astropy.time.Time`, optional
+        Time of the first sample.
+    nbits : 8 or 32
+        Whether to requantize data to 8 bits, with a scale and offset for
+        each channel in each subint, or store as 32-bit floats.
+    dm : `~astropy.units.Quantity`, optional
+        Dispersion measure with which the data were dedispersed.
+    nsblk : int
+        Number of samples per subint (default: 4096).
+    primary_header : `~astropy.io.fits.Header` or dict, optional
+        Values for keywords of the primary header.
+    nsigma : float
+        For 8-bit data, the number of standard deviations that can be
+        represented (see `requantize`).
+    """
+    def __init__(self, name, freq, tsamp, start_time=None, nbits=32,
+                 dm=None, nsblk=4096, primary_header=None, nsigma=6.):
+        if nbits not in (8, 32):
+            raise ValueError("Can only write 8 or 32 bits per sample.")
+        freq = freq.to('MHz').value.ravel()
+        nchan = len(freq)
+        chan_bw = np.abs(np.diff(freq)).mean() if nchan > 1 else 0.
+        self.freq = freq
+        self.tsamp = tsamp.to('s').value
+        self.nbits = nbits
+        self.nsblk = nsblk
+        self.nsigma = nsigma
+        self.nsamp = 0
+        self.buffer = np.zeros((nsblk, nchan), dtype=np.float32)
+        self.nbuffer = 0
+
+        primary = ({} if primary_header is None
+                   else dict(primary_header.items()))
+        primary.update({'OBS_MODE': 'SEARCH',
+                        'OBSFREQ': 0.5 * (freq.min() + freq.max()),
+                        'OBSBW': chan_bw * nchan,
+                        'OBSNCHAN': nchan,
+                        'CHAN_DM': 0. if dm is None
+                        else dm.to('pc/cm3').value})
+        if start_time is not None:
+            imjd = int(np.floor(start_time.utc.mjd))
+            seconds = (start_time - Time(imjd, format='mjd', scale='utc')
+                       ).to('s').value
+            primary.update({'DATE-OBS': start_time.utc.isot,
+                            'STT_IMJD': imjd,
+                            'STT_SMJD': int(seconds),
+                            'STT_OFFS': seconds - int(seconds)})
+        subint_header = {
+            'INT_TYPE': 'TIME', 'INT_UNIT': 'SEC', 'SCALE': 'FluxDen',
+            'POL_TYPE': 'AA+BB', 'NPOL': 1, 'NBIN': 1, 'NBIN_PRD': 0,
+            'NBITS': nbits, 'ZERO_OFF': ZERO_OFF if nbits == 8 else 0.,
+            'SIGNINT': 0, 'NSUBOFFS': 0, 'NCHAN': nchan, 'CHAN_BW': chan_bw,
+            'TBIN': self.tsamp, 'NSBLK': nsblk}
+        formats = {'DAT_FREQ': '{0}D'.format(nchan),
+                   'DAT_WTS': '{0}E'.format(nchan),
+                   'DAT_OFFS': '{0}E'.format(nchan),
+                   'DAT_SCL': '{0}E'.format(nchan),
+                   'DATA': ('{0}{1}'.format(nsblk * nchan,
+                                            'B' if nbits == 8 else 'E'),
+                            '({0},1,{1})'.format(nchan, nsblk))}
+        super(SearchWriter, self).__init__(name, formats, subint_header,
+                                           primary)
+
+    def write(self, data):
+        """Append spectra, with shape (nsamp, nchan)."""
+        while len(data) > 0:
+            n = min(len(data), self.nsblk - self.nbuffer)
+            self.buffer[self.nbuffer:self.nbuffer+n] = data[:n]
+            self.nbuffer += n
+            self.nsamp += n
+            data = data[n:]
+            if self.nbuffer == self.nsblk:
+                self.write_subint()
+
+    def write_subint(self):
+        """Write the buffered samples as a subint, padding if needed."""
+        data = self.buffer
+        if self.nbuffer < self.nsblk:
+            data[self.nbuffer:] = data[:self.nbuffer].mean(0)
+        if self.nbits == 8:
+            data, offset, scale = requantize(data, self.nsigma)
+        else:
+            offset = np.zeros(data.shape[1], dtype=np.float32)
+            scale = np.ones(data.shape[1], dtype=np.float32)
+        tsubint = self.nsblk * self.tsamp
+        self.write_row(TSUBINT=tsubint,
+                       OFFS_SUB=(self.nrows + 0.5) * tsubint,
+                       DAT_FREQ=self.freq,
+                       DAT_WTS=np.ones(len(self.freq), dtype=np.float32),
+                       DAT_OFFS=offset, DAT_SCL=scale, DATA=data)
+        self.nbuffer = 0
+
+    def close(self):
+        """Write any remaining samples, and complete the file."""
+        if not self.fh.closed and self.nbuffer > 0:
+            self.write_subint()
+        super(SearchWriter, self).close()
+
+    def __repr__(self):
+        return ("<{0} {1}: {2} samples written>"
+                .format(self.__class__.__name__, self.name, self.nsamp))
+
+
+def search_writer(name, *args, **kwargs):
+    """Open a search-mode writer, choosing the format from the extension.
+
+    Files ending in '.fil' are written in SIGPROC filterbank format, all
+    others as PSRFITS.  Further arguments are passed on to the writer
+    (`FilterbankWriter` or `SearchWriter`).
+    """
+    if os.path.splitext(name)[1] == '.fil':
+        kwargs.pop('primary_header', None)
+        kwargs.pop('nsblk', None)
+        return FilterbankWriter(name, *args, **kwargs)
+    else:
+        kwargs.pop('source_name', None)
+        return SearchWriter(name, *args, **kwargs)
@@ -0,0 +1,155 @@
+"""Concurrent reading of data blocks striped over multiple files.
+
+ARO data are recorded in blocks that are distributed round-robin over
+several raw_voltage files, each typically on a separate disk.  Reading
+these one after the other only ever uses one disk at a time.  The
+StripedReader keeps one reader thread per file, so that upcoming blocks
+on different disks are read concurrently, while they are still handed out
+in sequence order.
+"""
+from __future__ import division, print_function
+
+import threading
+import time
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import numpy as np
+from astropy.table import Table
+
+
+class StripedReader(object):
+    """Read blocks from several files concurrently, one thread per file.
+
+    Parameters
+    ----------
+    files : list of str
+        Names of the files holding the blocks (typically on separate disks).
+    indices : array of int
+        For each block in sequence, the index of the file it is stored in,
+        or -1 if the block is missing (it will be returned as zeros).
+    blocksize : int
+        Size of each block in bytes.
+    nahead : int or None
+        Number of blocks beyond the one requested that should be read ahead.
+        Default: the number of files, so that every disk is kept busy.
+    """
+    def __init__(self, files, indices, blocksize, nahead=None):
+        self.files = files
+        self.indices = np.asarray(indices)
+        self.blocksize = blocksize
+        self.nahead = len(files) if nahead is None else nahead
+        # Location of each block within its own file.
+        self.file_offsets = np.zeros(len(self.indices), dtype=np.int64)
+        for ifh in range(len(files)):
+            in_file = self.indices == ifh
+            self.file_offsets[in_file] = (np.arange(np.count_nonzero(in_file))
+                                          * blocksize)
+        # Per-file statistics.
+        self.nblock = np.zeros(len(files), dtype=np.int64)
+        self.nbytes = np.zeros(len(files), dtype=np.int64)
+        self.busy = np.zeros(len(files), dtype=np.float64)
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue() for f in files]
+        self._threads = []
+        for ifh, name in enumerate(files):
+            thread = threading.Thread(target=self._worker,
+                                      args=(ifh, open(name, 'rb')))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self, ifh, fh):
+        """Serve read requests for the file with index ifh."""
+        try:
+            while True:
+                block = self._queues[ifh].get()
+                if block is None:
+                    break
+                with self._lock:
+                    request = self._pending.get(block)
+                if request is None:  # no longer needed
+                    continue
+                t0 = time.time()
+                try:
+                    fh.seek(self.file_offsets[block])
+                    data = np.frombuffer(fh.read(self.blocksize),
+                                         dtype=np.int8)
+                    if len(data) != self.blocksize:
+                        raise EOFError('Block {0} is truncated in {1}'
+                                       .format(block, self.files[ifh]))
+                except Exception as exc:
+                    data = exc
+                else:
+                    self.nblock[ifh] += 1
+                    self.nbytes[ifh] += len(data)
+                self.busy[ifh] += time.time() - t0
+                request[1].append(data)
+                request[0].set()
+        finally:
+            fh.close()
+
+    def _schedule(self, block):
+        """Queue a block for reading, if it is not pending already."""
+        if (block in self._pending or block >= len(self.indices) or
+                self.indices[block] < 0):
+            return
+        self._pending[block] = (threading.Event(), [])
+        self._queues[self.indices[block]].put(block)
+
+    def read_block(self, block):
+        """Get the data for the given block, reading ahead as needed.
+
+        Returns an array of blocksize np.int8 values (zeros for missing
+        blocks).
+        """
+        if block >= len(self.indices):
+            raise EOFError('At end of file in StripedReader.read_block')
+        with self._lock:
+            # Drop blocks we skipped over, e.g., after a seek.
+            for stale in [b for b in self._pending
+                          if b < block or b > block + self.nahead]:
+                del self._pending[stale]
+            for ahead in range(block, block + self.nahead + 1):
+                self._schedule(ahead)
+            request = self._pending.get(block)
+
+        if request is None:  # missing block
+            return np.zeros(self.blocksize, dtype=np.int8)
+
+        request[0].wait()
+        with self._lock:
+            self._pending.pop(block, None)
+        data = request[1][0]
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def stats(self):
+        """Per-file read statistics.
+
+        Returns a Table with the number of blocks and bytes read from each
+        file, the time spent reading, and the resulting throughput.
+        """
+        rate = np.where(self.busy > 0., self.nbytes / np.maximum(self.busy,
+                                                                 1.e-30), 0.)
+        return Table([self.files, self.nblock, self.nbytes, self.busy,
+                      rate / 2.**20],
+                     names=['file', 'nblock', 'nbytes', 'time', 'MiB/s'])
+
+    def close(self):
+        """Stop the reader threads, which close their files."""
+        with self._lock:
+            self._pending.clear()
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __repr__(self):
+        return ("<StripedReader over {0} files, reading {1} blocks ahead>"
+                .format(len(self.files), self.nahead))
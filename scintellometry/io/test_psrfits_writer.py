@@ -0,0 +1,76 @@
+"""Check that fold-mode PSRFITS files written row by row read back."""
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+import astropy.units as u
+
+from .psrfits_writer import FoldWriter
+
+NCHAN = 8
+NGATE = 16
+NSUBINT = 3
+
+
+def test_fold_writer_round_trip():
+    rng = np.random.RandomState(1)
+    freq = (400. + np.arange(NCHAN) * 0.5) * u.MHz
+    start_time = Time('2016-01-01T12:00:00', scale='utc')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for npow in (1, 2, 4):
+            name = os.path.join(tmpdir, 'fold{0}.fits'.format(npow))
+            foldspec = rng.uniform(1., 2., size=(NSUBINT, NCHAN, NGATE, npow))
+            icount = rng.randint(1, 10, size=(NSUBINT, NCHAN, NGATE))
+            # a channel without any samples should get zero weight.
+            icount[:, 2] = 0
+            foldspec[:, 2] = 0.
+            with FoldWriter(name, freq, NGATE, npow,
+                            dm=10. * u.pc / u.cm**3, period=0.1 * u.s,
+                            start_time=start_time) as writer:
+                for isub in range(NSUBINT):
+                    writer.write_subint(foldspec[isub], icount[isub],
+                                        10. * u.s, (isub + 0.5) * 10. * u.s)
+
+            with fits.open(name) as hdul:
+                assert hdul[0].header['OBS_MODE'] == 'PSR'
+                assert hdul[0].header['STT_IMJD'] == int(start_time.mjd)
+                subint = hdul['SUBINT']
+                assert subint.header['NAXIS2'] == NSUBINT
+                assert subint.header['NBIN'] == NGATE
+                assert subint.header['NCHAN'] == NCHAN
+                assert np.isclose(subint.header['DM'], 10.)
+                rows = subint.data
+                assert np.allclose(rows['DAT_FREQ'], freq.value)
+                assert np.allclose(rows['OFFS_SUB'],
+                                   (np.arange(NSUBINT) + 0.5) * 10.)
+                expected_weights = np.ones(NCHAN)
+                expected_weights[2] = 0.
+                assert np.all(rows['DAT_WTS'] == expected_weights)
+                for isub, row in enumerate(rows):
+                    npol = len(writer.pol_order)
+                    data = row['DATA'].reshape(npol, NCHAN, NGATE)
+                    scl = row['DAT_SCL'].reshape(npol, NCHAN, 1)
+                    offs = row['DAT_OFFS'].reshape(npol, NCHAN, 1)
+                    profile = data * scl + offs
+                    with np.errstate(invalid='ignore'):
+                        expected = np.where(
+                            icount[isub, ..., np.newaxis] > 0,
+                            foldspec[isub] / icount[isub, ..., np.newaxis],
+                            0.)
+                    expected = expected[..., writer.pol_order].transpose(
+                        2, 0, 1)
+                    # 16-bit integers spanning the range of each profile.
+                    assert np.all(np.abs(profile - expected) <= scl)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_fold_writer_round_trip()
+    print("All PSRFITS writer checks passed.")
@@ -0,0 +1,134 @@
+"""Check that search-mode files written in chunks read back."""
+from __future__ import division, print_function
+
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+import astropy.units as u
+
+from .searchmode import FilterbankWriter, SearchWriter, ZERO_OFF
+
+NCHAN = 8
+NSAMP = 250
+NSBLK = 100
+CHUNK = 70
+
+
+def spectra(seed=1):
+    rng = np.random.RandomState(seed)
+    return (10. + rng.normal(size=(NSAMP, NCHAN))).astype(np.float32)
+
+
+def write_in_chunks(writer, data):
+    with writer:
+        for start in range(0, len(data), CHUNK):
+            writer.write(data[start:start+CHUNK])
+
+
+def read_filterbank(name):
+    """Read header and data of a SIGPROC filterbank file."""
+    with open(name, 'rb') as fh:
+        def read_string():
+            size = struct.unpack('<i', fh.read(4))[0]
+            return fh.read(size).decode('ascii')
+
+        assert read_string() == 'HEADER_START'
+        header = {}
+        while True:
+            key = read_string()
+            if key == 'HEADER_END':
+                break
+            if key == 'source_name':
+                header[key] = read_string()
+            elif key in ('fch1', 'foff', 'tsamp', 'tstart', 'refdm'):
+                header[key] = struct.unpack('<d', fh.read(8))[0]
+            else:
+                header[key] = struct.unpack('<i', fh.read(4))[0]
+        dtype = '<f4' if header['nbits'] == 32 else np.uint8
+        data = np.frombuffer(fh.read(), dtype=dtype)
+    return header, data.reshape(-1, header['nchans'])
+
+
+def test_filterbank_round_trip():
+    data = spectra()
+    freq = (400. + np.arange(NCHAN) * 0.5) * u.MHz
+    start_time = Time('2016-01-01T12:00:00', scale='utc')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for nbits in (32, 8):
+            name = os.path.join(tmpdir, 'search{0}.fil'.format(nbits))
+            writer = FilterbankWriter(name, freq, 1. * u.ms,
+                                      start_time=start_time, nbits=nbits,
+                                      dm=10. * u.pc / u.cm**3,
+                                      source_name='B1957+20')
+            write_in_chunks(writer, data)
+            header, result = read_filterbank(name)
+            assert header['nchans'] == NCHAN
+            assert header['nbits'] == nbits
+            assert header['source_name'] == 'B1957+20'
+            assert np.isclose(header['fch1'], 400.)
+            assert np.isclose(header['foff'], 0.5)
+            assert np.isclose(header['tsamp'], 1.e-3)
+            assert np.isclose(header['tstart'], start_time.mjd)
+            assert np.isclose(header['refdm'], 10.)
+            if nbits == 32:
+                assert np.all(result == data)
+            else:
+                # scale and offset are set by the first chunk.
+                offset, scale = writer.scale
+                restored = (result - ZERO_OFF) * scale + offset
+                assert np.all(np.abs(restored - data) <= 0.5 * scale)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_psrfits_search_round_trip():
+    data = spectra(2)
+    freq = (400. + np.arange(NCHAN) * 0.5) * u.MHz
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for nbits in (32, 8):
+            name = os.path.join(tmpdir, 'search{0}.fits'.format(nbits))
+            write_in_chunks(SearchWriter(name, freq, 1. * u.ms, nbits=nbits,
+                                         nsblk=NSBLK), data)
+            with fits.open(name) as hdul:
+                assert hdul[0].header['OBS_MODE'] == 'SEARCH'
+                subint = hdul['SUBINT']
+                nrow = -(-NSAMP // NSBLK)
+                assert subint.header['NAXIS2'] == nrow
+                assert subint.header['NSBLK'] == NSBLK
+                assert subint.header['NBITS'] == nbits
+                rows = subint.data
+                assert np.allclose(rows['TSUBINT'], NSBLK * 1.e-3)
+                assert np.allclose(rows['OFFS_SUB'],
+                                   (np.arange(nrow) + 0.5) * NSBLK * 1.e-3)
+                result = []
+                for row in rows:
+                    samples = row['DATA'].reshape(NSBLK, NCHAN)
+                    zero_off = subint.header['ZERO_OFF']
+                    result.append((samples - zero_off) * row['DAT_SCL'] +
+                                  row['DAT_OFFS'])
+                result = np.vstack(result)
+            if nbits == 32:
+                assert np.all(result[:NSAMP] == data)
+                tolerance = 0.
+            else:
+                tolerance = 0.5 * rows['DAT_SCL'].max()
+                assert np.all(np.abs(result[:NSAMP] - data) <= tolerance)
+            # the last subint is padded with the mean of its samples.
+            last = data[(nrow - 1) * NSBLK:]
+            assert np.allclose(result[NSAMP:], last.mean(0),
+                               rtol=0., atol=tolerance + 1.e-5)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_filterbank_round_trip()
+    test_psrfits_search_round_trip()
+    print("All search-mode checks passed.")
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-""" Routines to convert raw LOFAR data between 4-byte floats and 1-byte integers.
+""" Routines to convert raw LOFAR data between 4-byte floats and 1-byte integers,
+ or from big-endian to native-endian floats.
 
  Main routine is convert_dtype
 
@@ -16,6 +17,10 @@
    The dataset also has attributes 'STOKES_X_nsig', preserving the NSIG argument
                                    'STOKES_X_recsize', preserving the read buffer size
    The dataset is deleted if direction='i2f', i..e. 'refloat'ing the byte stream
+ * with direction='f2n', float data are rewritten in the native byte order of
+   the machine doing the conversion, which is recorded in the STOKES_X
+   'BYTE_ORDER' attribute (absent means big-endian, as written by LOFAR).
+   This avoids byte swapping every time the data are read.
  * digitization clips extreme fluctuations (nsig), so you may not recover the original
    float stream. Noise will be clipped.
  * We modify the STOKES_X 'DATATYPE' attribute, changing it from 'float' to 'int8' if direction == 'f2i'
@@ -29,6 +34,7 @@ import numpy as np
 import os
 import re
 import shutil
+import sys
 
 import h5py
 
@@ -51,8 +57,9 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
            This process clips outliers.
            (default: 5.)
 
-    direction : One of 'f2i' or 'i2f'. The 'i2f' routine undoes the original
-                digitization and should reproduce the original data.
+    direction : One of 'f2i', 'i2f', or 'f2n'. The 'i2f' routine undoes the
+                original digitization and should reproduce the original data.
+                The 'f2n' routine converts floats to native byte order.
             (deafult: 'f2i')
 
     check : Check the h5 structure is consistent with the filename.
@@ -76,7 +83,7 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
     if not isinstance(files, list):
         files = [files]
 
-    assert direction in ['f2i', 'i2f']
+    assert direction in ['f2i', 'i2f', 'f2n']
 
     for fname in files:
         fraw = fname.replace('.h5', '.raw')
@@ -85,6 +92,8 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
             print("Digitizing %s to %s" % (fraw, fraw_out))
         elif direction == 'i2f':
             print("unDigitizing %s to %s" % (fraw, fraw_out))
+        elif direction == 'f2n':
+            print("Converting %s to native byte order in %s" % (fraw, fraw_out))
  
         if os.path.abspath(fraw) == os.path.abspath(fraw_out):
             print("Warning, this will overwrite input files")
@@ -102,7 +111,7 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
         itemsize_i = np.dtype(dtype).itemsize
         if direction == 'f2i':
             itemsize_o = np.dtype('>i1').itemsize
-        elif direction == 'i2f':
+        elif direction in ('i2f', 'f2n'):
             itemsize_o = np.dtype('>f4').itemsize
 
         with open(fraw, 'rb', recsize*itemsize_i) as fh1,\
@@ -110,6 +119,9 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
                 h5py.File(fnew, 'a') as h5:
             if verbose >= 1:
                 print("\t",fraw," has dtype", dtype)
+            # the byte order is only recorded for native-endian floats
+            if 'BYTE_ORDER' in h5[sap][beam][stokes].attrs:
+                del h5[sap][beam][stokes].attrs['BYTE_ORDER']
             # create/access dataset used to convert back to floats from int8's
             if direction == 'f2i':            
                 h5[sap][beam][stokes].attrs['DATATYPE'] = 'int8'
@@ -119,6 +131,11 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
             elif direction == 'i2f':
                 h5[sap][beam][stokes].attrs['DATATYPE'] = 'float'
                 diginfo = h5[sap][beam]["%s_i2f" % stokes]
+            elif direction == 'f2n':
+                if dtype not in ('>f4', '<f4'):
+                    raise ValueError("Can only convert float data to native "
+                                     "byte order.")
+                h5[sap][beam][stokes].attrs['BYTE_ORDER'] = sys.byteorder
 
             idx = 0
             while True:
@@ -151,6 +168,9 @@ def convert_dtype(files, outdir, nsig=5., direction='f2i', check=True, verbose=N
                     scale = diginfo[idx]
                     raw1_o = (raw1*scale).astype('>f4')
 
+                elif direction == 'f2n':
+                    raw1_o = raw1.astype('=f4')
+
                 raw1_o.tofile(fh1out)
 
                 if verbose >= 3:
@@ -202,6 +222,8 @@ def lofar_h5info(fname, check=True):
     # with 1 channel in each subband
     nchan = st0.attrs['NOF_SUBBANDS']
     dtype = _lofar_dtypes[st0.attrs['DATATYPE']]
+    if dtype == '>f4' and st0.attrs.get('BYTE_ORDER', 'big') == 'little':
+        dtype = '<f4'
     # process sets of ~32 MB, hence // np.log2(nchan)
     ntint = 2**25//4//int(np.log2(nchan))  # 16=~nchan -> power of 2, but sets of ~32 MB
     nsamples = b0.attrs['NOF_SAMPLES']
@@ -273,6 +295,10 @@ def CL_parser():
                         help='Convert int8 back to float32 ("i2f").'
                              'This only works on files having gone through the digitization process.')
 
+    parser.add_argument('--native', action='store_true',
+                        help='Convert float32 to native byte order ("f2n"), '
+                             'so that no byte swapping is needed when reading.')
+
     parser.add_argument('-nc', '--nocheck', action='store_true',
                         help='do not enforce filename consistency of *_SAP???_B???_S?_* with the actual hdf5 '
                         'structure for SUB_ARRAY_POINTING_???, BEAM_???, and STOKES_? .')
@@ -286,6 +312,8 @@ if __name__ == '__main__':
     args.verbose = 0 if args.verbose is None else sum(args.verbose)
     if args.refloat:
         direction = 'i2f'
+    elif args.native:
+        direction = 'f2n'
     else:
         direction = 'f2i'
     convert_dtype(args.files, args.outdir, args.nsig, direction=direction, check=check, verbose=args.verbose)
@@ -145,13 +145,18 @@ class Telescope(OrderedDict):
                           .format(key, str(t)))
         return key
 
-    def open(self, key, comm=None):
-        """Open the reader with the files associated with `key`."""
+    def open(self, key, comm=None, **kwargs):
+        """Open the reader with the files associated with `key`.
+
+        Further keyword arguments override the reader setup given in the
+        configuration (e.g., ``blocksize``).
+        """
         data_format = self.get('format', self['name'])
         if data_format not in DATA_READERS:
             raise ValueError("Unsupported data format {0}".format(data_format))
-        setup = self.get('setup', {})
+        setup = dict(self.get('setup', {}))
         setup.update(self[key].get('setup', {}))
+        setup.update(kwargs)
         file_setup = {'key': key}
         file_setup.update(self)
         file_setup.update(self[key])
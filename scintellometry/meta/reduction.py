@@ -1,25 +1,68 @@
 from __future__ import (absolute_import, unicode_literals, division,
                         print_function)
 
+import os
 import numpy as np
 import argparse
 
 from astropy.time import Time, TimeDelta
-
-from scintellometry.folding.fold import Folder, normalize_counts
+import astropy.units as u
+
+from scintellometry.folding.fold import (Folder, normalize_counts,
+                                          output_name)
+from scintellometry.folding.accumulators import accumulator
+from scintellometry.folding.channelized import ChannelizedArchive, HEADER
+from scintellometry.folding.collective import reduce_array
+from scintellometry.folding.parallel import LocalComm
 from scintellometry.folding.pmap import pmap
+from scintellometry.folding.rfi import RFIExcision
+from scintellometry.folding.tuner import tune as tune_fold
+from scintellometry.io.integrity import scan, bad_blocks
 
 from .observations import obsdata
 
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:  # can still run in processes on a single machine.
+    MPI = None
+
+
+def time_span(fh, tstart, tend, observation):
+    """Interpret the requested start and end (or duration) of a reduction.
+
+    By default, the span runs from the start of the file to the end given
+    for the observation.
+    """
+    time0 = fh.time0
+    tstart = time0 if tstart is None else Time(tstart, scale='utc')
+    if tstart < time0:
+        raise ValueError("Cowardly refusing to analyse with requested "
+                         "time {0} before start time {1}."
+                         .format(tstart.iso, time0.iso))
+    if tend is None:
+        tend = observation['tend']
+
+    try:
+        tend = Time(tend, scale='utc')
+        dt = tend - tstart
+    except ValueError:
+        dt = TimeDelta(float(tend), format='sec')
+        tend = tstart + dt
+    return tstart, tend, dt
 
 
 def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
            rfi_filter_raw=None, fref=None, dedisperse=None,
            rfi_filter_power=None, do_waterfall=True, do_foldspec=True,
-           verbose=True):
-
-    comm = MPI.COMM_WORLD
+           skip_bad=False, channelized=None, nworkers=0, dm=None,
+           checkpoint=None, phase_tolerance=None, fits=False,
+           search=None, search_nbits=32, accumulators=None,
+           waterfall_float32=False, overlap_save=False, fft_length=None,
+           tune=False, memory=None, schedule='static', sk_length=None,
+           sk_threshold=5., mad_threshold=None, comm=None, verbose=True):
+
+    if comm is None:
+        comm = LocalComm() if MPI is None else MPI.COMM_WORLD
     if dedisperse == 'None':
         dedisperse = None
 
@@ -43,12 +86,46 @@ def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
     psr = obs[telescope][obskey]['src']
     assert psr in obs['psrs'].keys()
 
-    dm = obs['psrs'][psr]['dm']
+    if dm is None:
+        dm = obs['psrs'][psr]['dm']
+    else:
+        # override catalogue value, possibly with several trial values
+        # (a single one gives an ordinary reduction, as before).
+        if not np.isscalar(dm) and len(dm) == 1:
+            dm = dm[0]
+        dm = u.Quantity(dm, u.pc / u.cm**3)
 
     if verbose and comm.rank == 0:
         print("Attempting to open {0}: {1}".format(telescope, obskey))
 
-    with obs[telescope].open(obskey, comm=comm) as fh:
+    setup = {}
+    if tune:
+        # benchmark on the first process only, and let all use its choice.
+        with obs[telescope].open(obskey, comm=comm) as fh:
+            choice = None
+            if comm.rank == 0:
+                span = time_span(fh, tstart, tend, obs[telescope][obskey])
+                candidates = tune_fold(
+                    fh, dm, dedisperse, nchan=nchan,
+                    memory=None if memory is None else memory * u.GB,
+                    nt=fh.ntimebins(span[0], span[1]), ngate=ngate,
+                    ntbin=ntbin, ntw_min=ntw_min, do_waterfall=do_waterfall,
+                    nworkers=nworkers, verbose=verbose)
+                if candidates and candidates[0]['speed'] is not None:
+                    choice = candidates[0]
+            choice = comm.bcast(choice, root=0)
+            if choice is None:
+                raise ValueError("No block size and number of channels meet "
+                                 "the dispersion and memory constraints.")
+            if choice['blocksize'] != fh.blocksize:
+                setup['blocksize'] = choice['blocksize']
+        nchan = choice['nchan']
+        ntw_min = choice['ntw']
+        if verbose and comm.rank == 0:
+            print("Tuned to blocksize={0}, nchan={1}, ntw={2}"
+                  .format(choice['blocksize'], nchan, ntw_min))
+
+    with obs[telescope].open(obskey, comm=comm, **setup) as fh:
         if verbose and comm.rank == 0:
             print("Opened files")
 
@@ -64,20 +141,8 @@ def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
                              .format(fh.nchan))
 
         time0 = fh.time0
-        tstart = time0 if tstart is None else Time(tstart, scale='utc')
-        if tstart < time0:
-            raise ValueError("Cowardly refusing to analyse with requested "
-                             "time {0} before start time {1}."
-                             .format(tstart.iso, time0.iso))
-        if tend is None:
-            tend = obs[telescope][obskey]['tend']
-
-        try:
-            tend = Time(tend, scale='utc')
-            dt = tend - tstart
-        except ValueError:
-            dt = TimeDelta(float(tend), format='sec')
-            tend = tstart + dt
+        tstart, tend, dt = time_span(fh, tstart, tend,
+                                     obs[telescope][obskey])
 
         if verbose and comm.rank == 0:
             print("Requested time span: {0} to {1}".format(tstart.isot,
@@ -101,6 +166,36 @@ def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
                   .format(fh.offset/fh.blocksize, nt, fh.time().isot,
                           fh.time(fh.offset + nt*fh.blocksize).isot))
 
+        if skip_bad:
+            # scan headers only once, and share the gap map with all nodes
+            gapmap = scan(fh) if comm.rank == 0 else None
+            gapmap = comm.bcast(gapmap, root=0)
+            # scanning may have moved the reader; fold starts from here.
+            fh.seek(tstart)
+            skip_blocks = bad_blocks(gapmap, fh.blocksize,
+                                     fh.offset // fh.blocksize, nt)
+            if verbose and comm.rank == 0:
+                print("Will skip {0} of {1} blocks with invalid or lost data"
+                      .format(np.count_nonzero(skip_blocks), nt))
+        else:
+            skip_blocks = None
+
+        savepref = "{0}{1}_{2}chan{3}ntbin".format(telescope, psr, nchan,
+                                                   ntbin)
+        if fits:
+            fits_output = ("{0}foldspec_{1}+{2:08}sec.fits"
+                           .format(savepref, tstart.isot, dt.sec))
+        else:
+            fits_output = None
+        if search is not None:
+            # stream the waterfall to a search-mode file instead.
+            search_output = ("{0}waterfall_{1}+{2:08}sec.{3}"
+                             .format(savepref, tstart.isot, dt.sec, search))
+        else:
+            search_output = None
+
+        rfi_excision = (RFIExcision(sk_length, sk_threshold, mad_threshold)
+                        if sk_length or mad_threshold else None)
         # set the default parameters to fold
         # Note, some parameters may be in fh's HDUs, or fh.__getitem__
         # but these are overwritten if explicitly sprecified in Folder
@@ -108,32 +203,65 @@ def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
                         nt=nt, ntint=ntint, ngate=ngate,
                         ntbin=ntbin, ntw=ntw, dm=dm, fref=fref,
                         phasepol=phasepol, dedisperse=dedisperse,
-                        do_waterfall=do_waterfall, do_foldspec=do_foldspec,
+                        do_waterfall=do_waterfall or search is not None,
+                        do_foldspec=do_foldspec,
                         verbose=verbose, progress_interval=1,
                         rfi_filter_raw=rfi_filter_raw,
-                        rfi_filter_power=rfi_filter_power)
-        myfoldspec, myicount, mywaterfall = folder(fh, comm=comm)
+                        rfi_filter_power=rfi_filter_power,
+                        skip_blocks=skip_blocks, nworkers=nworkers,
+                        checkpoint=checkpoint,
+                        phase_tolerance=phase_tolerance,
+                        fits_output=fits_output,
+                        search_output=search_output,
+                        search_nbits=search_nbits,
+                        accumulator_dir=accumulators,
+                        waterfall_dtype=(np.float32 if waterfall_float32
+                                         else np.float64),
+                        overlap_save=overlap_save, fft_length=fft_length,
+                        schedule=schedule, rfi_excision=rfi_excision)
+        # decide on rank 0, since it writes the header of a new archive.
+        from_archive = comm.bcast(
+            channelized is not None and comm.rank == 0 and
+            os.path.exists(os.path.join(channelized, HEADER)), root=0)
+        if from_archive:
+            # fold power spectra stored by an earlier reduction.
+            if verbose and comm.rank == 0:
+                print("Folding spectra archived in {0}".format(channelized))
+            with ChannelizedArchive(channelized) as archive:
+                # ensure the archive holds the data asked for.
+                archive.check(nchan, ntint, dedisperse, dm, nt=nt, fref=fref,
+                              npol=getattr(fh, 'npol', 1),
+                              nskip=fh.tell() / fh.blocksize)
+                myfoldspec, myicount, mywaterfall = folder(archive, comm=comm)
+        else:
+            folder['channelized_output'] = channelized
+            myfoldspec, myicount, mywaterfall = folder(fh, comm=comm)
     # end with
 
     print("Rank {0} exited with statement".format(comm.rank))
 
-    savepref = "{0}{1}_{2}chan{3}ntbin".format(telescope, psr, nchan, ntbin)
+    def reduce_to_root(array, name):
+        # with accumulators on disk, stream the sums to disk as well;
+        # otherwise, sum in place in the arrays of rank 0.
+        out = (accumulator(array.shape, array.dtype, accumulators, name)
+               if comm.rank == 0 and accumulators is not None else None)
+        return reduce_array(comm, array, out=out, root=0)
+
+    do_waterfall = do_waterfall and search is None
     if do_waterfall:
-        waterfall = np.zeros_like(mywaterfall)
-        comm.Reduce(mywaterfall, waterfall, op=MPI.SUM, root=0)
+        waterfall = reduce_to_root(mywaterfall, 'waterfall_sum')
+        del mywaterfall
         if comm.rank == 0:
             # waterfall = normalize_counts(waterfall)
             np.save("{0}waterfall_{1}+{2:08}sec.npy"
                     .format(savepref, tstart.isot, dt.sec), waterfall)
 
     if do_foldspec:
-        foldspec = np.zeros_like(myfoldspec) if comm.rank == 0 else None
         print("Rank {0} is entering comm.Reduce".format(comm.rank))
-        comm.Reduce(myfoldspec, foldspec, op=MPI.SUM, root=0)
-        del myfoldspec  # save memory on node 0
-        icount = np.zeros_like(myicount) if comm.rank == 0 else None
-        comm.Reduce(myicount, icount, op=MPI.SUM, root=0)
-        del myicount  # save memory on node 0
+        foldspec = reduce_to_root(myfoldspec, 'foldspec_sum')
+        del myfoldspec
+        icount = reduce_to_root(myicount, 'icount_sum')
+        del myicount
         if comm.rank == 0:
             fname = ("{0}foldspec_{1}+{2:08}sec.npy")
             np.save(fname.format(savepref, tstart.isot, dt.sec), foldspec)
@@ -141,67 +269,57 @@ def reduce(telescope, obskey, tstart, tend, nchan, ngate, ntbin, ntw_min,
             np.save(iname.format(savepref, tstart.isot, dt.sec), icount)
 
     if comm.rank == 0:
-        if do_foldspec and foldspec.ndim == 3:
-            # sum over time slices -> pulse profile vs channel
-            foldspec1 = normalize_counts(foldspec.sum(0).astype(np.float64),
-                                         icount.sum(0).astype(np.int64))
-            # sum over channels -> pulse profile vs time
-            foldspec3 = normalize_counts(foldspec.sum(1).astype(np.float64),
-                                         icount.sum(1).astype(np.int64))
-            fluxes = foldspec1.sum(axis=0)
-            with open('{0}flux_{1}+{2:08}sec.dat'
-                      .format(savepref, tstart.isot, dt.sec), 'w') as f:
-                for i, flux in enumerate(fluxes):
-                    f.write('{0:12d} {1:12.9g}\n'.format(i+1, flux))
-            # ratio'd flux only if file will not be ridiculously large
-            if ntbin*ngate < 10000:
-                foldspec2 = normalize_counts(foldspec, icount)
-
-        plots = True
-        if plots and do_waterfall and waterfall.ndim == 2:  # no polarizations
-            w = waterfall.copy()
-            pmap('{0}waterfall_{1}+{2:08}sec.pgm'
-                 .format(savepref, tstart.isot, dt.sec), w, 1, verbose=True)
-        if plots and do_foldspec and foldspec.ndim == 3:
-            pmap('{0}folded_{1}+{2:08}sec.pgm'
-                 .format(savepref, tstart.isot, dt.sec), foldspec1, 0, verbose)
-            pmap('{0}folded3_{1}+{2:08}sec.pgm'
-                 .format(savepref, tstart.isot, dt.sec),
-                 foldspec3.T, 0, verbose)
-            # ratio'd flux only if file will not be ridiculously large
-            if ntbin*ngate < 10000:
-                pmap('{0}foldedbin_{1}+{2:08}sec.pgm'
-                     .format(savepref, tstart.isot, dt.sec),
-                     foldspec2.transpose(1,2,0).reshape(nchan,-1), 1, verbose)
-
-    # savefits = False
-    # if savefits and comm.rank == 0:
-    #     print("Saving FITS files...")
-    #     # assign the folded data ( [f2] = [nchan, ngate, ntbin]
-    #     #                          want [ntbin, npol, nchan, ngate]
-
-    #     # TODO: figure out lofar and aro data, which concatenates channels
-    #     # so f2 = len(range(P))*nchan
-    #     if telescope == 'lofar':
-    #         f2 = f2[-nchan:]
-    #     elif telescope == 'aro':
-    #         f2 = f2[0:nchan]
-    #     nchan, ngate, ntbin = f2.shape
-    #     f2 = f2.transpose(2, 0, 1)
-    #     f2 = f2.reshape(ntbin, np.newaxis, nchan, ngate)
-    #     std = f2.std(axis=0)
-    #     subint_table[1].data.field('DATA')[:] = (2**16*f2/std).astype(
-    #         np.int16)
-    #     fout = ('{0}folded3_{1}+{2:08}sec.fits'
-    #             .format(savepref, tstart.isot, dt.sec))
-    #     # Note: output_verify != 'ignore' resets the cards for some reason
-    #     try:
-    #         subint_table.writeto(fout, output_verify='ignore', clobber=True)
-    #     except ValueError:
-    #         print("FITS writings is a work in progress: "
-    #               "need to come to terms with array shapes")
-    #         print("f2.shape, subint_table[1].data.field('DATA')[:].shape = ",
-    #               f2.shape, subint_table[1].data.field('DATA')[:].shape)
+        if not do_foldspec:
+            foldspec = icount = None
+        if not do_waterfall:
+            waterfall = None
+        # for several dispersion measures, make products for each.
+        multi_dm = not dm.isscalar
+        for idm, _dm in enumerate(dm.reshape(-1)):
+            select = (lambda result: result[idm]
+                      if multi_dm and result is not None else result)
+            save_products(savepref, tstart, dt, _dm, multi_dm,
+                          select(foldspec), select(icount),
+                          select(waterfall), ntbin, ngate, nchan, verbose)
+
+
+def save_products(savepref, tstart, dt, dm, multi_dm, foldspec, icount,
+                  waterfall, ntbin, ngate, nchan, verbose):
+    """Write fluxes and plots for the results for one dispersion measure.
+
+    For several dispersion measures, the value is appended to the names.
+    """
+    def name(kind, ext):
+        return output_name('{0}{1}_{2}+{3:08}sec.{4}'.format(
+            savepref, kind, tstart.isot, dt.sec, ext), dm, multi_dm)
+
+    if foldspec is not None and foldspec.ndim == 3:
+        # sum over time slices -> pulse profile vs channel
+        foldspec1 = normalize_counts(foldspec.sum(0).astype(np.float64),
+                                     icount.sum(0).astype(np.int64))
+        # sum over channels -> pulse profile vs time
+        foldspec3 = normalize_counts(foldspec.sum(1).astype(np.float64),
+                                     icount.sum(1).astype(np.int64))
+        fluxes = foldspec1.sum(axis=0)
+        with open(name('flux', 'dat'), 'w') as f:
+            for i, flux in enumerate(fluxes):
+                f.write('{0:12d} {1:12.9g}\n'.format(i+1, flux))
+        # ratio'd flux only if file will not be ridiculously large
+        if ntbin*ngate < 10000:
+            foldspec2 = normalize_counts(foldspec, icount)
+
+    plots = True
+    if plots and waterfall is not None and waterfall.ndim == 2:
+        # no polarizations
+        w = waterfall.copy()
+        pmap(name('waterfall', 'pgm'), w, 1, verbose=True)
+    if plots and foldspec is not None and foldspec.ndim == 3:
+        pmap(name('folded', 'pgm'), foldspec1, 0, verbose)
+        pmap(name('folded3', 'pgm'), foldspec3.T, 0, verbose)
+        # ratio'd flux only if file will not be ridiculously large
+        if ntbin*ngate < 10000:
+            pmap(name('foldedbin', 'pgm'),
+                 foldspec2.transpose(1,2,0).reshape(nchan,-1), 1, verbose)
 
 
 def CL_parser():
@@ -242,6 +360,54 @@ def CL_parser():
         '--rfi_filter_power', action='store_true',
         help="Apply the 'rfi_filter_power' routine to "
               "possibly dedispersed spectra.")
+    d_parser.add_argument(
+        '--sk_length', type=int, default=None,
+        help="Zap chunks of this many samples in channels in which the "
+        "spectral kurtosis indicates RFI.")
+    d_parser.add_argument(
+        '--sk_threshold', type=float, default=5.,
+        help="Number of standard deviations from unity of the spectral "
+        "kurtosis beyond which a chunk is zapped.")
+    d_parser.add_argument(
+        '--mad_threshold', type=float, default=None,
+        help="Zap samples for which the power averaged over channels "
+        "deviates more than this number of (robust) standard deviations "
+        "from the median.")
+    d_parser.add_argument(
+        '--skip_bad', action='store_true',
+        help="Scan the data for invalid or lost frames first, "
+        "and do not fold blocks affected by those.")
+    d_parser.add_argument(
+        '--channelized', type=str, default=None,
+        help="Directory in which to archive channelized power spectra, or "
+        "from which to read them if written by an earlier reduction.")
+    d_parser.add_argument(
+        '--checkpoint', type=str, default=None,
+        help="Directory in which to save intermediate results, and from "
+        "which to resume if an earlier reduction was interrupted. "
+        "Needs the same number of MPI processes.")
+    d_parser.add_argument(
+        '--processes', type=int, default=0,
+        help="Number of processes to run on this machine, communicating "
+        "through shared memory rather than MPI (0: use MPI if available).")
+    d_parser.add_argument(
+        '--schedule', type=str, default='static',
+        choices=['static', 'dynamic'],
+        help="How blocks are distributed over processes: in equal "
+        "contiguous ranges, or handed out in chunks as processes become "
+        "free (which balances uneven loads; cannot be checkpointed).")
+    d_parser.add_argument(
+        '--tune', action='store_true',
+        help="Benchmark block sizes and numbers of channels first, and "
+        "use the fastest that meets the dispersion smearing constraints "
+        "(and the memory budget, if given).")
+    d_parser.add_argument(
+        '--memory', type=float, default=None,
+        help="Memory available per process (in GB) when tuning.")
+    d_parser.add_argument(
+        '--accumulators', type=str, default=None,
+        help="Directory in which to keep the folded spectra and waterfall "
+        "as memory-mapped files, rather than in memory.")
 
     f_parser = parser.add_argument_group("folding related parameters")
     f_parser.add_argument(
@@ -256,6 +422,18 @@ def CL_parser():
     f_parser.add_argument(
         '-nb', '--ntbin', type=int, default=5,
         help="number of time bins the time series is split into for folding.")
+    f_parser.add_argument(
+        '--nworkers', type=int, default=0,
+        help="Number of threads with which to channelize data, while "
+        "reading and folding in separate threads (0: all in sequence).")
+    f_parser.add_argument(
+        '--phase_tolerance', type=float, nargs='?', const=True, default=None,
+        help="If given, calculate phases from an expansion per block, "
+        "with at most this error (in cycles; by default, 1%% of a phase "
+        "bin), rather than for every sample.")
+    f_parser.add_argument(
+        '--fits', action='store_true',
+        help="Also write the folded spectrum as a PSRFITS fold-mode file.")
 
     w_parser = parser.add_argument_group("Waterfall related parameters")
     w_parser.add_argument(
@@ -264,6 +442,18 @@ def CL_parser():
     w_parser.add_argument(
         '-nwm', '--ntw_min', type=int, default=10200,
         help="number of samples to combine for waterfall")
+    w_parser.add_argument(
+        '--waterfall_float32', action='store_true',
+        help="Accumulate the waterfall in single rather than double "
+        "precision.")
+    w_parser.add_argument(
+        '--search', type=str, default=None, choices=['fits', 'fil'],
+        help="Stream the waterfall to a PSRFITS search-mode ('fits') or "
+        "SIGPROC filterbank ('fil') file while folding, rather than "
+        "keeping it in memory.  Needs a single process.")
+    w_parser.add_argument(
+        '--search_nbits', type=int, default=32, choices=[8, 32],
+        help="Bits per sample for the search-mode output.")
 
     d_parser = parser.add_argument_group("Dedispersion related parameters.")
     d_parser.add_argument(
@@ -273,6 +463,20 @@ def CL_parser():
     d_parser.add_argument(
         '--fref', type=float, default=None,
         help="reference frequency for dispersion measure")
+    d_parser.add_argument(
+        '--dm', type=float, nargs='+', default=None,
+        help="Dispersion measure(s) in pc/cm^3 to use instead of the "
+        "catalogue value.  With several, all are folded in one pass, "
+        "giving output with an extra first dimension.")
+    d_parser.add_argument(
+        '--overlap_save', action='store_true',
+        help="For coherent or by-channel dedispersion, dedisperse by "
+        "overlap-save in short segments, rather than by transforming "
+        "whole blocks, which wraps around the block edges.")
+    d_parser.add_argument(
+        '--fft_length', type=int, default=None,
+        help="Length of the segments for overlap-save (default: chosen "
+        "from the dispersion smearing).")
 
     parser.add_argument('-v', '--verbose', action='append_const', const=1)
     return parser.parse_args()
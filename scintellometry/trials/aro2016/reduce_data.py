@@ -1,10 +1,13 @@
 """ work in progress: need to do lofar-style waterfall and foldspec """
 from __future__ import division, print_function
 
+from functools import partial
+
 import numpy as np
 import astropy.units as u
 
 from scintellometry.meta.reduction import reduce, CL_parser
+from scintellometry.folding.parallel import spawn
 
 MAX_RMS = 2.
 _fref = 600. * u.MHz  # ref. freq. for dispersion measure
@@ -65,10 +68,22 @@ if __name__ == '__main__':
         args.ntw_min = 170
         args.rfi_filter_raw = None
         args.verbose += 1
-    reduce(
+    # without MPI, run in processes sharing memory on this machine.
+    run = (partial(spawn, reduce, args.processes) if args.processes > 0
+           else reduce)
+    run(
         args.telescope, args.date, tstart=args.tstart, tend=args.tend,
         nchan=args.nchan, ngate=args.ngate, ntbin=args.ntbin,
         ntw_min=args.ntw_min, rfi_filter_raw=args.rfi_filter_raw,
         rfi_filter_power=args.rfi_filter_power,
         do_waterfall=args.waterfall, do_foldspec=args.foldspec,
-        dedisperse=args.dedisperse, fref=args.fref, verbose=args.verbose)
+        dedisperse=args.dedisperse, fref=args.fref, skip_bad=args.skip_bad,
+        channelized=args.channelized, nworkers=args.nworkers, dm=args.dm,
+        checkpoint=args.checkpoint, phase_tolerance=args.phase_tolerance,
+        fits=args.fits, search=args.search, search_nbits=args.search_nbits,
+        accumulators=args.accumulators,
+        waterfall_float32=args.waterfall_float32,
+        overlap_save=args.overlap_save, fft_length=args.fft_length,
+        tune=args.tune, memory=args.memory, schedule=args.schedule,
+        sk_length=args.sk_length, sk_threshold=args.sk_threshold,
+        mad_threshold=args.mad_threshold, verbose=args.verbose)
@@ -7,6 +7,7 @@ from astropy.time import Time
 from scintellometry.folding.fold import normalize_counts
 from scintellometry.folding.pmap import pmap
 from scintellometry.folding import correlate
+from scintellometry.folding.collective import reduce_array
 from scintellometry.io import AROdata, LOFARdata_Pcombined, GMRTdata
 
 from observations import obsdata
@@ -73,18 +74,16 @@ def main_correlate(tel1, date1, tel2, date2, nchan, tstart, tend, dedisperse,
     savepref = "{0}{1}_{2}chan{3}ntbin".format(tel1[0], tel2[0], nchan, ntbin)
     dt = t1 - t0
     if do_waterfall:
-        waterfall = np.zeros_like(mywaterfall)
-        comm.Reduce(mywaterfall, waterfall, op=MPI.SUM, root=0)
+        # sum in place on rank 0, to avoid a second copy.
+        waterfall = reduce_array(comm, mywaterfall)
         if comm.rank == 0:
             # waterfall = normalize_counts(waterfall)
             np.save("{0}waterfall_{1}+{2:08}sec.npy"
                     .format(savepref, t0, dt.sec), waterfall)
 
     if do_foldspec:
-        foldspec = np.zeros_like(myfoldspec)
-        icount = np.zeros_like(myicount)
-        comm.Reduce(myfoldspec, foldspec, op=MPI.SUM, root=0)
-        comm.Reduce(myicount, icount, op=MPI.SUM, root=0)
+        foldspec = reduce_array(comm, myfoldspec)
+        icount = reduce_array(comm, myicount)
         if comm.rank == 0:
             fname = ("{0}foldspec_{1}+{2:08}sec.npy")
             iname = ("{0}icount_{1}+{2:08}sec.npy")